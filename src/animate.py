@@ -8,10 +8,17 @@ import testcases
 from vmpoolstate import VMPoolState
 from dijkstra import VMPoolShortestPathFinder
 from aspiers import VMPoolAdamPathFinder
+from waves import WaveScheduler
 
 #STRATEGY = VMPoolShortestPathFinder
 STRATEGY = VMPoolAdamPathFinder
 
+# With a trailing 'waves' argument, migrations which can be performed
+# concurrently are animated together.
+waves = len(sys.argv) >= 2 and sys.argv[-1] == 'waves'
+if waves:
+    sys.argv.pop()
+
 if len(sys.argv) >= 2 and sys.argv[1] == 'random':
     stateA, stateB, expected_path = testcases.random.identical_hosts()
 else:
@@ -32,6 +39,8 @@ except RuntimeError, exc:
     sys.exit(1)
 
 if path:
-    path.animate(True)
+    if waves:
+        WaveScheduler().schedule(path)
+    path.animate(True, waves=waves)
 else:
     print "\nNo path found to animate."
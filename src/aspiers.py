@@ -1,14 +1,117 @@
 #!/usr/bin/python
 
-import copy
+import bisect
+import functools
+import time
 from types import *
 
-from vmpoolstateerrors import VMPoolStateSanityError
+from lrucache import LRUCache
 from vmmigration import VMmigration
-from pathfinder import VMPoolPathFinder
+from pathfinder import VMPoolPathFinder, traced
 from vm import VM
 from vmhost import VMhost
 
+# The recursive parts of the algorithm are written as generators,
+# which are run on an explicit stack by VMPoolAdamPathFinder._run().
+# Rather than calling another such generator directly, a frame yields
+# it (or a _Call wrapping it), and is sent back its result once it has
+# finished.  A frame finishes by yielding a _Return, since generators
+# can't return values.  This means the depth of the recursion is not
+# limited by Python's stack.
+
+class _Call:
+    """Request to run the given frame, caching its result in the
+    transposition table under key if that isn't None.
+    """
+    def __init__(self, frame, key=None):
+        self.frame = frame
+        self.key = key
+
+class _Cached:
+    """Result of a frame which is already known, so doesn't need to
+    be run.
+    """
+    def __init__(self, value):
+        self.value = value
+
+class _Return:
+    """Request to finish the current frame with the given result."""
+    def __init__(self, value):
+        self.value = value
+
+class _BudgetExhausted(Exception):
+    """Raised by VMPoolAdamPathFinder._run() to abandon the frames on
+    the stack when one of the path finder's budgets has run out.
+    """
+    def __init__(self, reason):
+        Exception.__init__(self, reason)
+        self.reason = reason
+
+def transposed(method):
+    """Decorator for frames of VMPoolAdamPathFinder which solve the
+    subproblem of reaching a state in which the given migration has
+    been performed.  Since the same subproblem is frequently reached
+    via different branches of the recursion, results (including
+    failures) are cached in the path finder's transposition table.
+
+    Besides the arguments, the result can only depend on which VM was
+    most recently migrated (which is never allowed to move again
+    straight away), so the rest of the path is omitted from the key.
+    vms_to_migrate is omitted too, since it always consists of exactly
+    the VMs which aren't on their final VM host in current_state.
+    """
+    @functools.wraps(method)
+    def wrapper(self, path, current_state, migration,
+                vms_to_migrate, locked_vms):
+        if self.transpositions is None:
+            return method(self, path, current_state, migration,
+                          vms_to_migrate, locked_vms)
+
+        key = (method.__name__, current_state,
+               migration.vm.name, migration.from_host.name,
+               migration.to_host.name,
+               path[-1].vm.name if path else None,
+               frozenset(locked_vms))
+        try:
+            result = self.transpositions[key]
+        except KeyError:
+            return _Call(method(self, path, current_state, migration,
+                                vms_to_migrate, locked_vms),
+                         key)
+        self.debug(2, "= reusing %s result for %s", method.__name__,
+                   migration)
+        return _Cached(result)
+    return wrapper
+
+class DisplacementNogood:
+    """Explanation of why no amount of displacing VMs from a VM host
+    could make way for the usurper VM: the host is short of RAM by
+    shortfall MB, even if all its guests other than locked_vms (the
+    names of those which are locked in place) were displaced.  If
+    arch_ok is False, the usurper couldn't run on the host anyway.
+
+    These only come from the bound check in _displacement_nogood(),
+    which prunes displacements which are hopeless on the face of it.
+    Failures found by searching aren't recorded as nogoods, since
+    whether displacement succeeds also depends on the rest of the
+    pool, so they are left to the transposition table.
+    """
+
+    def __init__(self, vmhost_name, usurper_name, shortfall, locked_vms,
+                 arch_ok=True):
+        self.vmhost_name = vmhost_name
+        self.usurper_name = usurper_name
+        self.shortfall = shortfall
+        self.locked_vms = locked_vms
+        self.arch_ok = arch_ok
+
+    def __str__(self):
+        if not self.arch_ok:
+            return "%s can't run on %s" % (self.usurper_name, self.vmhost_name)
+        return "%s short of %dMB for %s with [%s] locked" % \
+            (self.vmhost_name, self.shortfall, self.usurper_name,
+             ' '.join(sorted(self.locked_vms)))
+
 class VMPoolAdamPathFinder(VMPoolPathFinder):
     """Recursive path finding algorithm based around the concept of a
     TODO list containing which VMs have not yet reached their final
@@ -39,16 +142,154 @@ class VMPoolAdamPathFinder(VMPoolPathFinder):
     path-finding runs.
     """
 
+    # Maximum number of subproblem results to cache (see
+    # transposed()), or None to disable caching.
+    transposition_table_size = 100000
+
+    # Whether to try displacement candidates in order of cost and
+    # fit rather than in the order they are found; see
+    # _find_displacement_candidates().  None does so unless the cost
+    # model is just RAM (see CostModel.ram_only): bench.py's
+    # bench_candidate_order() finds it makes no difference to the
+    # total cost of the paths found then, but cuts it by about 1.5%
+    # under LiveMigrationCostModel.
+    best_fit_candidates = None
+
+    def init(self):
+        if self.best_fit_candidates is None:
+            self.best_fit_candidates = \
+                not VMmigration.cost_model.ram_only
+
+        self.transpositions = None
+        if self.transposition_table_size:
+            self.transpositions = LRUCache(self.transposition_table_size)
+
+        # Number of displacements ruled out by the bound check in
+        # _displacement_nogood() without searching.
+        self.nogood_prunes = 0
+
+        # Number of frames run, the deepest the stack got, and how
+        # deep it was when the budgets were last checked.
+        self.frames_run = 0
+        self.max_depth = 0
+        self._stack_depth = 0
+
+        # The path from the start along which _solve() got the most
+        # VMs to their final VM host, for when the search runs out
+        # of budget.
+        self.best_partial = [ ]
+        self.best_partial_placed = 0
+
+        # VMs still to migrate as of the most recent _solve(), for
+        # progress reports.
+        self._vms_to_migrate = self.path.vms_to_migrate
+
+    def nodes_searched(self):
+        return self.frames_run
+
+    def states_resident(self):
+        # Each frame on the stack holds at least one state, and so
+        # does each entry in the transposition table.
+        resident = self._stack_depth
+        if self.transpositions is not None:
+            resident += len(self.transpositions)
+        return resident
+
+    def current_depth(self):
+        return self._stack_depth
+
+    def vms_remaining(self):
+        return len(self._vms_to_migrate)
+
     def run(self):
-        self.debug(2, self.path.challenge_visualization(10, 80))
-        return self._solve([],
-                           self.path.state_post_initial_shutdowns,
-                           self.path.vms_to_migrate)
+        if self._debug_level >= 2:
+            self.debug(2, self.path.challenge_visualization(10, 80))
+        try:
+            return self._run(self._solve([],
+                                         self.path.state_post_initial_shutdowns,
+                                         self.path.vms_to_migrate))
+        except _BudgetExhausted, e:
+            self.give_up(e.reason, self.best_partial)
+            return None
+
+    def _run(self, frame):
+        """Runs the given frame, and any frames it requests to run in
+        turn, on an explicit stack until it finishes, and returns its
+        result.
+
+        The budgets are checked, and progress reported, before the
+        first frame is run, every 256 frames after that, and before
+        any frame which would exceed max_nodes or max_states.  If any
+        budget has run out or the search has been cancelled, the
+        frames are abandoned and _BudgetExhausted is raised.
+        """
+        frames = [ frame ]
+        keys = [ None ]
+        push_frame, pop_frame = frames.append, frames.pop
+        push_key, pop_key = keys.append, keys.pop
+        transpositions = self.transpositions
+        # Debugging output is indented by the depth of the stack, as
+        # for methods decorated with @traced.
+        debugging = self._debug_level > 0
+        value = None
+        max_nodes, max_states = self.max_nodes, self.max_states
+        self._check_budgets(0, 0)
+        self.frames_run += 1
+        max_depth = 1
+        while True:
+            if debugging:
+                self._depth = len(frames)
+            request = frames[-1].send(value)
+            request_class = request.__class__
+            if request_class is _Return:
+                # The finished frame is discarded without resuming it.
+                pop_frame()
+                key = pop_key()
+                value = request.value
+                if key is not None:
+                    transpositions[key] = value
+                if not frames:
+                    break
+            elif request_class is _Cached:
+                value = request.value
+            else:
+                if self.frames_run & 255 == 0 or \
+                   (max_nodes is not None and
+                    self.frames_run >= max_nodes) or \
+                   (max_states is not None and
+                    len(frames) + len(transpositions or ()) >= max_states):
+                    self._check_budgets(len(frames), max_depth)
+                if request_class is _Call:
+                    push_frame(request.frame)
+                    push_key(request.key)
+                else:
+                    push_frame(request)
+                    push_key(None)
+                value = None
+                self.frames_run += 1
+                if len(frames) > max_depth:
+                    max_depth = len(frames)
+
+        self._depth = 0
+        self._stack_depth = 0
+        self.max_depth = max(self.max_depth, max_depth)
+        return value
+
+    def _check_budgets(self, stack_depth, max_depth):
+        """Raises _BudgetExhausted if should_give_up() says so, with
+        the stack of frames being run by _run() at the given depth.
+        """
+        self._stack_depth = stack_depth
+        reason = self.should_give_up()
+        if reason is not None:
+            self._depth = 0
+            self.max_depth = max(self.max_depth, max_depth)
+            raise _BudgetExhausted(reason)
 
     def _solve(self, path, current_state, vms_to_migrate):
-        """Returns a list of sane migrations which transform the
-        current state into the final state, or None if no path
-        to the final state could be found.
+        """Frame which returns a list of sane migrations which
+        transform the current state into the final state, or None if
+        no path to the final state could be found.
 
         path is the path from the initial state to current_state,
         and is used purely for debugging.
@@ -60,27 +301,51 @@ class VMPoolAdamPathFinder(VMPoolPathFinder):
         each time we recursively invoke solve().
         """
         self.debug(1, "\n>> _solve")
-        self.debug(1, repr(path))
+        self.debug(1, "%r", path)
 
         if self._solved(current_state, vms_to_migrate):
-            return []
+            yield _Return([])
+            return
 
-        final_state = self.path.state_pre_final_provisions
+        self._vms_to_migrate = vms_to_migrate
+        placed = self.vms_placed(current_state)
+        if placed > self.best_partial_placed:
+            self.best_partial = path
+            self.best_partial_placed = placed
 
         for vm_name in sorted(vms_to_migrate.keys()):
-            from_host = current_state.get_vm_vmhost(vm_name)
-            to_host = self.target_host(vm_name)
-            migration = VMmigration(vm_name, from_host, to_host)
-            self.debug(2, "solve: %s" % migration)
-            path_segment, new_state, new_vms_to_migrate, locked_vms = \
-                self._solve_to(path, current_state, migration, vms_to_migrate, {})
-            if path_segment:
-                path_remainder = self._solve(path + path_segment, new_state,
-                                             new_vms_to_migrate)
-                if path_remainder is not None:
-                    return path_segment + path_remainder
-
-        return None
+            migrations = yield self._solve_first(path, current_state,
+                                                 vms_to_migrate, vm_name)
+            if migrations is not None:
+                yield _Return(migrations)
+                return
+
+        yield _Return(None)
+
+    def _solve_first(self, path, current_state, vms_to_migrate, vm_name):
+        """Frame which returns a list of sane migrations which
+        transform the current state into the final state, starting
+        with those which get the named VM to its final VM host, or
+        None if no such path could be found.
+        """
+        from_host = current_state.get_vm_vmhost(vm_name)
+        to_host = self.target_host(vm_name)
+        migration = VMmigration(vm_name, from_host, to_host)
+        self.debug(2, "solve: %s", migration)
+        path_segment, new_state, new_vms_to_migrate, locked_vms = \
+            yield self._solve_to(path, current_state, migration,
+                                 vms_to_migrate, {})
+        if not path_segment:
+            yield _Return(None)
+            return
+
+        path_remainder = yield self._solve(path + path_segment,
+                                           new_state, new_vms_to_migrate)
+        if path_remainder is None:
+            yield _Return(None)
+            return
+
+        yield _Return(path_segment + path_remainder)
 
     def _solved(self, current_state, vms_to_migrate):
         if current_state == self.path.state_pre_final_provisions:
@@ -98,17 +363,21 @@ class VMPoolAdamPathFinder(VMPoolPathFinder):
         else:
             return False
 
+    @transposed
     def _solve_to(self, path, current_state, migration,
                   vms_to_migrate, locked_vms):
-        """Finds a sequence of sane migrations from the current state
-        ending with the given migration.
+        """Frame which finds a sequence of sane migrations from the
+        current state ending with the given migration.
 
         Returns a (path, new_state, vms_to_migrate, locked_vms) tuple:
         path
             the list of sane migrations from the current state ending
             with the given migration, or None if no such path is found
         new_state
-            the new state reached by the given path, or None
+            the new state reached by the given path, or if no path is
+            found, the DisplacementNogood by which the bound check in
+            _displacement_nogood() ruled it out, or None if the search
+            ran out of candidates
         vms_to_migrate
             an updated copy of the provided vms_to_migrate dict, taking into
             account any VMs which have been migrated
@@ -123,8 +392,8 @@ class VMPoolAdamPathFinder(VMPoolPathFinder):
 
         Recursively calls _displace() when necessary.
         """
-        self.debug(1, "\n>> solve_to %s" % migration)
-        self.debug(1, repr(path))
+        self.debug(1, "\n>> solve_to %s", migration)
+        self.debug(1, "%r", path)
 
         single, new_state, new_vms_to_migrate = \
             self._solve_single(path, current_state, migration,
@@ -133,27 +402,36 @@ class VMPoolAdamPathFinder(VMPoolPathFinder):
         self.debug(1, "")
         if single is not None:
             self.debug(1, "<< solved without displacement")
-            return single, new_state, new_vms_to_migrate, locked_vms
-
-        self.debug(2, "can't migrate %s without first making way:" \
-                       % migration.vm)
-        self.debug(2, "%s" % new_state)
-        self.debug(2, "vms_to_migrate pre displacement: %s" % \
+            yield _Return((single, new_state, new_vms_to_migrate, locked_vms))
+            return
+
+        if self._debug_level >= 2:
+            self.debug(2, "can't migrate %s without first making way:",
+                       migration.vm)
+            self.debug(2, "%s", current_state)
+            self.debug(2, "vms_to_migrate pre displacement: %s",
                        ", ".join(vms_to_migrate.keys()))
         displacement_path, displaced_state, vms_to_migrate, locked_vms = \
-            self._displace(path, current_state, migration,
-                           vms_to_migrate, locked_vms)
+            yield self._displace(path, current_state, migration,
+                                 vms_to_migrate, locked_vms)
         if displacement_path is None:
-            self.debug(1, "<< Couldn't make way for %s at %s" % \
-                           (migration.vm.name, current_state))
-            return None, None, None, None
-
-        self.debug(2, "_solve_to returning: [%s]\n" % \
+            # On failure, _displace() provides the nogood from its
+            # bound check (or None) in place of the new state.
+            nogood = displaced_state
+            self.debug(1, "<< Couldn't make way for %s at %s: %s",
+                       migration.vm.name, current_state, nogood)
+            yield _Return((None, nogood, None, None))
+            return
+
+        if self._debug_level >= 2:
+            self.debug(2, "_solve_to returning: [%s]\n",
                        ", ".join([ str(m) for m in displacement_path ]))
-        self.debug(2, "vms_to_migrate: %s" % \
+            self.debug(2, "vms_to_migrate: %s",
                        ", ".join(sorted(vms_to_migrate.keys())))
-        return displacement_path, displaced_state, vms_to_migrate, locked_vms
+        yield _Return((displacement_path, displaced_state,
+                       vms_to_migrate, locked_vms))
 
+    @traced
     def _solve_single(self, path, current_state, migration,
                       vms_to_migrate, locked_vms):
         """Checks the given migration is sane, and returns the updated state.
@@ -163,41 +441,41 @@ class VMPoolAdamPathFinder(VMPoolPathFinder):
             a singleton list of the migration, or None
             if the migration is not sane
         new_state
-            the new state reached by the given migration, or
-            VMPoolStateSanityError if the migration is not sane
+            the new state reached by the given migration, or None
         vms_to_migrate
             an updated version of vms_to_migrate, or None
         """
-        self.debug(1, "\n>> solve_single %s" % migration)
-        self.debug(1, repr(path))
+        self.debug(1, "\n>> solve_single %s", migration)
+        self.debug(1, "%r", path)
 
         if path and path[-1].vm.name == migration.vm.name:
             # If we allowed this, we'd just go around in circles
             self.debug(2, "<< cannot migrate same VM twice in a row")
             return None, None, None
 
-        vm_highlights = self._get_vm_highlights(vms_to_migrate, locked_vms)
-        vm_highlights[migration.vm.name] = ('yellow', 'on_cyan')
-        vmhost_highlights = { migration.to_host.name :
-                                  ('white', 'on_green', ['bold']) }
-        self.debug_state(current_state, vms_to_migrate, locked_vms,
-                         vm_highlights, vmhost_highlights)
+        if self._debug_level >= 2:
+            vm_highlights = self._get_vm_highlights(vms_to_migrate, locked_vms)
+            vm_highlights[migration.vm.name] = ('yellow', 'on_cyan')
+            vmhost_highlights = { migration.to_host.name :
+                                      ('white', 'on_green', ['bold']) }
+            self.debug_state(current_state, vms_to_migrate, locked_vms,
+                             vm_highlights, vmhost_highlights)
 
-        try:
-            new_state = \
-                current_state.check_migration_sane(migration.vm.name,
-                                                   migration.to_host)
-        except VMPoolStateSanityError, exc:
+        if not current_state.can_migrate(migration.vm.name,
+                                         migration.to_host.name):
             self.debug(2, "<< migration not currently possible")
-            return None, exc, None
+            return None, None, None
 
-        self.debug(2, "<< migration sane; new segment: %s" % migration)
+        new_state = current_state.migrate(migration.vm.name,
+                                          migration.to_host.name)
+
+        self.debug(2, "<< migration sane; new segment: %s", migration)
         vms_to_migrate = self._update_vms_to_migrate(vms_to_migrate, migration)
 
         return [ migration ], new_state, vms_to_migrate
 
     def _update_vms_to_migrate(self, vms_to_migrate, migration):
-        vms_to_migrate = copy.copy(vms_to_migrate)
+        vms_to_migrate = dict(vms_to_migrate)
         vm_name = migration.vm.name
         target_host = self.target_host(vm_name)
         if migration.to_host == VMhost.vmhosts[target_host.name]:
@@ -219,10 +497,11 @@ class VMPoolAdamPathFinder(VMPoolPathFinder):
     ALLOW_RECURSION = 0
     PROHIBIT_RECURSION = 1
 
+    @transposed
     def _displace(self, path, current_state, on_behalf_of,
                   vms_to_migrate, locked_vms):
-        """Allow the on_behalf_of migration to take place by
-        displacing as many VMs as required away from the migration's
+        """Frame which allows the on_behalf_of migration to take place
+        by displacing as many VMs as required away from the migration's
         destination host.  Any VMs whose name is in the locked_vms
         dict is excluded from displacement.
 
@@ -231,7 +510,10 @@ class VMPoolAdamPathFinder(VMPoolPathFinder):
             the list of sane migrations ending with on_behalf_of,
             or None if no such path is found
         new_state
-            the new state reached by the given path, or None
+            the new state reached by the given path, or if no path is
+            found, the DisplacementNogood by which the bound check in
+            _displacement_nogood() ruled it out, or None if the search
+            ran out of candidates
         vms_to_migrate
             an updated copy of the provided vms_to_migrate dict, taking into
             account any VMs which have been migrated
@@ -242,17 +524,26 @@ class VMPoolAdamPathFinder(VMPoolPathFinder):
         Recursively calls _displace() / _solve_single() as necessary.
         """
         usurper_name = on_behalf_of.vm.name
-        self.debug(2, "\n_displace from %s for %s" % \
-                       (on_behalf_of.to_host.name, usurper_name))
-        self.debug(2, "vms_to_migrate: %s" % \
+        self.debug(2, "\n_displace from %s for %s",
+                   on_behalf_of.to_host.name, usurper_name)
+        if self._debug_level >= 2:
+            self.debug(2, "vms_to_migrate: %s",
                        ", ".join(vms_to_migrate.keys()))
 
         # Ensure displacement can't touch the VM we're displacing on behalf of,
         # otherwise when we've successfully displaced, we might not be able to
         # perform the migration we originally wanted to do.
-        locked_for_displacement = copy.copy(locked_vms)
+        locked_for_displacement = dict(locked_vms)
         locked_for_displacement[usurper_name] = True
-        self.debug(2, "+ locked %s" % usurper_name)
+        self.debug(2, "+ locked %s", usurper_name)
+
+        nogood = self._displacement_nogood(current_state, on_behalf_of,
+                                           locked_for_displacement)
+        if nogood is not None:
+            self.debug(2, "<< nogood: %s", nogood)
+            self.nogood_prunes += 1
+            yield _Return((None, nogood, None, None))
+            return
 
         candidates = \
             self._find_displacement_candidates(path, current_state,
@@ -273,62 +564,113 @@ class VMPoolAdamPathFinder(VMPoolPathFinder):
                 # no change to which VMs are locked
                 partially_displaced_locked_vms = locked_for_displacement
             elif recursion_mode == self.ALLOW_RECURSION:
+                # Don't bother recursing if the candidate's own
+                # destination can't be made room on.
+                locked_for_candidate = dict(locked_for_displacement)
+                locked_for_candidate[migration.vm.name] = True
+                nogood = self._displacement_nogood(current_state, migration,
+                                                   locked_for_candidate)
+                if nogood is not None:
+                    self.debug(2, "- skipping %s; nogood: %s", migration, nogood)
+                    self.nogood_prunes += 1
+                    continue
+
                 (partial_displacements,
                  partially_displaced_state,
                  partially_displaced_vms_to_migrate,
                  partially_displaced_locked_vms) = \
-                    self._solve_to(path, current_state, migration,
-                                   vms_to_migrate, locked_for_displacement)
+                    yield self._solve_to(path, current_state, migration,
+                                         vms_to_migrate,
+                                         locked_for_displacement)
             else:
                 raise RuntimeError("BUG: unknown recursion_mode %s" %
                                    recursion_mode)
 
             if partial_displacements is None:
                 continue
-            self.debug(2, "+ path to unvalidated displacement: %s" % \
-                           partial_displacements)
+            self.debug(2, "+ path to unvalidated displacement: %s",
+                       partial_displacements)
 
             remaining_displacements, fully_displaced_state, \
                 fully_displaced_vms_to_migrate, displaced_locked_vms = \
-                self._recurse_displacement(path + partial_displacements,
-                                           partially_displaced_state,
-                                           migration, on_behalf_of,
-                                           partially_displaced_vms_to_migrate,
-                                           partially_displaced_locked_vms)
+                yield self._recurse_displacement(
+                    path + partial_displacements,
+                    partially_displaced_state,
+                    migration, on_behalf_of,
+                    partially_displaced_vms_to_migrate,
+                    partially_displaced_locked_vms)
             if remaining_displacements is None:
                 # couldn't find a way to make this candidate work
                 continue
 
             displacements = partial_displacements + remaining_displacements
 
-            self.debug(2, "<< solved displacement %d for %s" % \
-                           (self.candidate_search_count, on_behalf_of))
+            self.debug(2, "<< solved displacement %d for %s",
+                       self.candidate_search_count, on_behalf_of)
             # self.debug(2, "[%s]" % \
             #                ", ".join([ str(m) for m in displacements ]))
 
-            return displacements, fully_displaced_state, \
-                fully_displaced_vms_to_migrate, displaced_locked_vms
+            yield _Return((displacements, fully_displaced_state,
+                           fully_displaced_vms_to_migrate,
+                           displaced_locked_vms))
+            return
 
         self.debug(2, "<< ran out of displacement candidates! " \
                        "giving up on displacement.")
-        return None, None, None, None
+        yield _Return((None, None, None, None))
+
+    def _displacement_nogood(self, current_state, migration, locked_vms):
+        """Returns a DisplacementNogood if the given migration
+        is impossible and no amount of displacing VMs from its
+        destination host could make it possible, or None otherwise.
+
+        Displacement can only ever move unlocked VMs off the host
+        (and locked VMs stay locked all the way down the recursion),
+        so the most RAM it could free is the total RAM of the
+        unlocked guests.
+        """
+        vm = migration.vm
+        to_host = migration.to_host
+        if not current_state.vm_arch_ok(vm, to_host):
+            return DisplacementNogood(to_host.name, vm.name, 0,
+                                      frozenset(), arch_ok=False)
+
+        shortfall = vm.ram - current_state.free_RAM(to_host.name)
+        if shortfall <= 0:
+            return None
+
+        locked = [ ]
+        unlocked_ram = 0
+        for vm_name in current_state.get_vmhost_vms(to_host.name):
+            if vm_name in locked_vms:
+                locked.append(vm_name)
+            else:
+                unlocked_ram += VM.vms[vm_name].ram
+                if unlocked_ram >= shortfall:
+                    return None
+
+        return DisplacementNogood(to_host.name, vm.name, shortfall,
+                                  frozenset(locked))
 
     candidate_search_count = 0
 
     def _recurse_displacement(self, path, current_state, migration,
                               on_behalf_of, vms_to_migrate, locked_vms):
-        """Once the given displacement migration has been made, see
-        whether it was sufficient to allow the on_behalf_of migration
-        to take place, and if not, continue recursively displacing
-        more VMs until we've displaced enough, or until we reach an
-        impasse.
+        """Frame which, once the given displacement migration has been
+        made, sees whether it was sufficient to allow the on_behalf_of
+        migration to take place, and if not, continues recursively
+        displacing more VMs until we've displaced enough, or until we
+        reach an impasse.
 
         Returns a (path, new_state, vms_to_migrate, locked_vms) tuple:
         path
             the list of sane migrations ending with on_behalf_of,
             or None if no such path is found
         new_state
-            the new state reached by the given path, or None
+            the new state reached by the given path, or if no path is
+            found, the DisplacementNogood by which the bound check in
+            _displacement_nogood() ruled it out, or None if the search
+            ran out of candidates
         vms_to_migrate
             an updated copy of the provided vms_to_migrate dict, taking into
             account any VMs which have been migrated
@@ -338,30 +680,32 @@ class VMPoolAdamPathFinder(VMPoolPathFinder):
 
         Recursively calls _displace() as necessary.
         """
-        self.debug(1, "\n>> recurse_displacement for %s" % on_behalf_of)
-        self.debug(1, repr(path))
+        self.debug(1, "\n>> recurse_displacement for %s", on_behalf_of)
+        self.debug(1, "%r", path)
 
         single, new_state, new_vms_to_migrate = \
             self._solve_single(path, current_state, on_behalf_of,
                                vms_to_migrate, locked_vms)
 
-        if path is not None:
-            self.debug(2, "<< %s achieves effective displacement" % migration)
-            return single, new_state, new_vms_to_migrate, locked_vms
+        if single is not None:
+            self.debug(2, "<< %s achieves effective displacement", migration)
+            yield _Return((single, new_state, new_vms_to_migrate, locked_vms))
         else:
-            self.debug(2, "+ %s doesn't achieve effective displacement" % \
-                           migration)
+            self.debug(2, "+ %s doesn't achieve effective displacement",
+                       migration)
             # keep on displacing
             rest_of_path, current_state, displaced_vms_to_migrate, locked_vms = \
-                self._displace(path + [ on_behalf_of ], current_state,
-                               on_behalf_of, vms_to_migrate, locked_vms)
+                yield self._displace(path, current_state,
+                                     on_behalf_of, vms_to_migrate, locked_vms)
             if rest_of_path is None:
                 self.debug(2, "<< couldn't displace enough; give up on this path")
-                return None, None, None, None
+                # current_state is now the nogood (or None) from _displace()
+                yield _Return((None, current_state, None, None))
+                return
 
-            self.debug(2, "<< finished displacement for %s" % on_behalf_of)
-            return rest_of_path, current_state, \
-                displaced_vms_to_migrate, locked_vms
+            self.debug(2, "<< finished displacement for %s", on_behalf_of)
+            yield _Return((rest_of_path, current_state,
+                           displaced_vms_to_migrate, locked_vms))
 
     def _find_displacement_candidates(self, path, current_state, vms_to_migrate,
                                       on_behalf_of, locked_vms):
@@ -383,27 +727,45 @@ class VMPoolAdamPathFinder(VMPoolPathFinder):
         This minimises the number of workloads which are potentially
         impacted, and hopefully helps minimise the number of
         required migrations too.
+
+        Within each case, candidates are provided in whatever order
+        the pool state happens to list VMs and VM hosts, unless
+        best_fit_candidates is set, in which case they are ordered
+        by the cost model (see VMmigration.set_cost_model()).  In case
+        1, VMs which would free enough RAM on their own are tried
+        first, followed by the rest, each in ascending order of the
+        cost model's lower bound on migrating them away.  In cases 2
+        and 3, the cheapest migrations are tried first, and among
+        equally cheap ones, those to the VM hosts with the least free
+        RAM which can accommodate the VM (best fit).  The orderings
+        come from sorted indexes cached by the pool state, so only
+        the feasible migrations in cases 2 and 3 need sorting.
         """
         VMPoolAdamPathFinder.candidate_search_count += 1
 
-        def _debug_cand(msg):
-            self.debug(2, "[%d] %s" % \
-                           (VMPoolAdamPathFinder.candidate_search_count, msg))
+        def _debug_cand(msg, *args):
+            self.debug(2, "[%d] " + msg,
+                       VMPoolAdamPathFinder.candidate_search_count, *args)
 
         # We iterate searching for case 1, and queue up any instances
         # of cases 2 and 3 we find for later, in case we need them.
         case_two, case_three = [ ], [ ]
 
         displace_from_host = on_behalf_of.to_host
-        _debug_cand("finding candidates to displace from %s" %
+        _debug_cand("finding candidates to displace from %s",
                     displace_from_host.name)
 
-        for vm_name in current_state.vmhost2vms[displace_from_host.name]:
+        if self.best_fit_candidates:
+            vm_names = self._vms_by_displacement_cost(current_state,
+                                                      on_behalf_of)
+        else:
+            vm_names = current_state.get_vmhost_vms(displace_from_host.name)
+        for vm_name in vm_names:
             if vm_name in locked_vms:
-                _debug_cand("1  - %s is locked; not considering" % vm_name)
+                _debug_cand("1  - %s is locked; not considering", vm_name)
                 continue
             if path and vm_name == path[-1].vm.name:
-                _debug_cand("1  - %s was just moved; not considering" % vm_name)
+                _debug_cand("1  - %s was just moved; not considering", vm_name)
                 continue
             if vm_name in vms_to_migrate:
                 to_host = self.target_host(vm_name)
@@ -412,10 +774,10 @@ class VMPoolAdamPathFinder(VMPoolPathFinder):
                     raise RuntimeError("shouldn't be considering %s "
                                        "which displacement is on behalf of" %
                                        on_behalf_of)
-                _debug_cand("1  ? consider required displacement %s" % migration)
+                _debug_cand("1  ? consider required displacement %s", migration)
                 case_two.append((vm_name, to_host))
-                _debug_cand("1  + deferred case 2: %s -> anything but %s" %
-                            (vm_name, to_host.name))
+                _debug_cand("1  + deferred case 2: %s -> anything but %s",
+                            vm_name, to_host.name)
                 # We need to perform this migration anyway, so it
                 # shouldn't cost us too dearly to recursively displace
                 # if necessary in order to make it possible.
@@ -423,39 +785,181 @@ class VMPoolAdamPathFinder(VMPoolPathFinder):
             else:
                 case_three.append(vm_name)
                 _debug_cand("1  + deferred case 3: "
-                            "undesirable migration of %s" % vm_name)
+                            "undesirable migration of %s", vm_name)
+
+        # Candidates in cases 2 and 3 are only accepted if they can be
+        # performed immediately, so rule out the rest in one go.
+        feasible = set(current_state.feasible_migrations(
+            [ vm_name for vm_name, final_host in case_two ] + case_three))
 
         # Case 2: migrating VMs which we need to move anyway, directly
         # to a non-final destination.
-        for to_host_name in current_state.vmhost_names():
-            to_host = VMhost.vmhosts[to_host_name]
-            if to_host == displace_from_host:
-                continue
-            for vm_name, final_host in case_two:
-                if to_host == final_host:
-                    continue
-                migration = VMmigration(vm_name, displace_from_host, to_host)
-                _debug_cand("2  ? consider extra displacement: %s" % migration)
-                # This migration isn't ideal, so if it's not directly possible,
-                # try something else instead.
-                yield (migration, self.PROHIBIT_RECURSION)
+        for vm_name, to_host in self._extra_displacements(
+                current_state, displace_from_host, case_two, feasible):
+            migration = VMmigration(vm_name, displace_from_host, to_host)
+            _debug_cand("2  ? consider extra displacement: %s", migration)
+            # This migration isn't ideal, so if it's not directly possible,
+            # try something else instead.
+            yield (migration, self.PROHIBIT_RECURSION)
 
         # Case 3. migrating VMs which we wouldn't otherwise need to move,
         # directly away from their non-final destination
-        for to_host_name in current_state.vmhost_names():
-            to_host = VMhost.vmhosts[to_host_name]
-            if to_host == displace_from_host:
-                continue
-            for vm_name in case_three:
-                migration = VMmigration(vm_name, displace_from_host, to_host)
-                _debug_cand("3  ? consider extra displacement: %s" % migration)
-                # This migration isn't ideal, so if it's not directly possible,
-                # try something else instead.
-                yield (migration, self.PROHIBIT_RECURSION)
+        for vm_name, to_host in self._extra_displacements(
+                current_state, displace_from_host,
+                [ (vm_name, None) for vm_name in case_three ], feasible):
+            migration = VMmigration(vm_name, displace_from_host, to_host)
+            _debug_cand("3  ? consider extra displacement: %s", migration)
+            # This migration isn't ideal, so if it's not directly possible,
+            # try something else instead.
+            yield (migration, self.PROHIBIT_RECURSION)
 
         _debug_cand("no more displacement candidates")
 
+    def _vms_by_displacement_cost(self, current_state, on_behalf_of):
+        """Returns the names of the VMs on the destination host of the
+        on_behalf_of migration, starting with those big enough to make
+        room for it on their own, followed by the rest, each in
+        ascending order of the cost of migrating them away.
+        """
+        vmhost_name = on_behalf_of.to_host.name
+        shortfall = on_behalf_of.vm.ram - current_state.free_RAM(vmhost_name)
+        big_enough, rest = [ ], [ ]
+        for cost, vm_name in current_state.vmhost_vms_by_cost(vmhost_name):
+            if VM.vms[vm_name].ram >= shortfall:
+                big_enough.append(vm_name)
+            else:
+                rest.append(vm_name)
+        return big_enough + rest
+
+    def _extra_displacements(self, current_state, displace_from_host,
+                             candidates, feasible):
+        """Generator which provides (VM name, VM host) pairs for the
+        feasible migrations of the given (VM name, final VM host)
+        candidates away from displace_from_host, other than to their
+        final VM host.  See _find_displacement_candidates() for the
+        order in which they are provided.
+        """
+        if not self.best_fit_candidates:
+            for to_host_name in current_state.vmhost_names():
+                to_host = VMhost.vmhosts[to_host_name]
+                if to_host == displace_from_host:
+                    continue
+                for vm_name, final_host in candidates:
+                    if to_host is final_host:
+                        continue
+                    if (vm_name, to_host_name) not in feasible:
+                        continue
+                    yield vm_name, to_host
+            return
+
+        cost_model = VMmigration.cost_model
+        vmhosts = current_state.vmhosts_by_free_RAM()
+        displacements = [ ]
+        for vm_name, final_host in candidates:
+            vm = VM.vms[vm_name]
+            start = bisect.bisect_left(vmhosts, (vm.ram, ''))
+            for free_RAM, to_host_name in vmhosts[start:]:
+                to_host = VMhost.vmhosts[to_host_name]
+                if to_host is displace_from_host or to_host is final_host:
+                    continue
+                if (vm_name, to_host_name) not in feasible:
+                    continue
+                cost = cost_model.cost(vm, displace_from_host, to_host)
+                displacements.append((cost, vm_name, to_host))
+        # The sort is stable, so equally cheap migrations stay in best
+        # fit order.
+        displacements.sort(key=lambda displacement: displacement[0])
+        for cost, vm_name, to_host in displacements:
+            yield vm_name, to_host
+
     def target_host(self, vm_name):
         target_host_name = \
             self.path.state_pre_final_provisions.get_vm_vmhost(vm_name)
         return VMhost.vmhosts[target_host_name]
+
+class VMPoolAnytimeAdamPathFinder(VMPoolAdamPathFinder):
+    """Anytime variant of VMPoolAdamPathFinder.  Rather than settling
+    for the first path found, it tries each VM which needs to be
+    migrated as the first to be moved to its final destination,
+    and keeps whichever of the resulting paths is cheapest, until
+    time_limit seconds have elapsed.
+
+    Alternatives still being searched when the time runs out are
+    abandoned, except that the time limit isn't enforced until some
+    path has been found, so the result is never worse than that of
+    VMPoolAdamPathFinder.  (The budgets passed to find_path() are
+    enforced regardless, but once a path has been found, running out
+    of them just ends the search early.)  The transposition table is
+    shared between the alternatives, so later ones are typically
+    much cheaper to search than the first.
+
+    N.B. Instances should not be reused for multiple runs.
+    """
+
+    # Wall-clock budget in seconds for trying alternative first moves.
+    time_limit = 10.0
+
+    # Reason passed to _BudgetExhausted when the time limit runs out.
+    TIME_LIMIT = 'time limit'
+
+    def init(self):
+        VMPoolAdamPathFinder.init(self)
+
+        # Number of alternative first moves tried, how many of them
+        # led to a complete path, and how many were abandoned when the
+        # time ran out.
+        self.alternatives_tried = 0
+        self.alternatives_solved = 0
+        self.alternatives_abandoned = 0
+        self.best_cost = None
+
+        # Time after which alternatives are abandoned, or None until
+        # a path has been found.
+        self.alternatives_deadline = None
+
+    def should_give_up(self):
+        if self.alternatives_deadline is not None and \
+           time.time() >= self.alternatives_deadline:
+            return self.TIME_LIMIT
+        return VMPoolAdamPathFinder.should_give_up(self)
+
+    def run(self):
+        if self._debug_level >= 2:
+            self.debug(2, self.path.challenge_visualization(10, 80))
+
+        current_state = self.path.state_post_initial_shutdowns
+        vms_to_migrate = self.path.vms_to_migrate
+        if self._solved(current_state, vms_to_migrate):
+            return []
+
+        deadline = time.time() + self.time_limit
+        best = None
+        for vm_name in sorted(vms_to_migrate.keys()):
+            if best is not None and time.time() >= deadline:
+                break
+            self.alternatives_tried += 1
+            try:
+                migrations = self._run(self._solve_first([], current_state,
+                                                         vms_to_migrate,
+                                                         vm_name))
+            except _BudgetExhausted, e:
+                self.alternatives_abandoned += 1
+                if best is None:
+                    self.give_up(e.reason, self.best_partial)
+                    return None
+                break
+            if migrations is None:
+                continue
+            self.alternatives_solved += 1
+            cost = sum([ migration.cost() for migration in migrations ])
+            self.debug(1, "alternative %d starting with %s costs %d",
+                       self.alternatives_tried, vm_name, cost)
+            if best is None or cost < self.best_cost:
+                best = migrations
+                self.best_cost = cost
+            self.alternatives_deadline = deadline
+
+        self.debug(1, "tried %d alternatives; %d solved, %d abandoned",
+                   self.alternatives_tried, self.alternatives_solved,
+                   self.alternatives_abandoned)
+        return best
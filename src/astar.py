@@ -0,0 +1,70 @@
+#!/usr/bin/python
+
+from dijkstra import VMPoolShortestPathFinder
+from vm import VM
+from vmhost import VMhost
+from vmmigration import VMmigration
+
+class VMPoolAStarPathFinder(VMPoolShortestPathFinder):
+    """A* variant of VMPoolShortestPathFinder.  Rather than exploring
+    nodes in order of their distance g from the start, it explores
+    them in order of g + h, where h is a lower bound on the remaining
+    cost from the node to the end state.  This finds paths of the same
+    (optimal) cost, but avoids expanding most of the nodes which
+    cannot possibly be on a cheap path.
+
+    Every VM which is not yet on its final host has to be migrated
+    at least once more, to its final host, so h is the sum over all
+    such VMs of the lower bound which the cost model gives for
+    migrating the VM to its final host (see CostModel.lower_bound()),
+    which by default is simply its RAM.  This is not only admissible
+    but consistent, since a single migration changes h by at most its
+    own cost, so nodes never need to be re-expanded.
+
+    N.B. Instances should not be reused for multiple runs.
+    """
+
+    def init(self):
+        # Remaining cost estimate for each node discovered so far.
+        self.estimates = { }
+        VMPoolShortestPathFinder.init(self)
+
+    def priority(self, state, previous_state, migration):
+        if previous_state is None:
+            estimate = self.estimate_remaining_cost(state)
+        else:
+            estimate = self.estimates[previous_state] + \
+                self._estimate_delta(migration)
+        self.estimates[state] = estimate
+        return self.distances[state] + estimate
+
+    def estimate_remaining_cost(self, state):
+        """Returns the sum of the lower bounds on the cost of
+        migrating each VM in the given state which is not on its final
+        host to that host.
+        """
+        end = self.path.state_pre_final_provisions
+        cost_model = VMmigration.cost_model
+        return sum([ cost_model.lower_bound(
+                         VM.vms[vm_name],
+                         VMhost.vmhosts[end.get_vm_vmhost(vm_name)])
+                     for vm_name in state.vm_names()
+                     if state.get_vm_vmhost(vm_name) !=
+                        end.get_vm_vmhost(vm_name) ])
+
+    def _estimate_delta(self, migration):
+        """Returns the change in the remaining cost estimate caused by
+        the given migration, in constant time.
+        """
+        vm_name = migration.vm.name
+        target = self.path.state_pre_final_provisions.get_vm_vmhost(vm_name)
+        if migration.from_host.name == migration.to_host.name:
+            return 0
+        if migration.from_host.name != target and \
+           migration.to_host.name != target:
+            return 0
+        bound = VMmigration.cost_model.lower_bound(migration.vm,
+                                                   VMhost.vmhosts[target])
+        if migration.to_host.name == target:
+            return -bound
+        return bound
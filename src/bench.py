@@ -0,0 +1,428 @@
+#!/usr/bin/python
+
+# Micro-benchmarks for the performance-sensitive parts of the path
+# finders.  Usage:
+#
+#   bench.py [benchmark]
+#
+# where benchmark is one of the bench_* functions below, minus the
+# prefix.  With no argument, all benchmarks are run.
+
+import multiprocessing
+import random
+import sys
+import time
+
+import testcases
+import testcases.fixed
+import testcases.random
+from vm import VM
+from vmhost import VMhost
+from vmpoolstate import VMPoolState
+from vmpoolarraystate import VMPoolArrayState
+from vmpoolstateerrors import VMPoolStateSanityError
+from vodict import ValueOrderedDictionary
+from pqueue import PriorityQueue
+from dijkstra import VMPoolShortestPathFinder
+from astar import VMPoolAStarPathFinder
+from aspiers import VMPoolAdamPathFinder, VMPoolAnytimeAdamPathFinder
+from parallel import VMPoolParallelAdamPathFinder
+from vmmigration import VMmigration
+from costmodel import CostModel, LiveMigrationCostModel
+from waves import WaveScheduler
+from compress import PathCompressor
+from improve import PathImprover
+from vmpoolpath import VMPoolPath
+
+def timed(func, *args, **kwargs):
+    """Returns a (result, seconds taken) tuple."""
+    start = time.time()
+    result = func(*args, **kwargs)
+    return result, time.time() - start
+
+def random_pool(num_vms, num_hosts, state_class=VMPoolState):
+    """Returns a state with num_vms VMs scattered randomly across
+    num_hosts identical VM hosts.
+    """
+    VM.reset()
+    VMhost.reset()
+    vmhosts = testcases.utils.create_vmhosts(num_hosts, 'x86_64', 4096, 280)
+    width = len(str(num_vms))
+    vms = [ VM("vm{0:0{1}}".format(i+1, width), 'x86_64',
+               random.randint(128, 4096))
+            for i in xrange(num_vms) ]
+    state = state_class()
+    for vmhost in vmhosts:
+        state.init_vmhost(vmhost.name)
+    for vm in vms:
+        state.add_vm(vm.name, random.choice(vmhosts).name)
+    return state
+
+def random_migration(num_vms, num_hosts, rng):
+    """Returns initial and final states which each place num_vms
+    VMs randomly (but sanely) across num_hosts identical VM hosts.
+    """
+    VM.reset()
+    VMhost.reset()
+    vmhosts = testcases.utils.create_vmhosts(num_hosts, 'x86_64', 4096, 280)
+    vms = [ VM("vm%02d" % (i+1), 'x86_64', rng.choice([ 256, 512, 1024, 2048 ]))
+            for i in xrange(num_vms) ]
+
+    def random_placement():
+        while True:
+            state = VMPoolState()
+            for vmhost in vmhosts:
+                state.init_vmhost(vmhost.name)
+            for vm in vms:
+                state.add_vm(vm.name, rng.choice(vmhosts).name)
+            try:
+                state.check_sane()
+            except VMPoolStateSanityError:
+                continue
+            return state
+
+    return random_placement(), random_placement()
+
+def bench_feasibility(num_vms=100, num_hosts=1000):
+    """Compares finding all sane migrations by constructing and
+    checking a new state for each (VM, VM host) pair, with the batch
+    feasible_migrations() query.
+    """
+    for state_class in (VMPoolState, VMPoolArrayState):
+        state = random_pool(num_vms, num_hosts, state_class)
+
+        def trial_and_error():
+            feasible = [ ]
+            for vm_name in state.vm_names():
+                for vmhost_name in state.vmhost_names():
+                    if vmhost_name == state.get_vm_vmhost(vm_name):
+                        continue
+                    try:
+                        state.check_migration_sane(
+                            vm_name, VMhost.vmhosts[vmhost_name])
+                    except VMPoolStateSanityError:
+                        continue
+                    feasible.append((vm_name, vmhost_name))
+            return feasible
+
+        slow, slow_time = timed(trial_and_error)
+        fast, fast_time = timed(state.feasible_migrations)
+        assert sorted(slow) == sorted(fast)
+        print "%-16s %dx%d: %d feasible; trial and error %.3fs, " \
+              "batch %.4fs" % \
+              (state_class.__name__, num_vms, num_hosts, len(fast),
+               slow_time, fast_time)
+
+def bench_priority_queue(size=10000):
+    """Compares ValueOrderedDictionary and PriorityQueue as the todo
+    list of a Dijkstra-like search: each shift is followed by a few
+    inserts and decrease-keys, until the queue is exhausted.
+    """
+    def run(queue_class):
+        rng = random.Random(42)
+        queue = queue_class()
+        for i in xrange(size):
+            queue.insert(i, rng.randint(0, size))
+        shifted = [ ]
+        next_key = size
+        while queue:
+            key, val = queue.shift()
+            shifted.append((key, val))
+            if next_key < 2 * size:
+                queue.insert(next_key, val + rng.randint(0, 100))
+                next_key += 1
+            for j in xrange(2):
+                other = rng.randint(0, next_key)
+                if other in queue and queue[other] > val:
+                    queue[other] = rng.randint(val, queue[other])
+        return shifted
+
+    results = { }
+    for queue_class in (ValueOrderedDictionary, PriorityQueue):
+        results[queue_class], seconds = timed(run, queue_class)
+        print "%-22s %d keys: %.3fs" % (queue_class.__name__, size, seconds)
+    assert results[ValueOrderedDictionary] == results[PriorityQueue]
+
+def bench_commuting_migrations():
+    """Compares the number of states expanded and discovered by the
+    shortest path finders with and without the reduction of
+    commuting migrations, on case_chain6 and some random pools.
+    """
+    def run(finder_class, case_name, initial, final):
+        results = [ ]
+        for reduce in (False, True):
+            finder = finder_class(initial, final, debug_level=0)
+            finder.reduce_commuting_migrations = reduce
+            path, seconds = timed(finder.find_path)
+            results.append(path and path.cost)
+            print "%-26s %-12s reduce=%-5s %6d expanded %7d discovered " \
+                  "%7.2fs" % \
+                  (finder_class.__name__, case_name, reduce,
+                   finder.nodes_expanded, len(finder.distances), seconds)
+        assert results[0] == results[1]
+
+    VM.reset()
+    VMhost.reset()
+    initial, final, expected = testcases.fixed.case_chain6()
+    run(VMPoolAStarPathFinder, 'chain6',
+        VMPoolState().init_by_vmhosts(initial),
+        VMPoolState().init_by_vmhosts(final))
+
+    rng = random.Random(42)
+    for num_vms, num_hosts in ((5, 5), (6, 6), (8, 8)):
+        initial, final = random_migration(num_vms, num_hosts, rng)
+        case_name = "%dx%d" % (num_vms, num_hosts)
+        if num_vms <= 5:
+            run(VMPoolShortestPathFinder, case_name, initial, final)
+        run(VMPoolAStarPathFinder, case_name, initial, final)
+
+def bench_adam_engine(lengths=(10, 100, 1000, 3000)):
+    """Measures how the time per frame of the Adam path finder's
+    explicit-stack engine grows with the depth of displacement
+    chains, including ones far deeper than Python's recursion limit.
+    """
+    print "recursion limit: %d" % sys.getrecursionlimit()
+    for length in lengths:
+        initial, final = testcases.utils.displacement_chain(length)
+        finder = VMPoolAdamPathFinder(initial, final, debug_level=0)
+        path, seconds = timed(finder.find_path)
+        assert len(path.migration_sequence) == length
+        print "chain of %4d: %6d frames, max depth %5d, %7.3fs, " \
+              "%5.1fus/frame" % \
+              (length, finder.frames_run, finder.max_depth, seconds,
+               1e6 * seconds / finder.frames_run)
+
+def bench_anytime(num_vms=14, num_hosts=5, trials=8, time_limit=1.0):
+    """Compares the cost and duration of the paths found by the Adam
+    path finder with those found by its anytime variant, which tries
+    alternative first moves until its time limit, on some random
+    pools.
+    """
+    rng = random.Random(42)
+    total, total_anytime = 0, 0
+    for trial in xrange(trials):
+        initial, final = random_migration(num_vms, num_hosts, rng)
+        adam = VMPoolAdamPathFinder(initial, final, debug_level=0)
+        path, seconds = timed(adam.find_path)
+        anytime = VMPoolAnytimeAdamPathFinder(initial, final, debug_level=0)
+        anytime.time_limit = time_limit
+        anytime_path, anytime_seconds = timed(anytime.find_path)
+        if path is None:
+            assert anytime_path is None
+            print "trial %2d: no path" % trial
+            continue
+        assert anytime_path.cost <= path.cost
+        total += path.cost
+        total_anytime += anytime_path.cost
+        print "trial %2d: cost %6d in %.3fs; anytime %6d in %.3fs " \
+              "(%d tried, %d solved, %d abandoned)" % \
+              (trial, path.cost, seconds, anytime_path.cost, anytime_seconds,
+               anytime.alternatives_tried, anytime.alternatives_solved,
+               anytime.alternatives_abandoned)
+    print "total cost %d; anytime %d (%.1f%% cheaper)" % \
+          (total, total_anytime, 100.0 * (total - total_anytime) / total)
+
+def bench_parallel(num_vms=14, num_hosts=5, trials=8, processes=None):
+    """Compares the time taken to try every alternative first move
+    sequentially (with VMPoolAnytimeAdamPathFinder) and in parallel
+    across a pool of worker processes, on some random pools.
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    print "%d worker processes" % processes
+    rng = random.Random(42)
+    total, total_parallel = 0, 0
+    for trial in xrange(trials):
+        initial, final = random_migration(num_vms, num_hosts, rng)
+        anytime = VMPoolAnytimeAdamPathFinder(initial, final, debug_level=0)
+        anytime.time_limit = float('inf')
+        path, seconds = timed(anytime.find_path)
+        parallel = VMPoolParallelAdamPathFinder(initial, final, debug_level=0)
+        parallel.processes = processes
+        parallel_path, parallel_seconds = timed(parallel.find_path)
+        assert (path and path.cost) == (parallel_path and parallel_path.cost)
+        total += seconds
+        total_parallel += parallel_seconds
+        print "trial %2d: %2d alternatives; sequential %.3fs, " \
+              "parallel %.3fs" % \
+              (trial, parallel.alternatives_tried, seconds, parallel_seconds)
+    print "total: sequential %.3fs, parallel %.3fs (%.1fx speed-up)" % \
+          (total, total_parallel, total / total_parallel)
+
+def bench_cost_model(cases=('swap_with_one_temp', 'complex_swap',
+                             'complex_pair_swap', 'shutdown_and_swap',
+                             'tricky', 'weird', 'circles'),
+                     trials=4):
+    """Compares the estimated total duration of the migrations on the
+    paths which A* finds when minimising the RAM migrated with that on
+    the paths it finds when minimising the estimated duration of each
+    live migration, on some of the fixed test cases with random NIC
+    bandwidths and dirty page rates.  The makespan of each path when
+    performed in waves is also shown, although that is not what is
+    minimised.
+    """
+    rng = random.Random(42)
+    live = LiveMigrationCostModel()
+    total_ram, total_live = 0, 0
+    for case_name in cases:
+        for trial in xrange(trials):
+            VM.reset()
+            VMhost.reset()
+            stateA, stateB, expected_path = \
+                getattr(testcases.fixed, 'case_' + case_name)()
+            initial = VMPoolState().init_by_vmhosts(stateA)
+            final = VMPoolState().init_by_vmhosts(stateB)
+            for vmhost_name in sorted(VMhost.vmhosts.keys()):
+                VMhost.vmhosts[vmhost_name].bandwidth = \
+                    rng.choice((125.0, 1250.0))
+            for vm_name in sorted(VM.vms.keys()):
+                VM.vms[vm_name].dirty_rate = rng.choice((0.0, 20.0, 100.0))
+            live.clear()
+            live.precompute()
+
+            durations = [ ]
+            for cost_model in (CostModel(), live):
+                VMmigration.set_cost_model(cost_model)
+                path = VMPoolAStarPathFinder(initial, final,
+                                             debug_level=0).find_path()
+                VMmigration.set_cost_model(live)
+                WaveScheduler(1, 1).schedule(path)
+                durations.append(sum([ migration.cost() for migration
+                                       in path.migration_sequence ]))
+                durations.append(path.makespan())
+            VMmigration.set_cost_model(CostModel())
+            total_ram += durations[0]
+            total_live += durations[2]
+            print "%-18s %d: minimising RAM %6dms (makespan %6dms), " \
+                  "minimising duration %6dms (makespan %6dms)" % \
+                  tuple([ case_name, trial ] + durations)
+    print "total duration %dms minimising RAM, %dms minimising duration " \
+          "(%.1f%% less)" % (total_ram, total_live,
+                             100.0 * (total_ram - total_live) / total_ram)
+
+def bench_candidate_order(num_hosts=10, max_vms=30, trials=100):
+    """Compares the cost of the paths found by the Adam path finder,
+    and the time taken to find them, when displacement candidates are
+    tried in the order they are found and in order of cost and fit,
+    on the same random pools as the soak test.  This is done both
+    with the default cost model, under which cost is just RAM, and
+    with LiveMigrationCostModel and random NIC bandwidths and dirty
+    page rates.
+    """
+    for cost_model in (CostModel(), LiveMigrationCostModel()):
+        totals = { }
+        for best_fit in (False, True):
+            cost, seconds, solved = 0, 0.0, 0
+            for trial in xrange(trials):
+                random.seed(trial)
+                stateA, stateB, expected_path = \
+                    testcases.random.identical_hosts(num_hosts, max_vms)
+                if isinstance(cost_model, LiveMigrationCostModel):
+                    rng = random.Random(trial)
+                    for vmhost_name in sorted(VMhost.vmhosts.keys()):
+                        VMhost.vmhosts[vmhost_name].bandwidth = \
+                            rng.choice((125.0, 1250.0))
+                    for vm_name in sorted(VM.vms.keys()):
+                        VM.vms[vm_name].dirty_rate = \
+                            rng.choice((0.0, 20.0, 100.0))
+                    cost_model.clear()
+                VMmigration.set_cost_model(cost_model)
+                finder = VMPoolAdamPathFinder(stateA, stateB, debug_level=0)
+                finder.best_fit_candidates = best_fit
+                path, elapsed = timed(finder.find_path)
+                seconds += elapsed
+                if path is not None:
+                    cost += path.cost
+                    solved += 1
+            totals[best_fit] = cost
+            print "%-22s %-12s %d solved, total cost %d in %.3fs" % \
+                  (cost_model.__class__.__name__,
+                   'best fit' if best_fit else 'found order',
+                   solved, cost, seconds)
+        print "%-22s best fit changes the total cost by %+.2f%%" % \
+              (cost_model.__class__.__name__,
+               100.0 * (totals[True] - totals[False]) / totals[False])
+    VMmigration.set_cost_model(CostModel())
+
+def bench_compression(lengths=(1000, 10000, 100000)):
+    """Measures how PathCompressor scales on long paths in which
+    every VM is moved via a temporary VM host, and a third of them end
+    up back where they started.
+    """
+    rng = random.Random(42)
+    for length in lengths:
+        VM.reset()
+        VMhost.reset()
+        num_hosts = length // 10
+        vmhosts = testcases.utils.create_vmhosts(num_hosts, 'x86_64',
+                                                 60 * 256 + 256)
+        vms = testcases.utils.create_vms(length, 'x86_64', 256)
+        initial, final = VMPoolState(), VMPoolState()
+        for vmhost in vmhosts:
+            initial.init_vmhost(vmhost.name)
+            final.init_vmhost(vmhost.name)
+        first_hops, second_hops = [ ], [ ]
+        for i, vm in enumerate(vms):
+            home = vmhosts[i % num_hosts]
+            temp = rng.choice(vmhosts)
+            while temp is home:
+                temp = rng.choice(vmhosts)
+            dest = home if i % 3 == 0 else rng.choice(vmhosts)
+            while dest is temp:
+                dest = rng.choice(vmhosts)
+            initial.add_vm(vm.name, home.name)
+            final.add_vm(vm.name, dest.name)
+            first_hops.append(VMmigration(vm, home, temp))
+            second_hops.append(VMmigration(vm, temp, dest))
+        rng.shuffle(first_hops)
+        rng.shuffle(second_hops)
+
+        path = VMPoolPath(initial, final)
+        path.compare_endpoints()
+        path.set_migration_sequence(first_hops + second_hops)
+        compressor = PathCompressor()
+        path, seconds = timed(compressor.compress, path)
+        print "%6d migrations: %6d removed in %d passes, %7.3fs, " \
+              "%5.1fus/migration" % \
+              (2 * length, compressor.migrations_removed, compressor.passes,
+               seconds, 1e6 * seconds / (2 * length))
+
+def bench_improvement(num_hosts=10, max_vms=30, trials=10, time_limit=2.0):
+    """Compares the cost of the paths found by the Adam path finder on
+    some of the soak test's random pools with their cost after
+    PathCompressor and after PathImprover, and with a lower bound:
+    the total RAM of the VMs which need to move.
+    """
+    totals = [ 0, 0, 0, 0 ]
+    for trial in xrange(trials):
+        random.seed(trial)
+        initial, final, expected_path = \
+            testcases.random.identical_hosts(num_hosts, max_vms)
+        path = VMPoolAdamPathFinder(initial, final, debug_level=0).find_path()
+        if path is None:
+            print "trial %2d: no path" % trial
+            continue
+        costs = [ path.cost ]
+        costs.append(PathCompressor().compress(path).cost)
+        improver = PathImprover(time_limit=time_limit)
+        path, seconds = timed(improver.improve, path)
+        costs.append(path.cost)
+        costs.append(sum([ VM.vms[vm_name].ram
+                           for vm_name in path.vms_to_migrate ]))
+        for i, cost in enumerate(costs):
+            totals[i] += cost
+        print "trial %2d: cost %6d, compressed %6d, improved %6d " \
+              "in %.2fs (%d/%d windows improved), lower bound %6d" % \
+              (trial, costs[0], costs[1], costs[2], seconds,
+               improver.windows_improved, improver.windows_tried, costs[3])
+    print "total cost %d, compressed %d, improved %d, lower bound %d" % \
+          tuple(totals)
+
+if __name__ == '__main__':
+    names = sys.argv[1:]
+    if not names:
+        names = sorted([ name[6:] for name in globals().keys()
+                        if name.startswith('bench_') ])
+    for name in names:
+        print "== %s" % name
+        globals()['bench_' + name]()
@@ -0,0 +1,179 @@
+#!/usr/bin/python
+
+from dijkstra import VMPoolShortestPathFinder
+from pqueue import PriorityQueue
+from vmmigration import VMmigration
+
+class SearchFrontier:
+    """The nodes discovered by one direction of a bidirectional
+    search, together with their distances from that direction's
+    origin, and the links back along the shortest known path towards
+    the origin.
+    """
+
+    def __init__(self, name, origin):
+        self.name = name
+        self.todo = PriorityQueue()
+        self.todo[origin] = 0
+        self.done = { }
+        self.distances = { origin : 0 }
+        # Mapping from each node to the adjacent node on the shortest
+        # known path back towards the origin ...
+        self.links = { }
+        # ... and to the migration between the two, in the direction
+        # of travel from the initial state to the final state.
+        self.route = { }
+
+class VMPoolBidirectionalPathFinder(VMPoolShortestPathFinder):
+    """Bidirectional variant of VMPoolShortestPathFinder.  One
+    frontier grows forwards from the state after the initial
+    shutdowns, and the other grows backwards from the state before
+    the final provisions, until they meet in the middle.  Since each
+    frontier only needs to reach roughly half way, this expands
+    dramatically fewer nodes than a single search of the whole path
+    when the branching factor is high.
+
+    Searching backwards relies on every sane migration between two
+    states having a sane counterpart in the opposite direction, which
+    is true because sanity is a property of states, not transitions.
+    The cost of each edge is still that of the forwards migration.
+
+    N.B. Instances should not be reused for multiple runs.
+    """
+
+    def init(self):
+        self.forward = SearchFrontier('forward',
+                                      self.path.state_post_initial_shutdowns)
+        self.backward = SearchFrontier('backward',
+                                       self.path.state_pre_final_provisions)
+
+        # Cost of the cheapest complete path found so far, and the
+        # node at which its two halves meet.
+        self.best_cost = None
+        self.meeting_point = None
+
+        self.nodes_expanded = 0
+
+    def run(self):
+        forward, backward = self.forward, self.backward
+        start = self.path.state_post_initial_shutdowns
+        if start == self.path.state_pre_final_provisions:
+            self.meeting_point = start
+            self.best_cost = 0
+
+        while forward.todo and backward.todo:
+            reason = self.should_give_up()
+            if reason is not None:
+                # A path which hasn't been proven cheapest yet is
+                # still the best progress made.
+                if self.meeting_point is not None:
+                    self.give_up(reason, self.trace_path())
+                else:
+                    self.give_up(reason,
+                                 self.trace_forward(self.best_partial()))
+                return None
+
+            forward_top = forward.todo.peek()[1]
+            backward_top = backward.todo.peek()[1]
+
+            # Any path through a node which neither side has expanded
+            # yet must cost at least this much, so once that's no
+            # better than the best path found, we're done.
+            if self.best_cost is not None and \
+               forward_top + backward_top >= self.best_cost:
+                break
+
+            # Expand the cheaper side, which keeps the two frontiers
+            # at roughly the same radius.
+            if forward_top <= backward_top:
+                self.expand(forward, backward)
+            else:
+                self.expand(backward, forward)
+
+        self.debug(1, "forward:  todo %d, done %d",
+                   len(forward.todo), len(forward.done))
+        self.debug(1, "backward: todo %d, done %d",
+                   len(backward.todo), len(backward.done))
+        self.debug(1, "nodes expanded: %d", self.nodes_expanded)
+
+        if self.meeting_point is None:
+            return None
+
+        self.found = True
+        return self.trace_path()
+
+    def states_resident(self):
+        return len(self.forward.distances) + len(self.backward.distances)
+
+    def best_partial(self):
+        """Returns the node discovered by the forward search with the
+        most VMs on their final VM host, and of those, the one with
+        the shortest path.
+        """
+        distances = self.forward.distances
+        return max(distances.iterkeys(),
+                   key=lambda state: (self.vms_placed(state),
+                                      -distances[state]))
+
+    def expand(self, frontier, other):
+        current_state, distance = frontier.todo.shift()
+        self.debug(2, "%s: current_state: %s", frontier.name, current_state)
+
+        for vm, to_host in current_state.feasible_migrations():
+            from_host = current_state.get_vm_vmhost(vm)
+            if frontier is self.forward:
+                migration = VMmigration(vm, from_host, to_host)
+            else:
+                # The neighbour is a predecessor, from which the
+                # forwards migration brings the VM back here.
+                migration = VMmigration(vm, to_host, from_host)
+
+            new_state = current_state.migrate(vm, to_host)
+            if new_state in frontier.done:
+                continue
+
+            alt = distance + migration.cost()
+            if new_state in frontier.distances and \
+               alt >= frontier.distances[new_state]:
+                continue
+
+            self.debug(3, "    %s: %s (total %d)",
+                       frontier.name, migration, alt)
+            frontier.distances[new_state] = alt
+            frontier.links[new_state] = current_state
+            frontier.route[new_state] = migration
+            frontier.todo[new_state] = alt
+
+            if new_state in other.distances:
+                total = alt + other.distances[new_state]
+                if self.best_cost is None or total < self.best_cost:
+                    self.debug(2, "    frontiers meet at %s (total %d)",
+                               new_state, total)
+                    self.best_cost = total
+                    self.meeting_point = new_state
+
+        frontier.done[current_state] = True
+        self.nodes_expanded += 1
+
+    def trace_forward(self, node):
+        """Returns the migrations from the start to the given node
+        discovered by the forward search.
+        """
+        migration_sequence = [ ]
+        cur = node
+        while cur in self.forward.links:
+            migration_sequence.insert(0, self.forward.route[cur])
+            cur = self.forward.links[cur]
+        return migration_sequence
+
+    def trace_path(self):
+        # Trace back from the meeting point to the start ...
+        migration_sequence = self.trace_forward(self.meeting_point)
+
+        # ... and then on from the meeting point to the end.
+        cur = self.meeting_point
+        while cur in self.backward.links:
+            migration_sequence.append(self.backward.route[cur])
+            cur = self.backward.links[cur]
+
+        return migration_sequence
@@ -0,0 +1,168 @@
+#!/usr/bin/python
+
+import bisect
+
+from rangemin import RangeMinTree
+from vmmigration import VMmigration
+
+class PathCompressor:
+    """Removes redundant migrations from the sequence of a VMPoolPath,
+    such as path finders (VMPoolAdamPathFinder in particular) tend to
+    produce when they move a VM out of the way temporarily.  For each
+    pair of consecutive migrations of the same VM, A -> B and later
+    B -> C:
+
+    - if C is A, the VM went away and came back, so both migrations
+      are dropped
+    - otherwise, the pair is replaced by a single migration A -> C,
+      either where the second one was, or failing that where the
+      first one was
+
+    as long as the VM host the VM now stays on in the meantime has
+    enough free RAM for it at every step in between.  Nothing else
+    can make the pool insane, since the only other VM host affected
+    gains free RAM.
+
+    Each pass over the sequence considers every such pair once, and
+    passes are repeated until one makes no change.  To avoid
+    replaying the sequence for every check, each pass tracks the free
+    RAM of each VM host after every step which affects it in a
+    RangeMinTree, so that each check and the corresponding update
+    take O(log n) time.  Steps where a VM host isn't affected don't
+    have their own entries, so updates involving such steps are
+    applied conservatively, i.e. so as to underestimate free RAM;
+    the next pass starts afresh.
+    """
+
+    def __init__(self):
+        self.migrations_removed = 0
+        self.passes = 0
+
+    def compress(self, path):
+        """Compresses the migration sequence of the given path in
+        place, and updates its cost.  Any waves scheduled for the
+        path are discarded.  Returns the path.
+        """
+        sequence = list(path.migration_sequence)
+        while True:
+            self.passes += 1
+            removed = self._pass(path.state_post_initial_shutdowns, sequence)
+            if not removed:
+                break
+            self.migrations_removed += removed
+            sequence = [ migration for migration in sequence
+                         if migration is not None ]
+
+        path.set_migration_sequence(sequence)
+        path.set_cost(sum([ migration.cost() for migration in sequence ]))
+        path.set_waves(None)
+        return path
+
+    def _pass(self, state, sequence):
+        """Makes a single pass over the sequence, replacing removed
+        migrations with None, and returns how many were removed.
+        """
+        self._index(state, sequence)
+
+        # Indices of the migrations of each VM which are still in the
+        # sequence, in the order the VMs first appear.
+        moves = { }
+        vm_names = [ ]
+        for i, migration in enumerate(sequence):
+            vm_name = migration.vm.name
+            if vm_name not in moves:
+                moves[vm_name] = [ ]
+                vm_names.append(vm_name)
+            moves[vm_name].append(i)
+
+        removed = 0
+        for vm_name in vm_names:
+            # Stack of the indices of the VM's migrations which have
+            # been kept so far, so that when a round trip is dropped,
+            # the migration before it can be paired with the one
+            # after it.
+            kept = [ ]
+            for j in moves[vm_name]:
+                if not kept:
+                    kept.append(j)
+                    continue
+                i = kept[-1]
+                first, second = sequence[i], sequence[j]
+                vm = first.vm
+                from_host, via_host, to_host = \
+                    first.from_host, first.to_host, second.to_host
+                if to_host is from_host:
+                    if self._fits(from_host, vm, i, j):
+                        self._move(from_host, via_host, vm, i, j)
+                        sequence[i] = sequence[j] = None
+                        kept.pop()
+                        removed += 2
+                        continue
+                elif self._fits(from_host, vm, i, j):
+                    self._move(from_host, via_host, vm, i, j)
+                    sequence[i] = None
+                    sequence[j] = VMmigration(vm, from_host, to_host)
+                    kept[-1] = j
+                    removed += 1
+                    continue
+                elif self._fits(to_host, vm, i, j):
+                    self._move(to_host, via_host, vm, i, j)
+                    sequence[i] = VMmigration(vm, from_host, to_host)
+                    sequence[j] = None
+                    removed += 1
+                    continue
+                kept.append(j)
+        return removed
+
+    def _index(self, state, sequence):
+        """Builds a RangeMinTree for each VM host of its free RAM
+        after each step of the sequence which affects it.  The
+        indices of those steps are kept in self._steps, starting with
+        -1 for the start of the sequence.
+        """
+        free_RAM = dict([ (vmhost_name, state.free_RAM(vmhost_name))
+                          for vmhost_name in state.vmhost_names() ])
+        self._steps = dict([ (vmhost_name, [ -1 ])
+                             for vmhost_name in free_RAM ])
+        values = dict([ (vmhost_name, [ free_RAM[vmhost_name] ])
+                        for vmhost_name in free_RAM ])
+        for i, migration in enumerate(sequence):
+            ram = migration.vm.ram
+            for vmhost_name, delta in ((migration.from_host.name, ram),
+                                       (migration.to_host.name, -ram)):
+                free_RAM[vmhost_name] += delta
+                self._steps[vmhost_name].append(i)
+                values[vmhost_name].append(free_RAM[vmhost_name])
+        self._trees = dict([ (vmhost_name, RangeMinTree(values[vmhost_name]))
+                             for vmhost_name in values ])
+
+    def _span(self, vmhost, i, j, inner=False):
+        """Returns the range of entries in the tree of the given VM
+        host covering steps i to j - 1 inclusive.  Unless inner is
+        true, this starts with the entry for step i or the last one
+        before it, and so may also cover earlier steps; otherwise it
+        starts with the first entry after step i, and so may not
+        cover all of step i to the next entry.
+        """
+        steps = self._steps[vmhost.name]
+        if inner:
+            lo = bisect.bisect_left(steps, i)
+        else:
+            lo = bisect.bisect_right(steps, i) - 1
+        return lo, bisect.bisect_left(steps, j)
+
+    def _fits(self, vmhost, vm, i, j):
+        """Returns True if the VM host has enough free RAM for the VM
+        from step i to step j - 1 inclusive.
+        """
+        lo, hi = self._span(vmhost, i, j)
+        return self._trees[vmhost.name].min(lo, hi) >= vm.ram
+
+    def _move(self, to_host, from_host, vm, i, j):
+        """Records that the VM is on to_host rather than from_host
+        from step i to step j - 1 inclusive.
+        """
+        lo, hi = self._span(to_host, i, j)
+        self._trees[to_host.name].add(lo, hi, -vm.ram)
+        lo, hi = self._span(from_host, i, j, inner=True)
+        self._trees[from_host.name].add(lo, hi, vm.ram)
@@ -0,0 +1,154 @@
+#!/usr/bin/python
+
+from vm import VM
+from vmhost import VMhost
+
+class CostModel:
+    """Determines the cost of each migration, which is what the path
+    finders minimise, and estimates how long a set of migrations takes
+    when scheduled in concurrent waves (see WaveScheduler).
+
+    This base class charges each migration the RAM of the VM being
+    migrated, i.e. the path finders minimise the total amount of RAM
+    moved, and assumes that migrations take time proportional to
+    their cost regardless of how many run at once.
+
+    Subclasses must ensure that lower_bound() never exceeds the cost
+    of migrating the VM to or from the given VM host, so that the
+    heuristic of VMPoolAStarPathFinder stays admissible and
+    consistent.
+    """
+
+    # Whether cost() and lower_bound() are just the RAM of the VM, in
+    # which case ordering displacement candidates by cost gains
+    # nothing (see VMPoolAdamPathFinder.best_fit_candidates).
+    ram_only = True
+
+    def cost(self, vm, from_host, to_host):
+        return vm.ram
+
+    def lower_bound(self, vm, vmhost):
+        """Returns a lower bound on the cost of migrating the given VM
+        to or from the given VM host.
+        """
+        return vm.ram
+
+    def wave_duration(self, wave):
+        """Returns how long the given list of migrations takes when
+        they are all performed concurrently, in the same units as
+        cost().
+        """
+        return max([ migration.cost() for migration in wave ])
+
+    def makespan(self, waves):
+        """Returns how long the given waves of migrations take when
+        performed one after the other.
+        """
+        return sum([ self.wave_duration(wave) for wave in waves ])
+
+class LiveMigrationCostModel(CostModel):
+    """Charges each migration the number of milliseconds which a
+    pre-copy live migration is estimated to take.  Guest RAM is copied
+    across in rounds while the VM keeps running, and each round
+    re-sends the pages dirtied during the previous one, until few
+    enough remain to pause the VM and copy the rest.  VMs which dirty
+    pages faster than they can be sent never converge, and are paused
+    after max_rounds rounds.
+
+    The link between two VM hosts runs at the bandwidth (in MB/s) of
+    the slower of their NICs, and the NIC of a VM host is shared
+    equally between its concurrent inbound migrations, and likewise
+    between its outbound ones.  VMs and VM hosts which don't specify
+    their dirty_rate (in MB/s) or bandwidth get the defaults below.
+
+    Since the cost only depends on the VM and the bandwidth, costs
+    are cached in a table keyed by those, which precompute() can fill
+    in advance for the current inventory.  The table is keyed by VM
+    name, so clear() must be called if VMs are re-created or their
+    dirty_rate changes.
+    """
+
+    ram_only = False
+
+    default_bandwidth = 125.0     # 1Gb/s
+    default_dirty_rate = 0.0
+    stop_copy_threshold = 64.0    # MB
+    max_rounds = 30
+
+    def __init__(self):
+        self._table = { }
+
+    def clear(self):
+        """Empties the cost table."""
+        self._table = { }
+
+    def bandwidth(self, vmhost):
+        if vmhost.bandwidth is None:
+            return self.default_bandwidth
+        return float(vmhost.bandwidth)
+
+    def dirty_rate(self, vm):
+        if vm.dirty_rate is None:
+            return self.default_dirty_rate
+        return float(vm.dirty_rate)
+
+    def duration(self, vm, bandwidth):
+        """Returns the estimated time in milliseconds to live migrate
+        the given VM over a link of the given bandwidth.
+        """
+        dirty_rate = self.dirty_rate(vm)
+        remaining = float(vm.ram)
+        transferred = 0.0
+        for i in xrange(self.max_rounds):
+            if remaining <= self.stop_copy_threshold:
+                break
+            transferred += remaining
+            remaining = min(vm.ram, dirty_rate * remaining / bandwidth)
+        # Final stop-and-copy round.
+        transferred += remaining
+        return int(round(1000 * transferred / bandwidth))
+
+    def _cost(self, vm, bandwidth):
+        key = (vm.name, bandwidth)
+        cost = self._table.get(key)
+        if cost is None:
+            cost = self._table[key] = self.duration(vm, bandwidth)
+        return cost
+
+    def cost(self, vm, from_host, to_host):
+        return self._cost(vm, min(self.bandwidth(from_host),
+                                  self.bandwidth(to_host)))
+
+    def lower_bound(self, vm, vmhost):
+        # The link to or from the VM host can't be any faster than
+        # its NIC.
+        return self._cost(vm, self.bandwidth(vmhost))
+
+    def precompute(self):
+        """Empties the cost table and fills it afresh for every VM at
+        the bandwidth of every VM host.
+        """
+        self.clear()
+        bandwidths = set([ self.bandwidth(vmhost)
+                           for vmhost in VMhost.vmhosts.itervalues() ])
+        for vm in VM.vms.itervalues():
+            for bandwidth in bandwidths:
+                self._cost(vm, bandwidth)
+
+    def wave_duration(self, wave):
+        inbound, outbound = { }, { }
+        for migration in wave:
+            to_host_name = migration.to_host.name
+            from_host_name = migration.from_host.name
+            inbound[to_host_name] = inbound.get(to_host_name, 0) + 1
+            outbound[from_host_name] = outbound.get(from_host_name, 0) + 1
+
+        duration = 0
+        for migration in wave:
+            bandwidth = min(
+                self.bandwidth(migration.from_host) /
+                    float(outbound[migration.from_host.name]),
+                self.bandwidth(migration.to_host) /
+                    float(inbound[migration.to_host.name]))
+            duration = max(duration, self.duration(migration.vm, bandwidth))
+        return duration
@@ -0,0 +1,111 @@
+#!/usr/bin/python
+
+from collections import deque
+import gzip
+import os
+import Queue
+import tempfile
+import threading
+
+import unittest
+
+class DebugLog:
+    """Bounded log of the debugging messages emitted by a path
+    finder.  Only the most recent max_messages messages are retained
+    in memory, so that long searches can't exhaust it, and appending
+    is O(1) regardless of how much has been logged.
+
+    If a filename is given, every message is additionally streamed to
+    that file, gzip-compressed, by a background thread, so that the
+    full log can still be inspected afterwards without the search
+    having to wait for the disk.  close() must be called to flush the
+    file.
+    """
+
+    def __init__(self, max_messages=10000, filename=None):
+        self.messages = deque(maxlen=max_messages)
+        self._writer = None
+        if filename is not None:
+            self._writer = DebugLogWriter(filename)
+
+    def append(self, message):
+        self.messages.append(message)
+        if self._writer is not None:
+            self._writer.write(message)
+
+    def tail(self):
+        """Returns the retained messages as a single string, one per
+        line.
+        """
+        return ''.join([ message + "\n" for message in self.messages ])
+
+    def __len__(self):
+        return len(self.messages)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+class DebugLogWriter(threading.Thread):
+    """Background thread which writes messages from a queue to a
+    gzip-compressed file until closed.
+    """
+
+    # Placeholder for the end of the queue.
+    _EOF = object()
+
+    def __init__(self, filename):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.filename = filename
+        self.queue = Queue.Queue()
+        self.start()
+
+    def write(self, message):
+        self.queue.put(message)
+
+    def run(self):
+        out = gzip.open(self.filename, 'wb')
+        try:
+            while True:
+                message = self.queue.get()
+                if message is self._EOF:
+                    break
+                out.write(message + "\n")
+        finally:
+            out.close()
+
+    def close(self):
+        self.queue.put(self._EOF)
+        self.join()
+
+class DebugLogTestCase(unittest.TestCase):
+    def testBounded(self):
+        log = DebugLog(max_messages=3)
+        for i in xrange(5):
+            log.append("message %d" % i)
+        self.assertEqual(len(log), 3)
+        self.assertEqual(log.tail(), "message 2\nmessage 3\nmessage 4\n")
+
+    def testSpill(self):
+        fd, filename = tempfile.mkstemp(suffix='.gz')
+        os.close(fd)
+        try:
+            log = DebugLog(max_messages=2, filename=filename)
+            for i in xrange(5):
+                log.append("message %d\n  continued" % i)
+            log.close()
+            self.assertEqual(log.tail(),
+                             "message 3\n  continued\n"
+                             "message 4\n  continued\n")
+            f = gzip.open(filename, 'rb')
+            self.assertEqual(f.read(),
+                             ''.join([ "message %d\n  continued\n" % i
+                                       for i in xrange(5) ]))
+            f.close()
+        finally:
+            os.unlink(filename)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,6 @@
 #!/usr/bin/python
 
-from vodict import ValueOrderedDictionary
-from vmpoolstateerrors import VMPoolStateSanityError
+from pqueue import PriorityQueue
 from pathfinder import VMPoolPathFinder
 from vmmigration import VMmigration
 from vmpoolpath import VMPoolPath
@@ -54,18 +53,52 @@ class VMPoolShortestPathFinder(VMPoolPathFinder):
     #     // u is now "explored"
     #     move u from T to D
 
+    # Migrations between disjoint pairs of VM hosts commute (see
+    # VMmigration.commutes_with()), so without any reduction the search
+    # reaches the same state via every interleaving of them.  To avoid
+    # this, only the interleaving in which each adjacent pair of
+    # commuting migrations is ordered by VM name is explored.  Any path
+    # can be rearranged into that canonical order by repeatedly
+    # swapping adjacent out-of-order pairs, without changing its cost
+    # or end state, so optimality is preserved.
+    #
+    # This reduces the number of migrations explored rather than the
+    # number of states, since every state is still reachable via its
+    # canonical interleaving.  With few VM hosts, few pairs of
+    # migrations commute, so the bookkeeping usually costs more than
+    # it saves (see bench.py), hence it is off by default.
+    reduce_commuting_migrations = False
+
+    # Names of the only VMs which may be migrated, or None for any VM.
+    # Restricting the search like this means the path found is only
+    # the cheapest of those which leave all other VMs in place.
+    movable_vms = None
+
     def init(self):
         initial_cost = 0
 
-        # Nodes which still need to be explored, sorted by distance ascending.
-        self.todo = ValueOrderedDictionary()
-        self.todo[self.path.initial_state.unique()] = initial_cost
+        # Shutdowns all happen before any migrations, so that's where
+        # the search starts from.
+        start = self.path.state_post_initial_shutdowns
 
-        # Nodes which have already been fully explored.
-        self.done = { }
+        # Nodes are keyed by the pool state objects themselves, which
+        # hash and compare cheaply via their incremental hash.  This
+        # relies on the VMPoolState instances remaining unchanged
+        # after being used as keys, which holds since states are
+        # constructed during neighbour exploration and not
+        # subsequently altered.
 
         # Distances for all nodes (both todo and done)
-        self.distances = { self.path.initial_state.unique() : initial_cost }
+        self.distances = { start : initial_cost }
+
+        # Nodes which still need to be explored, sorted by priority
+        # ascending.  For plain Dijkstra the priority is simply the
+        # distance; see priority().
+        self.todo = PriorityQueue()
+        self.todo[start] = self.priority(start, None, None)
+
+        # Nodes which have already been fully explored.
+        self.done = { }
 
         # Mapping from any node in shortest path to its previous node
         self.previous = { }
@@ -74,29 +107,73 @@ class VMPoolShortestPathFinder(VMPoolPathFinder):
         # which gets there from the previous node.
         self.route = { }
 
-        self._state_cache = { }
-        self.cache_state(self.path.initial_state)
-        self.cache_state(self.path.final_state)
+        # Mapping from each node to the final migrations of all the
+        # optimal paths to it found so far.  These determine which
+        # onward migrations are redundant; see prune_migration().
+        self.last_migrations = { start : [ ] }
+
+        # Mapping from each explored node which has to be explored
+        # again to its final migrations as they were when it was
+        # first explored; see explore_neighbours().
+        self.reopened = { }
+
+        # Number of nodes which have been fully explored, and the one
+        # currently being explored.
+        self.nodes_expanded = 0
+        self.current_state = start
+
+    def priority(self, state, previous_state, migration):
+        """Returns the priority with which the given state should be
+        explored, lowest first.  previous_state and migration are
+        the node and edge via which the current shortest path reaches
+        state (or None for the start node), which allows subclasses
+        to calculate the priority incrementally.
+        """
+        return self.distances[state]
+
+    def nodes_searched(self):
+        return self.nodes_expanded
+
+    def states_resident(self):
+        return len(self.distances)
+
+    def current_depth(self):
+        depth = 0
+        cur = self.previous.get(self.current_state)
+        while cur is not None:
+            depth += 1
+            cur = self.previous.get(cur)
+        return depth
+
+    def vms_remaining(self):
+        return self.vms_misplaced(self.current_state)
 
     def run(self):
-        self.end = self.path.state_pre_final_provisions.unique()
+        self.end = self.path.state_pre_final_provisions
         while len(self.todo) > 0:
-            print "todo list:"
-            for s in self.todo:
-                print "  %2d: %s" % (self.distances[s], s)
-            current, dist = self.todo.shift()
-            if current == self.end:
+            reason = self.should_give_up()
+            if reason is not None:
+                self.give_up(reason, self.trace_path(self.best_partial()))
+                return None
+            if self._debug_level >= 3:
+                self.debug(3, "todo list:")
+                for s in self.todo:
+                    self.debug(3, "  %2d: %s", self.todo[s], s)
+            current_state, priority = self.todo.shift()
+            self.current_state = current_state
+            if current_state == self.end:
                 self.found = True
                 break
-            current_state = self.cache_lookup(current)
-            print "current_state:", current_state
+            self.debug(2, "current_state: %s", current_state)
             self.explore_neighbours(current_state)
 
-            print "    < marking as done:", current_state
-            self.done[current] = True
+            self.debug(3, "    < marking as done: %s", current_state)
+            self.done[current_state] = True
+            self.nodes_expanded += 1
 
-        print "todo list size:", len(self.todo)
-        print "done list size:", len(self.done)
+        self.debug(1, "todo list size: %d", len(self.todo))
+        self.debug(1, "done list size: %d", len(self.done))
+        self.debug(1, "nodes expanded: %d", self.nodes_expanded)
 
         if self.found:
             return self.trace_path()
@@ -114,73 +191,126 @@ class VMPoolShortestPathFinder(VMPoolPathFinder):
         unmigrated_vms = [ ]
         assert current_state
         for vm in current_state.vm_names():
+            if self.movable_vms is not None and vm not in self.movable_vms:
+                continue
             if vm in self.path.vms_to_migrate:
                 migrated_vms.append(vm)
             else:
                 unmigrated_vms.append(vm)
 
-        for vm in migrated_vms + unmigrated_vms:
-            from_host = current_state.get_vm_vmhost(vm)
-            print "  examining %s, currently on %s" % (vm, from_host)
+        # Only sane migrations are returned, so there's no need to
+        # construct and sanity check the state for each candidate.
+        feasible = \
+            current_state.feasible_migrations(migrated_vms + unmigrated_vms)
 
-            for to_host in current_state.vmhost2vms:
-                if from_host == to_host:
-                    continue
+        # If the node is being explored again, only migrations which
+        # were redundant the first time round need exploring now.
+        previous_last_migrations = self.reopened.pop(current_state, None)
 
-                new_state = current_state.migrate(vm, to_host)
-                migration = VMmigration(vm, from_host, to_host)
-                print "    %s" % migration
-                try:
-                    new_state.check_sane()
-                except VMPoolStateSanityError, e:
-                    print "    . new state %s not sane:" % new_state
-                    print "      %s" % e
-                    continue
+        for vm, to_host in feasible:
+            from_host = current_state.get_vm_vmhost(vm)
+            migration = VMmigration(vm, from_host, to_host)
+            self.debug(3, "    %s", migration)
 
-                if new_state.unique() in self.done:
-                    print "    . already done:", new_state
+            if self.reduce_commuting_migrations:
+                if self.prune_migration(current_state, migration):
+                    self.debug(3, "    . redundant interleaving")
+                    continue
+                if previous_last_migrations is not None and \
+                   not self._redundant_after(previous_last_migrations,
+                                             migration):
+                    self.debug(3, "    . already explored")
                     continue
 
-                self.cache_state(new_state)
-
-                self.check_migration(migration, current_state, new_state)
-
-                new = new_state.unique()
-                if new not in self.done and new not in self.todo:
-                    self.todo.insert(new, self.distances[new_state.unique()])
+            new_state = current_state.migrate(vm, to_host)
+
+            if new_state in self.done and \
+               not self.reduce_commuting_migrations:
+                self.debug(3, "    . already done: %s", new_state)
+                continue
+
+            if self.check_migration(migration, current_state, new_state):
+                # Either a newly discovered node, or a shorter path to
+                # one already in the todo list (decrease-key).
+                self.todo[new_state] = \
+                    self.priority(new_state, current_state, migration)
+            elif new_state in self.done and self.distances[new_state] == \
+                 self.distances[current_state] + migration.cost():
+                # An equally optimal path to a node which has already
+                # been explored can only be found when priorities tie
+                # (e.g. for A*).  It may make onward migrations from
+                # that node non-redundant, so it needs exploring again.
+                self.debug(3, "    . reopening: %s", new_state)
+                del self.done[new_state]
+                self.reopened[new_state] = \
+                    self.last_migrations[new_state][:-1]
+                self.todo[new_state] = \
+                    self.priority(new_state, current_state, migration)
+
+    def prune_migration(self, current_state, migration):
+        """Returns True if the given migration from current_state is
+        redundant, because on every optimal path to current_state found
+        so far, the final migration commutes with it and should come
+        after it in canonical order.
+        """
+        return self._redundant_after(self.last_migrations[current_state],
+                                     migration)
+
+    def _redundant_after(self, last_migrations, migration):
+        if not last_migrations:
+            return False
+        for last in last_migrations:
+            if migration.vm.name > last.vm.name or \
+               not migration.commutes_with(last):
+                return False
+        return True
 
     def check_migration(self, migration, current_state, new_state):
         """Check whether we've found a quicker way of getting from the
-        initial state to new_state.
+        initial state to new_state, and if so record it and return True.
         """
-        new = new_state.unique()
-        current = current_state.unique()
         cost = migration.cost()
-        alt = self.distances[current] + cost
-        if new not in self.distances or \
-           alt < self.distances[new]:
-            print "    + new shortest path cost %d (total %d)" % (cost, alt)
-            print "    +     to %s" % new
-            self.distances[new] = alt
-            self.previous[new] = current
-            self.route[new] = migration
-            return
-
-        if alt == self.distances[new]:
-            print "    = equally optimal path cost %d (total: %d)" % (cost, alt)
-            print "    =     to %s" % new
+        alt = self.distances[current_state] + cost
+        if new_state not in self.distances or \
+           alt < self.distances[new_state]:
+            self.debug(3, "    + new shortest path cost %d (total %d)",
+                       cost, alt)
+            self.debug(3, "    +     to %s", new_state)
+            self.distances[new_state] = alt
+            self.previous[new_state] = current_state
+            self.route[new_state] = migration
+            self.last_migrations[new_state] = [ migration ]
+            return True
+
+        if alt == self.distances[new_state]:
+            self.debug(3, "    = equally optimal path cost %d (total: %d)",
+                       cost, alt)
+            self.debug(3, "    =     to %s", new_state)
+            self.last_migrations[new_state].append(migration)
         else:
-            print "    - suboptimal path cost %d (total: %d)" % (cost, alt)
-            print "    -     to %s" % new
+            self.debug(3, "    - suboptimal path cost %d (total: %d)",
+                       cost, alt)
+            self.debug(3, "    -     to %s", new_state)
+        return False
+
+    def best_partial(self):
+        """Returns the discovered node with the most VMs on their
+        final VM host, and of those, the one with the shortest path.
+        """
+        return max(self.distances.iterkeys(),
+                   key=lambda state: (self.vms_placed(state),
+                                      -self.distances[state]))
 
-    def trace_path(self):
+    def trace_path(self, end=None):
         # Trace path backwards from end to start
+        if end is None:
+            end = self.end
         migration_sequence = [ ]
 
-        print "route", repr(self.route)
-        print "end", repr(self.end)
+        self.debug(3, "route %r", self.route)
+        self.debug(3, "end %r", end)
 
-        cur = self.end
+        cur = end
         while True:
             migration = self.route.get(cur, None)
             cur = self.previous.get(cur, None)
@@ -189,23 +319,3 @@ class VMPoolShortestPathFinder(VMPoolPathFinder):
             migration_sequence.insert(0, migration)
 
         return migration_sequence
-
-    # Cache objects by unique string.  This allows us to key
-    # todo/done/distances/previous by unique string but still be able
-    # to retrieve the corresponding object.  This is necessary because
-    # multiple pool state objects can potentially represent the same
-    # state.
-    #
-    # Note that this relies on the VMPoolState instances remaining
-    # unchanged after caching.  This should be thread-safe since the
-    # cache is per path finder run (per instance), within which state
-    # instances are constructed during neighbour exploration and not
-    # subsequently altered.
-
-    def cache_state(self, state):
-        if state.unique() not in self._state_cache:
-            self._state_cache[state.unique()] = state
-
-    def cache_lookup(self, state_string):
-        return self._state_cache[state_string]
-        #return self._state_cache.get(state_string, None)
@@ -0,0 +1,21 @@
+#!/usr/bin/python
+
+from astar import VMPoolAStarPathFinder
+
+class VMPoolGreedyPathFinder(VMPoolAStarPathFinder):
+    """Greedy best-first variant of VMPoolAStarPathFinder.  Nodes are
+    explored purely in order of the estimate h of their remaining
+    cost, ignoring the cost g of reaching them, so the search heads
+    straight for the end state, moving VMs to their final hosts
+    wherever possible.
+
+    This typically expands only a handful of nodes per migration
+    on the path, but unlike A* the path found is not necessarily the
+    cheapest one.
+
+    N.B. Instances should not be reused for multiple runs.
+    """
+
+    def priority(self, state, previous_state, migration):
+        VMPoolAStarPathFinder.priority(self, state, previous_state, migration)
+        return self.estimates[state]
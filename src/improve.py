@@ -0,0 +1,174 @@
+#!/usr/bin/python
+
+import time
+
+from compress import PathCompressor
+from astar import VMPoolAStarPathFinder
+from vmhost import VMhost
+from vmmigration import VMmigration
+
+class PathImprover:
+    """Large neighbourhood search which reduces the cost of an existing
+    VMPoolPath, e.g. one found by VMPoolAdamPathFinder on a pool far
+    too big for VMPoolShortestPathFinder to search as a whole.
+
+    After removing any redundant migrations with PathCompressor, it
+    repeatedly takes a window of consecutive migrations from the
+    path, and searches for the cheapest sequence of migrations
+    between the states at either end of the window with finder_class.
+    If that is cheaper than the window, it is spliced into the path in
+    place of the window; since it ends in the same state, the rest of
+    the path is unaffected.
+
+    Windows of min_window migrations are swept across the path,
+    overlapping by half, and the sweep is repeated until it makes no
+    further improvement, at which point the window size is doubled,
+    up to max_window.  This continues until a sweep with the largest
+    window makes no improvement, or time_limit seconds have elapsed.
+    Each window's search is abandoned after max_nodes nodes (None
+    means unlimited), so that windows which are too hard to solve
+    don't use up all the time.  Windows which already cost no more
+    than the cost model's lower bound for getting each VM they move
+    to where it ends up (see CostModel.lower_bound()) can't be
+    improved, so aren't searched.  Unless restrict_to_window is false,
+    the search may only migrate VMs which the window migrates (see
+    VMPoolShortestPathFinder.movable_vms), which makes each search
+    far cheaper on big pools, at the expense of missing improvements
+    which involve moving other VMs.
+
+    Instances can be reused; the counters accumulate across calls to
+    improve().
+    """
+
+    finder_class = VMPoolAStarPathFinder
+    restrict_to_window = True
+
+    def __init__(self, time_limit=10.0, min_window=4, max_window=16,
+                 max_nodes=1000):
+        self.time_limit = time_limit
+        self.min_window = min_window
+        self.max_window = max_window
+        self.max_nodes = max_nodes
+
+        self.windows_tried = 0
+        self.windows_improved = 0
+        self.windows_abandoned = 0
+        self.cost_saved = 0
+
+    def improve(self, path):
+        """Improves the migration sequence of the given path in place,
+        and updates its cost.  Any waves scheduled for the path are
+        discarded.  Returns the path.
+        """
+        deadline = time.time() + self.time_limit
+        cost = path.cost
+        PathCompressor().compress(path)
+
+        sequence = list(path.migration_sequence)
+        states = [ path.state_post_initial_shutdowns ]
+        for migration in sequence:
+            states.append(states[-1].migrate(migration.vm.name,
+                                             migration.to_host.name))
+
+        size = self.min_window
+        while time.time() < deadline:
+            if self._sweep(sequence, states, size, deadline):
+                continue
+            if size >= self.max_window or size >= len(sequence):
+                break
+            size = min(2 * size, self.max_window)
+
+        self._check(path, sequence)
+        path.set_migration_sequence(sequence)
+        path.set_cost(sum([ migration.cost() for migration in sequence ]))
+        path.set_waves(None)
+        self.cost_saved += cost - path.cost
+        return path
+
+    def _check(self, path, sequence):
+        """Replays the improved sequence of migrations to make sure it
+        is sane and still leads to the end of the path.
+        """
+        state = path.state_post_initial_shutdowns
+        for migration in sequence:
+            if state.get_vm_vmhost(migration.vm.name) != \
+               migration.from_host.name:
+                raise RuntimeError, "BUG: %s is not on %s" % \
+                    (migration.vm.name, migration.from_host.name)
+            state = state.check_migration_sane(migration.vm.name,
+                                               migration.to_host)
+        if state != path.state_pre_final_provisions:
+            raise RuntimeError, "BUG: improved path ends in %s" % state
+
+    def _sweep(self, sequence, states, size, deadline):
+        """Sweeps windows of the given size across the sequence, and
+        the corresponding list of the states before and after each
+        migration, splicing in any improvements.  Returns True if any
+        were made.
+        """
+        improved = False
+        start = 0
+        while start < len(sequence) - 1 and time.time() < deadline:
+            end = min(start + size, len(sequence))
+            replacement = self._solve(sequence[start:end],
+                                      states[start], states[end], deadline)
+            if replacement is None:
+                start += max(1, size // 2)
+                continue
+
+            self.windows_improved += 1
+            improved = True
+            sequence[start:end] = replacement
+            # The replacement may be a different length to the window,
+            # or even empty, so recompute the states after each of its
+            # migrations, including the last.
+            window_states = [ ]
+            state = states[start]
+            for migration in replacement:
+                state = state.migrate(migration.vm.name,
+                                      migration.to_host.name)
+                window_states.append(state)
+            states[start + 1:end + 1] = window_states
+            start += max(1, len(replacement))
+        return improved
+
+    def _solve(self, window, start_state, end_state, deadline):
+        """Returns the cheapest sequence of migrations from start_state
+        to end_state if it is cheaper than the given window of
+        migrations between them, or None otherwise.
+        """
+        cost = sum([ migration.cost() for migration in window ])
+        if cost <= self._lower_bound(window, end_state):
+            return None
+
+        self.windows_tried += 1
+        finder = self.finder_class(start_state, end_state, debug_level=0)
+        if self.restrict_to_window:
+            finder.movable_vms = set([ migration.vm.name
+                                       for migration in window ])
+        path = finder.find_path(max_nodes=self.max_nodes, deadline=deadline)
+        if path is None:
+            if finder.status.exhausted():
+                self.windows_abandoned += 1
+            return None
+        if path.cost >= cost:
+            return None
+        return path.migration_sequence
+
+    def _lower_bound(self, window, end_state):
+        """Returns a lower bound on the cost of any sequence of
+        migrations with the same effect as the given window, which
+        ends in end_state.
+        """
+        start = { }
+        for migration in window:
+            start.setdefault(migration.vm.name,
+                             (migration.vm, migration.from_host.name))
+        cost_model = VMmigration.cost_model
+        bound = 0
+        for vm, from_host_name in start.itervalues():
+            to_host_name = end_state.get_vm_vmhost(vm.name)
+            if to_host_name != from_host_name:
+                bound += cost_model.lower_bound(vm,
+                                                VMhost.vmhosts[to_host_name])
+        return bound
@@ -0,0 +1,86 @@
+#!/usr/bin/python
+
+import unittest
+
+from vm import VM
+from vmhost import VMhost
+from vmmigration import VMmigration
+from vmpoolstate import VMPoolState
+
+class InventorySnapshot:
+    """Picklable snapshot of the inventory of VMs and VM hosts (i.e.
+    the VM.vms and VMhost.vmhosts registries, the table of which guest
+    architectures can run on which VM hosts, and the cost model used
+    for migrations), together with the
+    placements of any number of VMPoolState instances.
+
+    The registries are global to each process, so this allows another
+    process, e.g. a multiprocessing worker, to reconstruct the same
+    pool states via restore().  Only VM and VM host names are stored,
+    so the snapshot is compact and independent of how the states
+    happen to share data with each other.
+    """
+
+    def __init__(self, states=[]):
+        self.vms = [ (vm.name, vm.arch, vm.ram, vm.dirty_rate)
+                     for vm in VM.vms.itervalues() ]
+        self.vmhosts = [ (vmhost.name, vmhost.arch, vmhost.ram,
+                          vmhost.dom0_ram, vmhost.bandwidth)
+                         for vmhost in VMhost.vmhosts.itervalues() ]
+        self.guest_archs_ok = VMPoolState.guest_archs_ok
+        self.cost_model = VMmigration.cost_model
+        self.placements = [ self._placement(state) for state in states ]
+
+    def _placement(self, state):
+        return dict([ (vmhost_name, sorted(state.get_vmhost_vms(vmhost_name)))
+                      for vmhost_name in state.vmhost_names() ])
+
+    def restore(self):
+        """Replaces the inventory of the current process with the one
+        in the snapshot, and returns a list of new VMPoolState
+        instances with the snapshotted placements.
+        """
+        VM.reset()
+        VMhost.reset()
+        for name, arch, ram, dirty_rate in self.vms:
+            VM(name, arch, ram, dirty_rate)
+        for name, arch, ram, dom0_ram, bandwidth in self.vmhosts:
+            VMhost(name, arch, ram, dom0_ram, bandwidth)
+        VMPoolState.set_guest_archs_ok(self.guest_archs_ok)
+        VMmigration.set_cost_model(self.cost_model)
+
+        states = [ ]
+        for placement in self.placements:
+            state = VMPoolState()
+            for vmhost_name in sorted(placement.keys()):
+                state.init_vmhost(vmhost_name)
+                for vm_name in placement[vmhost_name]:
+                    state.add_vm(vm_name, vmhost_name)
+            states.append(state)
+        return states
+
+class InventorySnapshotTestCase(unittest.TestCase):
+    def testRoundTrip(self):
+        import pickle
+        import testcases.fixed
+
+        VM.reset()
+        VMhost.reset()
+        stateA, stateB, expected_path = testcases.fixed.case_tricky()
+        states = [ VMPoolState().init_by_vmhosts(stateA),
+                   VMPoolState().init_by_vmhosts(stateB) ]
+        snapshot = pickle.loads(pickle.dumps(InventorySnapshot(states)))
+
+        VM.reset()
+        VMhost.reset()
+        restored = snapshot.restore()
+        self.assertEqual(restored, states)
+        self.assertEqual([ hash(state) for state in restored ],
+                         [ hash(state) for state in states ])
+        self.assertEqual(sorted(VM.vms.keys()),
+                         sorted([ vm[0] for vm in snapshot.vms ]))
+        self.assertEqual(sorted(VMhost.vmhosts.keys()),
+                         sorted(stateA.keys()))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/python
+
+from collections import OrderedDict
+
+import unittest
+
+class LRUCache:
+    """Mapping which holds at most max_size items, evicting the least
+    recently used item to make room for new ones.  Both retrieving an
+    item and storing one count as a use, and both are O(1).
+
+    Hits and misses are counted, to allow measurement of how
+    effective the cache is.
+    """
+
+    def __init__(self, max_size):
+        if max_size < 1:
+            raise ValueError, "LRUCache size must be positive"
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __getitem__(self, key):
+        try:
+            value = self._items.pop(key)
+        except KeyError:
+            self.misses += 1
+            raise
+        self.hits += 1
+        # Reinsert to mark as most recently used.
+        self._items[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self._items:
+            del self._items[key]
+        elif len(self._items) >= self.max_size:
+            self._items.popitem(last=False)
+        self._items[key] = value
+
+class LRUCacheTestCase(unittest.TestCase):
+    def testAll(self):
+        cache = LRUCache(3)
+        for key in 'abc':
+            cache[key] = key.upper()
+        self.assertEqual(len(cache), 3)
+
+        # use a, so that b becomes least recently used
+        self.assertEqual(cache['a'], 'A')
+        cache['d'] = 'D'
+        self.assertEqual(len(cache), 3)
+        assert 'b' not in cache, 'evicted least recently used'
+        for key in 'acd':
+            assert key in cache, key
+
+        # overwriting counts as a use, and doesn't evict anything
+        cache['c'] = 'C2'
+        cache['e'] = 'E'
+        assert 'a' not in cache, 'evicted least recently used'
+        self.assertEqual(cache['c'], 'C2')
+
+        self.assertRaises(KeyError, cache.__getitem__, 'b')
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def testNoneValues(self):
+        cache = LRUCache(1)
+        cache['x'] = None
+        assert 'x' in cache
+        self.assertEqual(cache['x'], None)
+
+if __name__ == '__main__':
+    unittest.main()
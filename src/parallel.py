@@ -0,0 +1,189 @@
+#!/usr/bin/python
+
+import multiprocessing
+
+from aspiers import VMPoolAdamPathFinder, _BudgetExhausted
+from inventory import InventorySnapshot
+from vmmigration import VMmigration
+
+# Path finder used by each worker process for all the alternatives it
+# is given; see _init_worker().
+_worker_finder = None
+
+def _init_worker(snapshot):
+    """Initialises a worker process of VMPoolParallelAdamPathFinder
+    from a snapshot of the inventory and the endpoints of the path.
+    """
+    global _worker_finder
+    initial_state, final_state = snapshot.restore()
+    _worker_finder = VMPoolAdamPathFinder(initial_state, final_state,
+                                          debug_level=0)
+
+def _moves(migrations):
+    """Returns a list of (VM name, from host name, to host name)
+    tuples describing the given migrations.  Names are passed back
+    from the workers rather than VMmigration objects, since those
+    refer to the worker's own VM and VMhost objects.
+    """
+    return [ (migration.vm.name, migration.from_host.name,
+              migration.to_host.name)
+             for migration in migrations ]
+
+def _solve_first(task):
+    """Runs in a worker process.  The task is a (vm_name, deadline,
+    max_nodes, max_states) tuple, where the budgets apply to the
+    search for this alternative alone, and are as for find_path().
+
+    Returns a (vm_name, moves, frames_run, reason, partial, placed)
+    tuple, where moves is a list of moves (see _moves()) describing
+    the path found by moving the named VM first, or None if there is
+    no such path or a budget ran out first, in which case reason is
+    the SearchStatus reason for giving up.  partial describes the
+    partial path along which this worker has so far got the most VMs
+    (placed of them) to their final VM host, in any of the
+    alternatives it has been given.
+    """
+    vm_name, deadline, max_nodes, max_states = task
+    finder = _worker_finder
+    frames_run = finder.frames_run
+    finder.deadline = deadline
+    finder.max_nodes = None
+    if max_nodes is not None:
+        finder.max_nodes = frames_run + max_nodes
+    finder.max_states = max_states
+    try:
+        migrations = finder._run(
+            finder._solve_first([], finder.path.state_post_initial_shutdowns,
+                                finder.path.vms_to_migrate, vm_name))
+    except _BudgetExhausted, e:
+        migrations, reason = None, e.reason
+    else:
+        reason = None
+    moves = None
+    if migrations is not None:
+        moves = _moves(migrations)
+    return vm_name, moves, finder.frames_run - frames_run, reason, \
+        _moves(finder.best_partial), finder.best_partial_placed
+
+class VMPoolParallelAdamPathFinder(VMPoolAdamPathFinder):
+    """Parallel variant of VMPoolAdamPathFinder, which spreads the
+    top-level choice of which VM to move to its final destination first
+    across a pool of worker processes, each of which searches for a
+    path starting with its alternatives as VMPoolAdamPathFinder would.
+
+    The workers are sent a picklable InventorySnapshot of the VMs, VM
+    hosts and endpoint states once, when they start.  Each worker
+    keeps its own transposition table across all the alternatives it
+    is given.
+
+    If first_wins is True, the first path which any worker finds is
+    returned and the remaining alternatives are abandoned; otherwise
+    all alternatives are searched and the cheapest path is returned,
+    which is the same path VMPoolAnytimeAdamPathFinder finds when
+    given enough time.
+
+    The deadline and max_states budgets are passed on to the search
+    of each alternative, as is whatever remains of max_nodes, which
+    also counts the frames run by all the workers together.  Budgets
+    and cancellation are checked at least every poll_interval seconds
+    while waiting for results.  As with VMPoolAnytimeAdamPathFinder,
+    if a budget runs out once a path has been found, the best one so
+    far is returned, and otherwise the search gives up, reporting the
+    partial path along which any worker got the most VMs to their
+    final VM host.
+
+    N.B. Instances should not be reused for multiple runs.
+    """
+
+    # Number of worker processes, or None for one per CPU.
+    processes = None
+
+    # Whether to settle for the first path found by any worker.
+    first_wins = False
+
+    # Seconds to wait for a result before checking the budgets again.
+    poll_interval = 0.1
+
+    def init(self):
+        VMPoolAdamPathFinder.init(self)
+
+        self.alternatives_tried = 0
+        self.alternatives_solved = 0
+        self.best_cost = None
+
+    def run(self):
+        current_state = self.path.state_post_initial_shutdowns
+        vms_to_migrate = self.path.vms_to_migrate
+        if self._solved(current_state, vms_to_migrate):
+            return []
+
+        snapshot = InventorySnapshot([ self.path.initial_state,
+                                       self.path.final_state ])
+        max_nodes = self.max_nodes
+        if max_nodes is not None:
+            max_nodes -= self.frames_run
+        tasks = [ (vm_name, self.deadline, max_nodes, self.max_states)
+                  for vm_name in sorted(vms_to_migrate.keys()) ]
+        pool = multiprocessing.Pool(self.processes, _init_worker, (snapshot,))
+        try:
+            best = self._collect(pool.imap_unordered(_solve_first, tasks))
+        except _BudgetExhausted, e:
+            self.give_up(e.reason, self.best_partial)
+            return None
+        finally:
+            # Any alternatives still being searched are no longer of
+            # interest.
+            pool.terminate()
+            pool.join()
+
+        self.debug(1, "tried %d alternatives; %d solved",
+                   self.alternatives_tried, self.alternatives_solved)
+        if best is None:
+            return None
+        return [ VMmigration(vm_name, from_host, to_host)
+                 for vm_name, from_host, to_host in best ]
+
+    def _collect(self, results):
+        """Returns the best list of moves from the given iterator of
+        results from _solve_first().  Ties are broken in favour of the
+        VM which comes first in sorted order, so that the result
+        doesn't depend on which worker finishes first.
+
+        Keeps track of the best partial path reported by the workers,
+        as VMPoolAdamPathFinder does, and raises _BudgetExhausted if a
+        budget runs out, or the search is cancelled, before any path
+        has been found.
+        """
+        best = best_vm_name = None
+        while True:
+            reason = self.should_give_up()
+            if reason is None:
+                try:
+                    vm_name, moves, frames_run, reason, partial, placed = \
+                        results.next(self.poll_interval)
+                except multiprocessing.TimeoutError:
+                    continue
+                except StopIteration:
+                    break
+                self.alternatives_tried += 1
+                self.frames_run += frames_run
+                if placed > self.best_partial_placed:
+                    self.best_partial = [ VMmigration(*move)
+                                          for move in partial ]
+                    self.best_partial_placed = placed
+            if reason is not None:
+                if best is None:
+                    raise _BudgetExhausted(reason)
+                break
+            if moves is None:
+                continue
+            self.alternatives_solved += 1
+            cost = sum([ VMmigration(*move).cost() for move in moves ])
+            self.debug(1, "alternative starting with %s costs %d",
+                       vm_name, cost)
+            if best is None or cost < self.best_cost or \
+               (cost == self.best_cost and vm_name < best_vm_name):
+                best, best_vm_name, self.best_cost = moves, vm_name, cost
+            if self.first_wins:
+                break
+        return best
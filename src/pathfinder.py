@@ -1,13 +1,107 @@
 #!/usr/bin/python
 
+import functools
 import re
 import sys
 import time
-import traceback
 
+from debuglog import DebugLog
 from vmpoolstateerrors import VMPoolStateSanityError
 from vmpoolpath import VMPoolPath
 
+def traced(method):
+    """Decorator for path finder methods whose debugging output
+    should be indented one level deeper than that of their caller.
+    This tracks the depth with a simple counter, which is much cheaper
+    than inspecting the stack on every call to debug().
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self._depth += 1
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._depth -= 1
+    return wrapper
+
+class CancellationToken:
+    """Flag which another thread can set via cancel() to ask a path
+    finder to give up its search as soon as possible.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class SearchProgress:
+    """Snapshot of the progress of a running search, as passed to a
+    path finder's progress callback:
+
+    nodes_expanded
+        number of nodes expanded so far
+    depth
+        how deep the search currently is (the number of migrations
+        from the start to the node being explored, or for
+        VMPoolAdamPathFinder, the depth of its stack), or None if
+        unknown
+    vms_to_migrate
+        number of VMs not yet on their final VM host in the node being
+        explored, or None if unknown
+    elapsed
+        seconds since the path finder was created
+    """
+
+    def __init__(self, nodes_expanded, depth, vms_to_migrate, elapsed):
+        self.nodes_expanded = nodes_expanded
+        self.depth = depth
+        self.vms_to_migrate = vms_to_migrate
+        self.elapsed = elapsed
+
+    def __str__(self):
+        return "%d nodes, depth %s, %s VMs to migrate, %.1fs" % \
+            (self.nodes_expanded, self.depth, self.vms_to_migrate,
+             self.elapsed)
+
+class SearchStatus:
+    """Outcome of a run of a path finder.  reason is one of the
+    constants below.  If the search was cut short by running out of
+    one of its budgets or being cancelled, migrations is the sequence
+    of sane migrations
+    from the start of the path which made the most progress, in terms
+    of the number of VMs which needed migrating and ended up on their
+    final VM host (vms_placed, out of vms_to_place).
+    """
+
+    FOUND       = 'found'
+    NO_PATH     = 'no path'
+    NODE_LIMIT  = 'node limit'
+    STATE_LIMIT = 'state limit'
+    DEADLINE    = 'deadline'
+    CANCELLED   = 'cancelled'
+
+    def __init__(self, reason, migrations, vms_placed, vms_to_place,
+                 nodes_expanded, resident_states):
+        self.reason = reason
+        self.migrations = migrations
+        self.vms_placed = vms_placed
+        self.vms_to_place = vms_to_place
+        self.nodes_expanded = nodes_expanded
+        self.resident_states = resident_states
+
+    def exhausted(self):
+        """Returns True if the search ran out of budget or was
+        cancelled.
+        """
+        return self.reason not in (self.FOUND, self.NO_PATH)
+
+    def __str__(self):
+        return "%s after %d nodes, %d resident states; " \
+               "%d/%d VMs placed by %d migrations" % \
+            (self.reason, self.nodes_expanded, self.resident_states,
+             self.vms_placed, self.vms_to_place, len(self.migrations))
+
 class VMPoolPathFinder:
     """This abstract class enables storage of the state data used
     during the discovery of the path inside an instance.  This makes
@@ -16,22 +110,53 @@ class VMPoolPathFinder:
     code a bit cleaner (albeit slightly more complex) through not
     having to pass several state variables around.
 
+    Debugging output is kept in a DebugLog, which retains only the
+    last debug_log_size messages, and optionally streams all of them
+    to the gzip-compressed file debug_log_file.
+
+    The search can be bounded by budgets passed to find_path(), and
+    cancelled from another thread via cancel_token, a
+    CancellationToken.  If progress_callback is given, it is called
+    with a SearchProgress at most once every progress_interval
+    seconds.  What counts as a node expanded or a resident state is
+    up to each subclass, which should check should_give_up()
+    regularly, and call give_up() if it returns a reason.
+
     N.B. Instances should not be reused for multiple runs.
     """
 
-    def __init__(self, initial_state, final_state, debug_level=2):
+    # Minimum number of seconds between calls to the progress
+    # callback.
+    progress_interval = 1.0
+
+    def __init__(self, initial_state, final_state, debug_level=2,
+                 debug_log_size=10000, debug_log_file=None,
+                 progress_callback=None, cancel_token=None):
         self.initial_state = initial_state
         self.final_state = final_state
 
-        self._debug = ''
+        self.progress_callback = progress_callback
+        self.cancel_token = cancel_token
+
+        self._debug = DebugLog(debug_log_size, debug_log_file)
         self._debug_level = debug_level
         self.immediate_debugging = False
 
+        # Nesting depth of @traced methods, used for indenting
+        # debugging output.
+        self._depth = 0
+
         self._start_time = time.time()
 
         # Did we find a path yet?
         self.found = False
 
+        # Budgets (see find_path()), and how the run turned out.
+        self.max_nodes = None
+        self.max_states = None
+        self.deadline = None
+        self.status = None
+
         self.check_endpoints_sane()
 
         if hasattr(self, 'path'):
@@ -59,53 +184,146 @@ class VMPoolPathFinder:
             sys.stderr.write("end state not sane: %s\n" % e)
             sys.exit(1)
 
-    def find_path(self):
-        self._stack_depth_at_run = len(traceback.extract_stack()) + 1
-        migrations = self.run()
+    def find_path(self, max_nodes=None, deadline=None, max_states=None):
+        """Returns a VMPoolPath from the initial state to the final
+        state, or None if no path was found.  Either way, self.status
+        is set to a SearchStatus describing the outcome.
+
+        The search gives up, returning None, once it has expanded
+        max_nodes nodes, or the time (as returned by time.time()) is
+        past deadline, or it is holding max_states states in memory.
+        In that case self.status includes the best partial path.
+        """
+        self.max_nodes = max_nodes
+        self.deadline = deadline
+        self.max_states = max_states
+        self._next_progress = time.time() + self.progress_interval
+        try:
+            migrations = self.run()
+        finally:
+            self._debug.close()
         self._end_time = time.time()
 
         if migrations is None:
+            if self.status is None:
+                self.status = self._status(SearchStatus.NO_PATH, [ ])
             return None
 
+        self.status = self._status(SearchStatus.FOUND, migrations)
         self.path.set_migration_sequence(migrations)
         cost = reduce(lambda acc, mig: acc + mig.cost(), migrations, 0)
         self.path.set_cost(cost)
 
         return self.path
 
+    def should_give_up(self):
+        """Returns the SearchStatus reason for giving up if the search
+        has been cancelled or any of the budgets has run out, or None
+        otherwise.  Also reports progress, if it's time to.
+        """
+        if self.progress_callback is not None:
+            now = time.time()
+            if now >= self._next_progress:
+                self._next_progress = now + self.progress_interval
+                self.progress_callback(SearchProgress(
+                    self.nodes_searched(), self.current_depth(),
+                    self.vms_remaining(), now - self._start_time))
+        if self.cancel_token is not None and self.cancel_token.cancelled:
+            return SearchStatus.CANCELLED
+        if self.max_nodes is not None and \
+           self.nodes_searched() >= self.max_nodes:
+            return SearchStatus.NODE_LIMIT
+        if self.max_states is not None and \
+           self.states_resident() >= self.max_states:
+            return SearchStatus.STATE_LIMIT
+        if self.deadline is not None and time.time() >= self.deadline:
+            return SearchStatus.DEADLINE
+        return None
+
+    def give_up(self, reason, migrations):
+        """Records that the search ran out of budget, having made the
+        most progress via the given partial path.
+        """
+        self.debug(1, "giving up: %s", reason)
+        self.status = self._status(reason, migrations)
+
+    def _status(self, reason, migrations):
+        state = self.path.state_post_initial_shutdowns
+        for migration in migrations:
+            state = state.migrate(migration.vm.name, migration.to_host.name)
+        return SearchStatus(reason, migrations, self.vms_placed(state),
+                            len(self.path.vms_to_migrate),
+                            self.nodes_searched(), self.states_resident())
+
+    def vms_placed(self, state):
+        """Returns the number of VMs which need migrating and are on
+        their final VM host in the given state.
+        """
+        end = self.path.state_pre_final_provisions
+        return len([ vm_name for vm_name in self.path.vms_to_migrate
+                     if state.get_vm_vmhost(vm_name) ==
+                        end.get_vm_vmhost(vm_name) ])
+
+    def vms_misplaced(self, state):
+        """Returns the number of VMs which aren't on their final VM
+        host in the given state.
+        """
+        end = self.path.state_pre_final_provisions
+        return len([ vm_name for vm_name in state.vm_names()
+                     if state.get_vm_vmhost(vm_name) !=
+                        end.get_vm_vmhost(vm_name) ])
+
+    def current_depth(self):
+        """Returns how deep the search currently is, for progress
+        reports, or None if unknown.  Override this if required.
+        """
+        return None
+
+    def vms_remaining(self):
+        """Returns the number of VMs which aren't on their final VM
+        host in the node currently being explored, for progress
+        reports, or None if unknown.  Override this if required.
+        """
+        return None
+
+    def nodes_searched(self):
+        """Returns the number of nodes expanded, for comparison with
+        the max_nodes budget.  Override this if required.
+        """
+        return 0
+
+    def states_resident(self):
+        """Returns the number of states held in memory, for comparison
+        with the max_states budget.  Override this if required.
+        """
+        return 0
+
     def time_elapsed(self):
         return self._end_time - self._start_time
 
-    def debug(self, level, message, indent=None):
-        if level <= self._debug_level:
-            if indent is None:
-                indent = self._indent()
-            #print "indent[%s]" % indent
-            if indent != "":
-                message = re.subn('^', indent, message, 0, re.MULTILINE)[0]
-            #message = "[%s]" % message
-            if self.immediate_debugging:
-                print message
-            self._debug += message + "\n"
-        # if time.time() - self._start_time > 1.0:
-        #     print self._debug,
-        #     self._debug = ''
-
-    def _indent(self):
-        # Determine stack depth from run() method
-        stack = traceback.extract_stack()
-        stack = stack[self._stack_depth_at_run:]
-
-        # Pop debug routines off traceback
-        while stack and __file__.startswith(stack[-1][0]):
-            stack.pop()
-
-        # print("".join(traceback.format_list(stack)))
-        # print len(stack)
-
-        # Indent by stack depth, excluding this method's caller so
-        # that we start with no indentation.
-        return "  " * (len(stack) - 1)
+    def debug(self, level, message, *args, **kwargs):
+        """Appends the message to the debugging output if level is
+        no higher than the debug level.  Any extra arguments are
+        interpolated into the message with the % operator, which is
+        deferred until the level has been checked, so that callers
+        don't pay for formatting messages which are discarded.
+
+        The message is indented according to the nesting depth of
+        @traced methods, unless an explicit indent keyword argument is
+        given.
+        """
+        if level > self._debug_level:
+            return
+        if args:
+            message = message % args
+        indent = kwargs.get('indent')
+        if indent is None:
+            indent = "  " * self._depth
+        if indent != "":
+            message = re.subn('^', indent, message, 0, re.MULTILINE)[0]
+        if self.immediate_debugging:
+            print message
+        self._debug.append(message)
 
     def _get_vm_highlights(self, vms_to_migrate, locked_vms):
         vm_highlights = { }
@@ -117,10 +335,13 @@ class VMPoolPathFinder:
         return vm_highlights
 
     def get_debug(self):
-        return self._debug
+        """Returns the most recent debugging output."""
+        return self._debug.tail()
 
     def debug_state(self, current_state, vms_to_migrate, locked_vms,
                     extra_vm_highlights={}, vmhost_highlights={}):
+        if self._debug_level < 2:
+            return
         vm_highlights = self._get_vm_highlights(vms_to_migrate, locked_vms)
         vm_highlights.update(extra_vm_highlights)
         meters = current_state.ascii_meters(
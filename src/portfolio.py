@@ -0,0 +1,290 @@
+#!/usr/bin/python
+
+# Races several path finding strategies against each other on the
+# same problem, each in its own process.  Usage:
+#
+#   portfolio.py [case ...]
+#
+# runs the portfolio on the given cases from testcases.fixed (or all
+# of them), and reports which strategies won how often.
+
+import multiprocessing
+import Queue
+import re
+import sys
+import time
+
+from aspiers import VMPoolAdamPathFinder
+from dijkstra import VMPoolShortestPathFinder
+from greedy import VMPoolGreedyPathFinder
+from inventory import InventorySnapshot
+from vmmigration import VMmigration
+from vmpoolpath import VMPoolPath
+from vmpoolstateerrors import VMPoolStateSanityError
+
+# Registry of the strategies which a Portfolio runs by default, as
+# (name, path finder class) pairs.  When several paths are equally
+# cheap, the one found by the strategy registered first wins.
+STRATEGIES = [ ]
+
+def register_strategy(name, finder_class):
+    """Adds a path finder class to the default portfolio."""
+    for registered_name, registered_class in STRATEGIES:
+        if registered_name == name:
+            raise ValueError, "strategy %s already registered" % name
+    STRATEGIES.append((name, finder_class))
+
+register_strategy('adam', VMPoolAdamPathFinder)
+register_strategy('greedy', VMPoolGreedyPathFinder)
+register_strategy('dijkstra', VMPoolShortestPathFinder)
+
+def _run_strategy(name, finder_class, snapshot, results):
+    """Runs in a child process, and puts a (name, moves, seconds)
+    tuple on the results queue, where moves is a list of (VM name,
+    from host name, to host name) tuples, or None if no path was
+    found, or the text of the exception if the strategy failed.
+    """
+    start = time.time()
+    try:
+        initial_state, final_state = snapshot.restore()
+        finder = finder_class(initial_state, final_state, debug_level=0)
+        path = finder.find_path()
+    except Exception, e:
+        results.put((name, "%s: %s" % (e.__class__.__name__, e),
+                     time.time() - start))
+        return
+
+    moves = None
+    if path is not None:
+        moves = [ (migration.vm.name, migration.from_host.name,
+                   migration.to_host.name)
+                  for migration in path.migration_sequence ]
+    results.put((name, moves, time.time() - start))
+
+class PortfolioStats:
+    """Tally of the outcomes of each strategy over all the runs of a
+    Portfolio, and of how long the strategies took when they finished,
+    to allow the portfolio to be tuned.
+
+    The possible outcomes of each strategy in each run are:
+
+    won
+        its path was the one returned
+    lost
+        it found a valid path, but not the one returned
+    no path
+        it finished without finding a path
+    failed
+        it raised an exception, exited prematurely, or returned an
+        invalid path
+    killed
+        it was still running when the winner was decided
+    """
+
+    OUTCOMES = ('won', 'lost', 'no path', 'failed', 'killed')
+
+    def __init__(self):
+        self.outcomes = { }
+        self.latencies = { }
+
+    def record(self, name, outcome, latency=None):
+        if outcome not in self.OUTCOMES:
+            raise ValueError, "unknown outcome %s" % outcome
+        counts = self.outcomes.setdefault(name, { })
+        counts[outcome] = counts.get(outcome, 0) + 1
+        if latency is not None:
+            self.latencies.setdefault(name, [ ]).append(latency)
+
+    def runs(self, name):
+        return sum(self.outcomes.get(name, { }).values())
+
+    def win_rate(self, name):
+        runs = self.runs(name)
+        if runs == 0:
+            return None
+        return float(self.outcomes[name].get('won', 0)) / runs
+
+    def mean_latency(self, name):
+        """Returns the mean time taken by the given strategy on the
+        runs in which it finished, or None if it never did.
+        """
+        latencies = self.latencies.get(name)
+        if not latencies:
+            return None
+        return sum(latencies) / len(latencies)
+
+    def report(self):
+        lines = [ "%-12s %5s %6s %s" % ('strategy', 'runs', 'wins',
+                                        'mean latency') ]
+        for name in sorted(self.outcomes.keys()):
+            latency = self.mean_latency(name)
+            lines.append("%-12s %5d %5.1f%% %s  %s" % \
+                (name, self.runs(name), 100 * self.win_rate(name),
+                 '       -' if latency is None else "%7.3fs" % latency,
+                 ', '.join([ "%s %d" % (outcome, self.outcomes[name][outcome])
+                             for outcome in self.OUTCOMES
+                             if outcome in self.outcomes[name] ])))
+        return "\n".join(lines)
+
+class Portfolio:
+    """Runs several path finding strategies concurrently on the same
+    problem, each in a separate process, and returns the path found
+    by one of them.
+
+    If first_wins is True, the first valid path found is returned.
+    Otherwise the cheapest path found by the time the deadline
+    expires (or all strategies have finished) is returned.  Either
+    way, any strategies still running are then killed.  Outcomes and
+    latencies of the strategies are accumulated in stats across
+    multiple calls to find_path().
+
+    Unlike the path finders, instances can be reused.
+    """
+
+    def __init__(self, strategies=None, deadline=60.0, first_wins=True):
+        if strategies is None:
+            strategies = STRATEGIES
+        self.strategies = list(strategies)
+        self.deadline = deadline
+        self.first_wins = first_wins
+        self.stats = PortfolioStats()
+
+        # Name of the strategy which found the last path returned.
+        self.winner = None
+
+    def find_path(self, initial_state, final_state):
+        """Returns a VMPoolPath from initial_state to final_state, or
+        None if no strategy found one before the deadline.
+        """
+        path = VMPoolPath(initial_state, final_state)
+        path.compare_endpoints()
+
+        snapshot = InventorySnapshot([ initial_state, final_state ])
+        results = multiprocessing.Queue()
+        processes = { }
+        for name, finder_class in self.strategies:
+            process = multiprocessing.Process(
+                target=_run_strategy,
+                args=(name, finder_class, snapshot, results))
+            process.daemon = True
+            process.start()
+            processes[name] = process
+
+        finished = { }
+        try:
+            found = self._collect(path, processes, results, finished)
+        finally:
+            for process in processes.itervalues():
+                if process.is_alive():
+                    process.terminate()
+                process.join()
+
+        self.winner = None
+        best = None
+        for name, finder_class in self.strategies:
+            if name in found and \
+               (best is None or found[name][1] < found[best][1]):
+                best = name
+        for name, finder_class in self.strategies:
+            if name in found:
+                outcome = 'won' if name == best else 'lost'
+                self.stats.record(name, outcome, found[name][2])
+            elif name not in finished:
+                self.stats.record(name, 'killed')
+
+        if best is None:
+            return None
+        self.winner = best
+        migrations, cost, seconds = found[best]
+        path.set_migration_sequence(migrations)
+        path.set_cost(cost)
+        return path
+
+    def _collect(self, path, processes, results, finished):
+        """Waits for results until the winner is decided, recording
+        the outcomes of strategies which finish without a valid path.
+        Returns a dict mapping the names of strategies which found
+        valid paths to (migrations, cost, seconds) tuples.  The names
+        of all strategies which finished are added to finished.
+        """
+        deadline = time.time() + self.deadline
+        found = { }
+        while len(finished) < len(processes):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                name, moves, seconds = results.get(timeout=min(remaining, 0.1))
+            except Queue.Empty:
+                # A strategy which exits prematurely (e.g. via
+                # sys.exit()) never reports back.
+                for name, process in processes.iteritems():
+                    if name not in finished and \
+                       process.exitcode is not None and process.exitcode != 0:
+                        finished[name] = True
+                        self.stats.record(name, 'failed')
+                continue
+
+            finished[name] = True
+            if moves is None:
+                self.stats.record(name, 'no path', seconds)
+                continue
+            if isinstance(moves, str):
+                self.stats.record(name, 'failed', seconds)
+                continue
+
+            migrations = [ VMmigration(*move) for move in moves ]
+            if not self._valid(path, migrations):
+                self.stats.record(name, 'failed', seconds)
+                continue
+
+            found[name] = (migrations,
+                           sum([ migration.cost() for migration in migrations ]),
+                           seconds)
+            if self.first_wins:
+                break
+
+        return found
+
+    def _valid(self, path, migrations):
+        """Checks that the given migrations lead sanely from the start
+        of the path to its end, so that a buggy strategy can't win.
+        """
+        state = path.state_post_initial_shutdowns
+        try:
+            for migration in migrations:
+                if state.get_vm_vmhost(migration.vm.name) != \
+                   migration.from_host.name:
+                    return False
+                state = state.check_migration_sane(migration.vm.name,
+                                                   migration.to_host)
+        except (VMPoolStateSanityError, KeyError, RuntimeError):
+            return False
+        return state == path.state_pre_final_provisions
+
+if __name__ == '__main__':
+    import testcases.fixed
+    from vm import VM
+    from vmhost import VMhost
+    from vmpoolstate import VMPoolState
+
+    case_names = sys.argv[1:]
+    if not case_names:
+        case_names = sorted([ m.group(1) for m in
+                              [ re.match('^case_(.+)', attr)
+                                for attr in dir(testcases.fixed) ]
+                              if m ])
+
+    portfolio = Portfolio()
+    for case_name in case_names:
+        VM.reset()
+        VMhost.reset()
+        stateA, stateB, expected_path = \
+            getattr(testcases.fixed, 'case_' + case_name)()
+        path = portfolio.find_path(VMPoolState().init_by_vmhosts(stateA),
+                                   VMPoolState().init_by_vmhosts(stateB))
+        print "%-20s %s" % (case_name,
+                            "%s (cost %d)" % (portfolio.winner, path.cost)
+                            if path else "no path")
+    print
+    print portfolio.stats.report()
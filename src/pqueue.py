@@ -0,0 +1,204 @@
+#!/usr/bin/python
+
+from heapq import heapify, heappush, heappop
+import itertools
+
+import unittest
+
+# Placeholder for the key of a heap entry which has been removed or
+# superseded.
+_REMOVED = object()
+
+class PriorityQueue(dict):
+    """Drop-in replacement for ValueOrderedDictionary, implemented as
+    a binary heap with lazy deletion.  insert(), shift() and changing
+    the value of an existing key (e.g. decrease-key via __setitem__)
+    are all O(log n), and __delitem__ is O(1).
+
+    Like ValueOrderedDictionary, keys with equal values are shifted
+    in FIFO order, and changing a key's value moves it behind any
+    other keys which already have the new value.  This is achieved by
+    tagging each heap entry with a sequence number.
+
+    Iterating in value order is O(n log n), since it requires sorting
+    the heap.
+    """
+
+    def __init__(self):
+        dict.__init__(self)
+        # Heap of [value, sequence number, key] entries.
+        self._heap = [ ]
+        # Maps each key to its live entry in the heap.
+        self._entries = { }
+        self._sequence = itertools.count()
+
+    def __setitem__(self, new_key, new_val):
+        if new_key in self:
+            del self[new_key]
+        self.insert(new_key, new_val)
+
+    def insert(self, new_key, new_val):
+        if new_key in self:
+            raise ValueError, "key %s already in todo list" % new_key
+        entry = [ new_val, next(self._sequence), new_key ]
+        self._entries[new_key] = entry
+        heappush(self._heap, entry)
+        dict.__setitem__(self, new_key, new_val)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError, key
+        # Leave the entry in the heap to be discarded when it
+        # reaches the top, rather than searching for it.
+        entry = self._entries.pop(key)
+        entry[-1] = _REMOVED
+        dict.__delitem__(self, key)
+        if len(self._heap) > 2 * len(self._entries) + 16:
+            self._compact()
+
+    def _compact(self):
+        """Discards all removed entries from the heap."""
+        self._heap = [ entry for entry in self._heap
+                       if entry[-1] is not _REMOVED ]
+        heapify(self._heap)
+
+    def peek(self):
+        """Returns the (key, value) pair which shift() would return,
+        without removing it.
+        """
+        while self._heap:
+            if self._heap[0][-1] is not _REMOVED:
+                val, seq, key = self._heap[0]
+                return key, val
+            heappop(self._heap)
+        raise IndexError, "peek at empty %s" % self.__class__.__name__
+
+    def shift(self):
+        while self._heap:
+            val, seq, key = heappop(self._heap)
+            if key is not _REMOVED:
+                del self._entries[key]
+                dict.__delitem__(self, key)
+                return key, val
+        raise IndexError, "shift from empty %s" % self.__class__.__name__
+
+    def _ordered_entries(self):
+        return sorted([ entry for entry in self._heap
+                        if entry[-1] is not _REMOVED ])
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    def itervalues(self):
+        return iter(self.values())
+
+    __iter__ = iterkeys
+
+    def iteritems(self):
+        return iter([ (key, val) for val, seq, key in self._ordered_entries() ])
+
+    def keys(self):
+        return [ key for val, seq, key in self._ordered_entries() ]
+
+    def values(self):
+        return [ val for val, seq, key in self._ordered_entries() ]
+
+    def show(self):
+        print "dict:", self
+        print "keys:", self.keys()
+        print "vals:", self.values()
+
+class PriorityQueueTestCase(unittest.TestCase):
+    def testAll(self):
+        pq = PriorityQueue()
+        assert isinstance(pq, PriorityQueue), 'class'
+        assert len(pq) == 0, 'length'
+
+        # test ordering, including FIFO order for equal values
+        pq.insert('5th', 9)
+        pq.insert('3rd', 5)
+        pq.insert('1st', 3)
+        pq.insert('2nd', 3)
+        pq.insert('4th', 7)
+
+        self.check_ordering(pq,
+                            [ '1st', '2nd', '3rd', '4th', '5th' ],
+                            [ 3, 3, 5, 7, 9 ])
+
+        # test shift
+        self.assertEqual(pq.peek(), ('1st', 3))
+        top = pq.shift()
+        self.assertEqual(top, ('1st', 3))
+        self.check_ordering(pq,
+                            [ '2nd', '3rd', '4th', '5th' ],
+                            [ 3, 5, 7, 9 ])
+
+        # test membership and addition
+        assert 'new' not in pq
+        pq['new'] = 8
+        assert 'new' in pq, 'new'
+        self.assertEqual(pq['new'], 8, 'assignment')
+
+        self.check_ordering(pq,
+                            [ '2nd', '3rd', '4th', 'new', '5th' ],
+                            [ 3, 5, 7, 8, 9 ])
+
+        # test duplicate detection
+        try:
+            pq.insert('new', 18)
+        except ValueError:
+            pass
+        else:
+            self.fail("expected a ValueError since new already there")
+
+        # test no corruption by attempted duplicate
+        self.assertEqual(pq['new'], 8, 'assignment')
+        self.check_ordering(pq,
+                            [ '2nd', '3rd', '4th', 'new', '5th' ],
+                            [ 3, 5, 7, 8, 9 ])
+
+        # test reordering by changing value, in both directions
+        pq['4th'] = 14
+        self.check_ordering(pq,
+                            [ '2nd', '3rd', 'new', '5th', '4th' ],
+                            [ 3, 5, 8, 9, 14 ])
+
+        # decrease-key moves behind existing keys with the same value
+        pq['5th'] = 5
+        self.check_ordering(pq,
+                            [ '2nd', '3rd', '5th', 'new', '4th' ],
+                            [ 3, 5, 5, 8, 14 ])
+
+        # test deletion
+        del pq['3rd']
+        self.check_ordering(pq,
+                            [ '2nd', '5th', 'new', '4th' ],
+                            [ 3, 5, 8, 14 ])
+
+        self.assertEqual([ pq.shift() for i in xrange(len(pq)) ],
+                         [ ('2nd', 3), ('5th', 5), ('new', 8), ('4th', 14) ])
+        self.assertRaises(IndexError, pq.shift)
+        self.assertRaises(IndexError, pq.peek)
+
+    def testCompaction(self):
+        pq = PriorityQueue()
+        for i in xrange(100):
+            pq[i] = i
+        for j in xrange(1, 5):
+            for i in xrange(100):
+                pq[i] = 100 * j - i
+        assert len(pq._heap) <= 2 * len(pq) + 16, 'removed entries compacted'
+        self.assertEqual(pq.shift(), (99, 301))
+
+    def check_ordering(self, pq, okeys, ovals):
+        self.assertEqual(pq.keys(), okeys)
+        self.assertEqual([x for x in pq.iterkeys()], okeys)
+
+        self.assertEqual(pq.values(), ovals)
+        self.assertEqual([x for x in pq.itervalues()], ovals)
+
+        self.assertEqual([x for x in pq.iteritems()],
+                         zip(okeys, ovals))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+#!/usr/bin/python
+
+import random
+import unittest
+
+class RangeMinTree:
+    """Segment tree over a fixed-length sequence of numbers, which
+    supports adding a constant to every element of a range, and
+    finding the minimum of a range, both in O(log n).  Ranges are
+    half-open, i.e. [lo, hi), as with slices.
+
+    Additions to a node's whole range are recorded lazily in the node
+    rather than being pushed down to its children, so each node's
+    minimum is the minimum of its children's plus its own pending
+    addition.
+    """
+
+    def __init__(self, values):
+        self.size = len(values)
+        self._min = [ 0 ] * (4 * max(self.size, 1))
+        self._add = [ 0 ] * (4 * max(self.size, 1))
+        if self.size:
+            self._build(1, 0, self.size, values)
+
+    def __len__(self):
+        return self.size
+
+    def _build(self, node, lo, hi, values):
+        if hi - lo == 1:
+            self._min[node] = values[lo]
+            return
+        mid = (lo + hi) // 2
+        self._build(2 * node, lo, mid, values)
+        self._build(2 * node + 1, mid, hi, values)
+        self._min[node] = min(self._min[2 * node], self._min[2 * node + 1])
+
+    def add(self, lo, hi, delta):
+        """Adds delta to every element in [lo, hi)."""
+        if lo < hi:
+            self._update(1, 0, self.size, lo, hi, delta)
+
+    def _update(self, node, node_lo, node_hi, lo, hi, delta):
+        if lo <= node_lo and node_hi <= hi:
+            self._min[node] += delta
+            self._add[node] += delta
+            return
+        mid = (node_lo + node_hi) // 2
+        if lo < mid:
+            self._update(2 * node, node_lo, mid, lo, hi, delta)
+        if hi > mid:
+            self._update(2 * node + 1, mid, node_hi, lo, hi, delta)
+        self._min[node] = self._add[node] + \
+            min(self._min[2 * node], self._min[2 * node + 1])
+
+    def min(self, lo, hi):
+        """Returns the minimum element in [lo, hi), which must not be
+        empty.
+        """
+        if not 0 <= lo < hi <= self.size:
+            raise IndexError, "invalid range [%d, %d)" % (lo, hi)
+        return self._query(1, 0, self.size, lo, hi)
+
+    def _query(self, node, node_lo, node_hi, lo, hi):
+        if lo <= node_lo and node_hi <= hi:
+            return self._min[node]
+        mid = (node_lo + node_hi) // 2
+        if hi <= mid:
+            result = self._query(2 * node, node_lo, mid, lo, hi)
+        elif lo >= mid:
+            result = self._query(2 * node + 1, mid, node_hi, lo, hi)
+        else:
+            result = min(self._query(2 * node, node_lo, mid, lo, hi),
+                         self._query(2 * node + 1, mid, node_hi, lo, hi))
+        return result + self._add[node]
+
+class RangeMinTreeTestCase(unittest.TestCase):
+    def testAgainstList(self):
+        rng = random.Random(1)
+        for size in (1, 2, 7, 64, 100):
+            values = [ rng.randint(-100, 100) for i in xrange(size) ]
+            tree = RangeMinTree(values)
+            self.assertEqual(len(tree), size)
+            for i in xrange(200):
+                lo = rng.randint(0, size - 1)
+                hi = rng.randint(lo + 1, size)
+                if rng.random() < 0.5:
+                    delta = rng.randint(-50, 50)
+                    tree.add(lo, hi, delta)
+                    for j in xrange(lo, hi):
+                        values[j] += delta
+                else:
+                    self.assertEqual(tree.min(lo, hi), min(values[lo:hi]))
+            self.assertEqual(tree.min(0, size), min(values))
+
+    def testInvalidRange(self):
+        tree = RangeMinTree([ 1, 2, 3 ])
+        self.assertRaises(IndexError, tree.min, 1, 1)
+        self.assertRaises(IndexError, tree.min, 0, 4)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,7 @@
 
 import unittest
 import sys
+import time
 import traceback
 
 import testcases
@@ -17,7 +18,7 @@ while True:
 
     path_finder = STRATEGY(stateA, stateB)
     try:
-        path = path_finder.find_path()
+        path = path_finder.find_path(deadline=time.time() + 3.0)
         if path is not None:
             path.walk()
     except RuntimeError, exc:
@@ -31,14 +32,10 @@ while True:
         #print path_finder.path.challenge_visualization(10, 80)
         print "No path found!"
 
-    if path_finder.time_elapsed() > 3.0:
+    if path_finder.status.exhausted():
         print path_finder.path.challenge_visualization(10, 80)
         print path_finder.get_debug()
         print path_finder.path.challenge_visualization(10, 80)
-        if path:
-            print path.summary()
-            print path.dump()
-        else:
-            print "No path found!"
+        print path_finder.status
         print "Took too long; aborting."
         sys.exit(1)
@@ -1,20 +1,65 @@
 #!/usr/bin/python
 
+import random
 import re
+import sys
 import unittest
 import textwrap
 
 from vm import VM
 from vmhost import VMhost
+import vmpoolstate
+import vmpoolarraystate
 from vmpoolstate import VMPoolState
+from vmpoolarraystate import VMPoolArrayState, VMPoolIndex
 import testcases.fixed
+import testcases.random
+import testcases.utils
 from dijkstra import VMPoolShortestPathFinder
-from aspiers import VMPoolAdamPathFinder
+from astar import VMPoolAStarPathFinder
+from bidirectional import VMPoolBidirectionalPathFinder
+from aspiers import VMPoolAdamPathFinder, VMPoolAnytimeAdamPathFinder
+from parallel import VMPoolParallelAdamPathFinder
+from portfolio import Portfolio
+from pathfinder import CancellationToken
+from waves import WaveScheduler
+from vmmigration import VMmigration
+from costmodel import CostModel, LiveMigrationCostModel
+from compress import PathCompressor
+from improve import PathImprover
+from vmpoolpath import VMPoolPath
 
 #STRATEGY = VMPoolShortestPathFinder
 STRATEGY = VMPoolAdamPathFinder
 
-class TestPathDiscovery(unittest.TestCase):
+# All the fixed testcases.
+FIXED_CASES = sorted([ m.group(1) for m in
+                       [ re.match('^case_(.+)', attr)
+                         for attr in dir(testcases.fixed) ]
+                       if m ])
+
+# Fixed testcases which are small enough for exhaustive search.
+SHORTEST_PATH_CASES = [
+    'simple_swap', 'simple_cessation', 'swap_with_one_temp',
+    'complex_swap', 'complex_pair_swap', 'shutdown_and_swap',
+    'tricky', 'weird', 'circles', 'simple_deadlock',
+]
+
+# Fixed testcases for strategies which are too expensive to run on
+# all of them, e.g. because they start worker processes.
+REPRESENTATIVE_CASES = [ 'tricky', 'complex_pair_swap' ]
+
+def to_array_state(state, index=None):
+    """Returns a VMPoolArrayState with the same placement as the
+    given VMPoolState.
+    """
+    return VMPoolArrayState(index).init_by_vmhosts(dict([
+        (vmhost_name, [ VM.vms[vm_name]
+                        for vm_name in state.get_vmhost_vms(vmhost_name) ])
+        for vmhost_name in state.vmhost_names() ]))
+
+class PoolTestCase(unittest.TestCase):
+    """Base class for tests which create their own VMs and VM hosts."""
     longMessage = True
     maxDiff = None
 
@@ -22,13 +67,50 @@ class TestPathDiscovery(unittest.TestCase):
         VM.reset()
         VMhost.reset()
 
-    def run_test(self, stateA, stateB, expected_path):
+    def fixed_case(self, case_name):
+        """Returns the initial and final states of the named fixed
+        testcase, and its expected path, if any.
+        """
+        stateA, stateB, expected_path = \
+            getattr(testcases.fixed, 'case_' + case_name)()
         if expected_path is not None:
             expected_path = textwrap.dedent(expected_path)
+        return VMPoolState().init_by_vmhosts(stateA), \
+            VMPoolState().init_by_vmhosts(stateB), expected_path
+
+class FixedCaseTestCase(PoolTestCase):
+    """Base class for tests which are run on each of the fixed
+    testcases named in cases, or on all of them if it is None.
+    Subclasses implement run_test(), which is given the initial and
+    final states of the testcase and its expected path; a test method
+    is added for each testcase by add_case_tests().
+    """
+    cases = None
 
-        sA = VMPoolState().init_by_vmhosts(stateA)
-        sB = VMPoolState().init_by_vmhosts(stateB)
+    def run_test(self, sA, sB, expected_path):
+        raise NotImplementedError
 
+    @classmethod
+    def add_case_tests(cls):
+        for case_name in cls.cases or FIXED_CASES:
+            def test_runner(self, case_name=case_name):
+                return self.run_test(*self.fixed_case(case_name))
+            setattr(cls, 'test_' + case_name, test_runner)
+
+class PathChecks:
+    """Mixin for test cases which rearrange the migrations of paths."""
+
+    def check_valid(self, path):
+        state = path.state_post_initial_shutdowns
+        for migration in path.migration_sequence:
+            self.assertEqual(state.get_vm_vmhost(migration.vm.name),
+                             migration.from_host.name)
+            state = state.check_migration_sane(migration.vm.name,
+                                               migration.to_host)
+        self.assertEqual(state, path.state_pre_final_provisions)
+
+class TestPathDiscovery(FixedCaseTestCase):
+    def run_test(self, sA, sB, expected_path):
         path_finder = STRATEGY(sA, sB)
         path = path_finder.find_path()
 
@@ -43,15 +125,611 @@ class TestPathDiscovery(unittest.TestCase):
             self.assertMultiLineEqual(path.dump(), expected_path,
                                       path_finder.get_debug())
 
-for attr in dir(testcases.fixed):
-    m = re.match('^case_(.+)', attr)
-    if not m:
-        continue
-    case_name = m.group(1)
-    test_name = 'test_' + case_name
-    method = getattr(testcases.fixed, attr)
-    def test_runner(self, method2=method):
-        return self.run_test(*method2())
-    setattr(TestPathDiscovery, test_name, test_runner)
+    def test_nogood_prunes(self):
+        # Displacements which provably can't make enough room are
+        # skipped without changing the path found.
+        sA, sB, expected_path = self.fixed_case('slow')
+        path_finder = VMPoolAdamPathFinder(sA, sB, debug_level=0)
+        path = path_finder.find_path()
+        self.assertGreater(path_finder.nogood_prunes, 0)
+        self.assertMultiLineEqual(path.dump(), expected_path)
+
+    def test_deep_displacement_chain(self):
+        # The chain of displacements is far deeper than Python's
+        # recursion limit, which the explicit stack isn't bound by.
+        initial, final = testcases.utils.displacement_chain(1000)
+        path_finder = VMPoolAdamPathFinder(initial, final, debug_level=0)
+        path = path_finder.find_path()
+        self.assertEqual(len(path.migration_sequence), 1000)
+        self.assertGreater(path_finder.max_depth, sys.getrecursionlimit())
+
+class TestAdamPaths(PathChecks, FixedCaseTestCase):
+    """Checks the variants of VMPoolAdamPathFinder, and what can be
+    done with the paths it finds:
+
+    - trying every alternative first move never ends up with a more
+      expensive path, and trying them in parallel finds the same path
+    - trying displacement candidates in order of cost and fit finds a
+      path whenever the default order does
+    - the same path is found with VMPoolArrayState, via states with
+      the same hashes
+    - the waves scheduled for the path respect all the constraints
+    - compressing the path keeps it valid and never makes it more
+      expensive
+    """
+    def run_test(self, sA, sB, expected_path):
+        path = VMPoolAdamPathFinder(sA, sB, debug_level=0).find_path()
+        self.check_array_states(sA, sB, path)
+
+        anytime = VMPoolAnytimeAdamPathFinder(sA, sB, debug_level=0)
+        anytime_path = anytime.find_path()
+        best_fit = VMPoolAdamPathFinder(sA, sB, debug_level=0)
+        best_fit.best_fit_candidates = True
+        best_fit_path = best_fit.find_path()
+        if path is None:
+            self.assertIsNone(anytime_path)
+            self.assertIsNone(best_fit_path)
+            return
+        self.assertIsNotNone(anytime_path)
+        self.assertLessEqual(anytime_path.cost, path.cost, anytime_path.dump())
+        self.assertEqual(anytime.alternatives_tried,
+                         len(anytime.path.vms_to_migrate))
+        self.assertIsNotNone(best_fit_path)
+
+        self.check_waves(path)
+
+        cost = path.cost
+        PathCompressor().compress(path)
+        self.check_valid(path)
+        self.assertLessEqual(path.cost, cost)
+
+    def check_array_states(self, sA, sB, path):
+        index = VMPoolIndex()
+        aA, aB = to_array_state(sA, index), to_array_state(sB, index)
+        self.assertEqual(hash(aA), hash(sA))
+        self.assertEqual(hash(aB), hash(sB))
+
+        array_path = STRATEGY(aA, aB, debug_level=0).find_path()
+        if path is None:
+            self.assertIsNone(array_path)
+            return
+        self.assertIsNotNone(array_path)
+        self.assertMultiLineEqual(array_path.dump(), path.dump())
+
+        state = path.state_post_initial_shutdowns
+        array_state = array_path.state_post_initial_shutdowns
+        for migration in path.migration_sequence:
+            state = state.migrate(migration.vm.name, migration.to_host.name)
+            array_state = array_state.migrate(migration.vm.name,
+                                                migration.to_host.name)
+            self.assertEqual(hash(array_state), hash(state))
+
+    def check_waves(self, path):
+        for limit in (1, 2, None):
+            waves = WaveScheduler(limit, limit).schedule(path)
+            self.assertEqual(sum(waves, [ ]), path.migration_sequence)
+            self.assertLessEqual(path.makespan(), path.cost)
+
+            state = path.state_post_initial_shutdowns
+            for wave in waves:
+                vms = [ migration.vm.name for migration in wave ]
+                self.assertEqual(len(set(vms)), len(vms))
+                for attr in ('from_host', 'to_host'):
+                    hosts = [ getattr(migration, attr).name
+                              for migration in wave ]
+                    for host in hosts:
+                        if limit is not None:
+                            self.assertLessEqual(hosts.count(host), limit)
+
+                # Migrating VMs occupy RAM on both VM hosts, so the
+                # state is sane after any subset of the wave, and
+                # in particular after all of it.
+                for migration in wave:
+                    incoming = sum([ other.vm.ram for other in wave
+                                     if other.to_host == migration.to_host ])
+                    self.assertLessEqual(
+                        incoming, state.free_RAM(migration.to_host.name))
+                for migration in wave:
+                    state = state.migrate(migration.vm.name,
+                                          migration.to_host.name)
+                state.check_sane()
+            self.assertEqual(state, path.state_pre_final_provisions)
+
+    def test_parallel(self):
+        for case_name in REPRESENTATIVE_CASES:
+            self.setUp()
+            sA, sB, expected_path = self.fixed_case(case_name)
+            path = VMPoolAnytimeAdamPathFinder(sA, sB,
+                                               debug_level=0).find_path()
+            parallel = VMPoolParallelAdamPathFinder(sA, sB, debug_level=0)
+            parallel.processes = 2
+            self.assertMultiLineEqual(parallel.find_path().dump(),
+                                      path.dump())
+
+class TestShortestPaths(PathChecks, FixedCaseTestCase):
+    """Checks that A* and bidirectional search, the reduction of
+    commuting migrations, and the portfolio of strategies, find paths
+    as cheap as plain Dijkstra's (though not necessarily the same
+    ones, when there are several paths of optimal cost), and that A*
+    does so without expanding any more nodes.
+
+    Also checks that improving the paths found by VMPoolAdamPathFinder
+    keeps them valid, and that once the window covers the whole path,
+    they are as cheap as those found by Dijkstra's.
+    """
+    cases = SHORTEST_PATH_CASES
+
+    def run_test(self, sA, sB, expected_path):
+        dijkstra = VMPoolShortestPathFinder(sA, sB, debug_level=0)
+        dijkstra_path = dijkstra.find_path()
+
+        astar = VMPoolAStarPathFinder(sA, sB, debug_level=0)
+        self.check_cost(astar, dijkstra_path)
+        self.assertLessEqual(astar.nodes_expanded, dijkstra.nodes_expanded)
+
+        bidirectional = VMPoolBidirectionalPathFinder(sA, sB, debug_level=0)
+        self.check_cost(bidirectional, dijkstra_path)
+
+        for finder_class in (VMPoolShortestPathFinder, VMPoolAStarPathFinder):
+            reduced = finder_class(sA, sB, debug_level=0)
+            reduced.reduce_commuting_migrations = True
+            self.check_cost(reduced, dijkstra_path)
+
+        if dijkstra_path is not None:
+            self.check_improvement(sA, sB, dijkstra_path)
+
+    def check_cost(self, path_finder, dijkstra_path):
+        path = path_finder.find_path()
+        if dijkstra_path is None:
+            self.assertIsNone(path)
+        else:
+            self.assertIsNotNone(path)
+            self.assertEqual(path.cost, dijkstra_path.cost, path.dump())
+
+    def check_improvement(self, sA, sB, dijkstra_path):
+        for restrict_to_window in (True, False):
+            path = VMPoolAdamPathFinder(sA, sB, debug_level=0).find_path()
+            cost = path.cost
+            improver = PathImprover(time_limit=60, min_window=2,
+                                    max_window=100, max_nodes=None)
+            improver.restrict_to_window = restrict_to_window
+            improver.improve(path)
+            self.check_valid(path)
+            self.assertLessEqual(path.cost, cost)
+            self.assertEqual(improver.cost_saved, cost - path.cost)
+            if not restrict_to_window:
+                self.assertEqual(path.cost, dijkstra_path.cost, path.dump())
+
+    def test_portfolio(self):
+        # Dijkstra's is one of the strategies in the portfolio, so if
+        # the portfolio waits for all of them, it should find an
+        # optimal path too.
+        for case_name in REPRESENTATIVE_CASES:
+            self.setUp()
+            sA, sB, expected_path = self.fixed_case(case_name)
+            dijkstra_path = VMPoolShortestPathFinder(sA, sB,
+                                                     debug_level=0).find_path()
+            portfolio = Portfolio(first_wins=False)
+            path = portfolio.find_path(sA, sB)
+            self.assertEqual(path.cost, dijkstra_path.cost, path.dump())
+            self.assertEqual(portfolio.stats.runs(portfolio.winner), 1)
+
+class TestFeasibleMigrations(FixedCaseTestCase):
+    """Checks that feasible_migrations_matrix() agrees with
+    can_migrate() for both kinds of pool state, both with NumPy and
+    without it.
+    """
+    def run_test(self, sA, sB, expected_path):
+        index = VMPoolIndex()
+        for state in (sA, sB, to_array_state(sA, index),
+                      to_array_state(sB, index)):
+            vm_names = sorted(state.vm_names())
+            vmhost_names = sorted(state.vmhost_names(), reverse=True)
+            for args in ((), (vm_names[1:], vmhost_names[1:])):
+                self.check_matrix(state, *args)
+                numpy = vmpoolstate.numpy
+                vmpoolstate.numpy = vmpoolarraystate.numpy = None
+                try:
+                    self.check_matrix(state, *args)
+                finally:
+                    vmpoolstate.numpy = vmpoolarraystate.numpy = numpy
+
+    def test_set_guest_archs_ok(self):
+        vm1 = VM('vm1', 'x86_64', 256)
+        vm2 = VM('vm2', 'i386', 256)
+        vm3 = VM('vm3', 'aarch64', 256)
+        host1 = VMhost('host1', 'x86_64', 4096)
+        host2 = VMhost('host2', 'aarch64', 4096)
+        host3 = VMhost('host3', 'x86_64', 4096)
+        # The index exists before the new arch is registered.
+        index = VMPoolIndex()
+        vm3_id, host2_id = index.vm_ids['vm3'], index.vmhost_ids['host2']
+        self.assertFalse(index.vm_arch_ok(vm3_id, host2_id))
+
+        guest_archs_ok = VMPoolState.guest_archs_ok
+        new_archs_ok = dict(guest_archs_ok)
+        new_archs_ok['aarch64'] = { 'aarch64' : 1 }
+        VMPoolState.set_guest_archs_ok(new_archs_ok)
+        try:
+            placement = { 'host1' : [ vm1, vm2 ],
+                          'host2' : [ vm3 ],
+                          'host3' : [ ] }
+            state = VMPoolState().init_by_vmhosts(placement)
+            array_state = VMPoolArrayState(index).init_by_vmhosts(placement)
+            array_state.check_sane()
+            for vm in (vm1, vm2, vm3):
+                for vmhost in (host1, host2, host3):
+                    arch_ok = vm.arch in new_archs_ok[vmhost.arch]
+                    self.assertEqual(state.vm_arch_ok(vm, vmhost), arch_ok)
+                    self.assertEqual(
+                        index.vm_arch_ok(index.vm_ids[vm.name],
+                                         index.vmhost_ids[vmhost.name]),
+                        arch_ok)
+                    if state.get_vm_vmhost(vm.name) != vmhost.name:
+                        for s in (state, array_state):
+                            self.assertEqual(s.can_migrate(vm.name,
+                                                           vmhost.name),
+                                             arch_ok)
+            self.check_matrix(state)
+            self.check_matrix(array_state)
+        finally:
+            VMPoolState.set_guest_archs_ok(guest_archs_ok)
+        self.assertFalse(index.vm_arch_ok(vm3_id, host2_id))
+
+    def check_matrix(self, state, *args):
+        vm_names, vmhost_names, matrix = \
+            state.feasible_migrations_matrix(*args)
+        for i, vm_name in enumerate(vm_names):
+            for j, vmhost_name in enumerate(vmhost_names):
+                self.assertEqual(bool(matrix[i][j]),
+                                 state.can_migrate(vm_name, vmhost_name),
+                                 "%s to %s" % (vm_name, vmhost_name))
+
+class TestCandidateOrder(PoolTestCase):
+    """Checks that the sorted indexes used to order displacement
+    candidates by cost and fit are kept up to date.
+    """
+    def test_sorted_indexes(self):
+        state, sB, expected_path = self.fixed_case('tricky')
+        for vmhost_name in state.vmhost_names():
+            state.vmhost_vms_by_cost(vmhost_name)
+        state.vmhosts_by_free_RAM()
+
+        for vm_name in sorted(state.vm_names()):
+            for vmhost_name in sorted(state.vmhost_names()):
+                if not state.can_migrate(vm_name, vmhost_name):
+                    continue
+                new_state = state.migrate(vm_name, vmhost_name)
+                self.assertEqual(new_state.vmhosts_by_free_RAM(),
+                                 sorted([ (new_state.free_RAM(name), name)
+                                          for name in new_state.vmhost_names() ]))
+                for name in new_state.vmhost_names():
+                    self.assertEqual(new_state.vmhost_vms_by_cost(name),
+                                     sorted([ (VM.vms[vm].ram, vm) for vm in
+                                              new_state.get_vmhost_vms(name) ]))
+
+        # The per-host lists are rebuilt when the cost model changes.
+        live = LiveMigrationCostModel()
+        VMmigration.set_cost_model(live)
+        try:
+            for name in state.vmhost_names():
+                vmhost = VMhost.vmhosts[name]
+                self.assertEqual(state.vmhost_vms_by_cost(name),
+                                 sorted([ (live.lower_bound(VM.vms[vm], vmhost),
+                                           vm) for vm in
+                                          state.get_vmhost_vms(name) ]))
+        finally:
+            VMmigration.set_cost_model(CostModel())
+
+class TestArrayStates(PoolTestCase):
+    """Checks the bookkeeping of VMPoolArrayState."""
+
+    def test_guest_index(self):
+        # The guests of each VM host stay right in every state along
+        # a random walk, even though the index is shared with clones.
+        rng = random.Random(1)
+        random.seed(1)
+        state, stateB, expected_path = testcases.random.identical_hosts(6, 20)
+        array_state = to_array_state(state)
+        pairs = [ ]
+        for i in xrange(50):
+            pairs.append((state, array_state))
+            for name in array_state.vmhost_names():
+                self.assertEqual(sorted(array_state.get_vmhost_vms(name)),
+                                 sorted(state.get_vmhost_vms(name)))
+            vm_name, vmhost_name = rng.choice(state.feasible_migrations())
+            state = state.migrate(vm_name, vmhost_name)
+            array_state = array_state.migrate(vm_name, vmhost_name)
+        # Changing a state in place doesn't affect its clones.
+        clone = array_state.clone()
+        vm_name = clone.vm_names()[0]
+        vmhost_name = clone.get_vm_vmhost(vm_name)
+        array_state.remove_vm(vm_name)
+        self.assertIn(vm_name, clone.get_vmhost_vms(vmhost_name))
+        self.assertNotIn(vm_name, array_state.get_vmhost_vms(vmhost_name))
+        array_state.add_vm(vm_name, vmhost_name)
+
+        for state, array_state in pairs:
+            for name in array_state.vmhost_names():
+                self.assertEqual(sorted(array_state.get_vmhost_vms(name)),
+                                 sorted(state.get_vmhost_vms(name)))
+
+    def test_unplaced_vm(self):
+        sA, sB, expected_path = self.fixed_case('simple_swap')
+        state = to_array_state(sA)
+        vm_name = state.vm_names()[0]
+        vmhost_name = state.get_vm_vmhost(vm_name)
+        state = state.shutdown_vm(vm_name)
+        self.assertRaises(RuntimeError, state.migrate, vm_name, vmhost_name)
+
+class TestCompression(PathChecks, PoolTestCase):
+    """Checks that redundant migrations are removed from paths."""
+
+    def test_redundant_migrations(self):
+        vmhosts = testcases.utils.create_vmhosts(3, 'x86_64', 4096, 256)
+        vm1 = VM('vm1', 'x86_64', 1000)
+        vm2 = VM('vm2', 'x86_64', 1000)
+        vm3 = VM('vm3', 'x86_64', 2500)
+        sA = VMPoolState().init_by_vmhosts({ 'host1' : [ vm1, vm2 ],
+                                             'host2' : [ vm3 ],
+                                             'host3' : [ ] })
+        sB = VMPoolState().init_by_vmhosts({ 'host1' : [ vm2, vm3 ],
+                                             'host2' : [ ],
+                                             'host3' : [ vm1 ] })
+        path = VMPoolPath(sA, sB)
+        path.compare_endpoints()
+        path.set_migration_sequence([
+            VMmigration('vm1', 'host1', 'host2'),
+            # vm2 goes away and comes back for no reason.
+            VMmigration('vm2', 'host1', 'host3'),
+            VMmigration('vm3', 'host2', 'host1'),
+            VMmigration('vm2', 'host3', 'host1'),
+            # vm1 can't stay on host1 until now, since vm3 needs the
+            # room, but it can go straight to host3 in the first place.
+            VMmigration('vm1', 'host2', 'host3'),
+        ])
+        self.check_valid(path)
+
+        compressor = PathCompressor()
+        compressor.compress(path)
+        self.check_valid(path)
+        self.assertEqual([ str(migration)
+                           for migration in path.migration_sequence ],
+                         [ str(VMmigration('vm1', 'host1', 'host3')),
+                           str(VMmigration('vm3', 'host2', 'host1')) ])
+        self.assertEqual(compressor.migrations_removed, 3)
+        self.assertEqual(path.cost, 3500)
+
+class TestImprovement(PathChecks, PoolTestCase):
+    """Checks that improving paths re-solves windows of them more
+    cheaply.
+    """
+    def test_random_pool(self):
+        # VMPoolAdamPathFinder's path for this pool can't be shortened
+        # by PathCompressor, but some of its windows can be re-solved
+        # more cheaply.
+        random.seed(4)
+        sA, sB, expected_path = testcases.random.identical_hosts(6, 15)
+        path = VMPoolAdamPathFinder(sA, sB, debug_level=0).find_path()
+        cost = path.cost
+        improver = PathImprover(time_limit=60)
+        improver.improve(path)
+        self.check_valid(path)
+        self.assertLess(path.cost, cost)
+        self.assertGreater(improver.windows_improved, 0)
+
+    def test_identity_window(self):
+        # Each of host1 to host3 only has room for one of vm1 and vm2,
+        # which are swapped and then swapped back, so the first six
+        # migrations can be replaced by none at all.
+        testcases.utils.create_vmhosts(5, 'x86_64', 4096, 256)
+        vm1 = VM('vm1', 'x86_64', 2000)
+        vm2 = VM('vm2', 'x86_64', 2000)
+        vm3 = VM('vm3', 'x86_64', 256)
+        vm4 = VM('vm4', 'x86_64', 256)
+        sA = VMPoolState().init_by_vmhosts({ 'host1' : [ vm1 ],
+                                             'host2' : [ vm2 ],
+                                             'host3' : [ ],
+                                             'host4' : [ vm3, vm4 ],
+                                             'host5' : [ ] })
+        sB = VMPoolState().init_by_vmhosts({ 'host1' : [ vm1 ],
+                                             'host2' : [ vm2 ],
+                                             'host3' : [ ],
+                                             'host4' : [ ],
+                                             'host5' : [ vm3, vm4 ] })
+        path = VMPoolPath(sA, sB)
+        path.compare_endpoints()
+        path.set_migration_sequence([
+            VMmigration('vm1', 'host1', 'host3'),
+            VMmigration('vm2', 'host2', 'host1'),
+            VMmigration('vm1', 'host3', 'host2'),
+            VMmigration('vm2', 'host1', 'host3'),
+            VMmigration('vm1', 'host2', 'host1'),
+            VMmigration('vm2', 'host3', 'host2'),
+            VMmigration('vm3', 'host4', 'host5'),
+            VMmigration('vm4', 'host4', 'host5'),
+        ])
+        path.set_cost(sum([ migration.cost()
+                            for migration in path.migration_sequence ]))
+        self.check_valid(path)
+
+        improver = PathImprover(time_limit=60, min_window=6, max_window=6)
+        improver.improve(path)
+        self.check_valid(path)
+        self.assertEqual([ str(migration)
+                           for migration in path.migration_sequence ],
+                         [ str(VMmigration('vm3', 'host4', 'host5')),
+                           str(VMmigration('vm4', 'host4', 'host5')) ])
+        self.assertEqual(path.cost, 512)
+
+class TestCostModels(FixedCaseTestCase):
+    """Checks that A* still finds optimal paths under the live
+    migration cost model, with a mixture of NIC bandwidths and dirty
+    page rates, i.e. that its heuristic is still admissible.
+    """
+    cases = SHORTEST_PATH_CASES
+
+    def setUp(self):
+        PoolTestCase.setUp(self)
+        VMmigration.set_cost_model(LiveMigrationCostModel())
+
+    def tearDown(self):
+        VMmigration.set_cost_model(CostModel())
+
+    def run_test(self, sA, sB, expected_path):
+        for i, vmhost_name in enumerate(sorted(VMhost.vmhosts.keys())):
+            VMhost.vmhosts[vmhost_name].bandwidth = (125.0, 1250.0)[i % 2]
+        for i, vm_name in enumerate(sorted(VM.vms.keys())):
+            VM.vms[vm_name].dirty_rate = (0.0, 50.0, 200.0)[i % 3]
+        VMmigration.cost_model.precompute()
+
+        dijkstra_path = VMPoolShortestPathFinder(sA, sB,
+                                                 debug_level=0).find_path()
+        path = VMPoolAStarPathFinder(sA, sB, debug_level=0).find_path()
+        if dijkstra_path is None:
+            self.assertIsNone(path)
+            return
+        self.assertEqual(path.cost, dijkstra_path.cost, path.dump())
+
+        # Without concurrency on any NIC, each wave takes as long as
+        # its most costly migration.
+        WaveScheduler(1, 1).schedule(path)
+        self.assertLessEqual(path.makespan(), path.cost)
+
+    def test_best_fit_default(self):
+        # Displacement candidates are ordered by cost and fit unless
+        # the cost model is just RAM.
+        sA, sB, expected_path = self.fixed_case('simple_swap')
+        path_finder = VMPoolAdamPathFinder(sA, sB, debug_level=0)
+        self.assertTrue(path_finder.best_fit_candidates)
+        VMmigration.set_cost_model(CostModel())
+        path_finder = VMPoolAdamPathFinder(sA, sB, debug_level=0)
+        self.assertFalse(path_finder.best_fit_candidates)
+
+    def test_integer_bandwidths(self):
+        VM('vm1', 'x86_64', 512)
+        VM('vm2', 'x86_64', 512)
+        for name in ('host1', 'host2', 'host3'):
+            VMhost(name, 'x86_64', 4096, bandwidth=1)
+        model = VMmigration.cost_model
+        wave = [ VMmigration('vm1', 'host1', 'host3'),
+                 VMmigration('vm2', 'host2', 'host3') ]
+        # The two migrations share host3's NIC, so each gets half of it.
+        self.assertEqual(model.wave_duration(wave),
+                         2 * model.cost(VM.vms['vm1'], VMhost.vmhosts['host1'],
+                                        VMhost.vmhosts['host3']))
+
+        # The cost table has to be cleared when VMs change.
+        cost = wave[0].cost()
+        VM.vms['vm1'].dirty_rate = 0.5
+        self.assertEqual(wave[0].cost(), cost)
+        model.clear()
+        self.assertGreater(wave[0].cost(), cost)
+
+    def test_migration_ordering(self):
+        VM('vm1', 'x86_64', 512)
+        VM('vm2', 'x86_64', 512)
+        VMhost('host1', 'x86_64', 4096)
+        VMhost('host2', 'x86_64', 4096)
+        VMmigration.set_cost_model(CostModel())
+        a = VMmigration('vm1', 'host1', 'host2')
+        b = VMmigration('vm2', 'host1', 'host2')
+        self.assertEqual(a, VMmigration('vm1', 'host1', 'host2'))
+        self.assertNotEqual(a, b)
+        self.assertLess(a, b)
+        self.assertEqual(len(set([ a, b, VMmigration('vm1', 'host1', 'host2') ])),
+                         2)
+
+class TestBudgets(PoolTestCase):
+    """Checks that the path finders give up cleanly when they run out
+    of budget or are cancelled, and report a valid partial path.
+    """
+    def check_gives_up(self, path_finder, reason, **budgets):
+        self.assertIsNone(path_finder.find_path(**budgets))
+        status = path_finder.status
+        self.assertEqual(status.reason, reason)
+        self.assertTrue(status.exhausted())
+
+        state = path_finder.path.state_post_initial_shutdowns
+        for migration in status.migrations:
+            state = state.check_migration_sane(migration.vm.name,
+                                               migration.to_host)
+        self.assertEqual(status.vms_placed, path_finder.vms_placed(state))
+        self.assertLess(status.vms_placed, status.vms_to_place)
+        return status
+
+    def test_budgets(self):
+        sA, sB, expected_path = self.fixed_case('chain6')
+
+        for finder_class in (VMPoolShortestPathFinder, VMPoolAStarPathFinder,
+                             VMPoolBidirectionalPathFinder):
+            status = self.check_gives_up(finder_class(sA, sB, debug_level=0),
+                                         'node limit', max_nodes=100)
+            self.assertEqual(status.nodes_expanded, 100)
+            status = self.check_gives_up(finder_class(sA, sB, debug_level=0),
+                                         'state limit', max_states=100)
+            self.assertGreaterEqual(status.resident_states, 100)
+            self.check_gives_up(finder_class(sA, sB, debug_level=0),
+                                'deadline', deadline=0)
+
+        # The parallel finder reports the best partial path found by
+        # any of its workers.
+        path_finder = VMPoolParallelAdamPathFinder(sA, sB, debug_level=0)
+        path_finder.processes = 2
+        status = self.check_gives_up(path_finder, 'node limit', max_nodes=20)
+        self.assertGreater(status.vms_placed, 0)
+
+        sA, sB = testcases.utils.displacement_chain(100)
+        for finder_class in (VMPoolAdamPathFinder, VMPoolAnytimeAdamPathFinder):
+            status = self.check_gives_up(finder_class(sA, sB, debug_level=0),
+                                         'node limit', max_nodes=100)
+            self.assertEqual(status.nodes_expanded, 100)
+            status = self.check_gives_up(finder_class(sA, sB, debug_level=0),
+                                         'node limit', max_nodes=1)
+            self.assertEqual(status.nodes_expanded, 1)
+            status = self.check_gives_up(finder_class(sA, sB, debug_level=0),
+                                         'state limit', max_states=10)
+            self.assertEqual(status.resident_states, 10)
+            self.check_gives_up(finder_class(sA, sB, debug_level=0),
+                                'deadline', deadline=0)
+
+        # The parallel finder shares its budgets with its workers.
+        path_finder = VMPoolParallelAdamPathFinder(sA, sB, debug_level=0)
+        path_finder.processes = 2
+        status = self.check_gives_up(path_finder, 'node limit', max_nodes=1)
+        self.assertGreaterEqual(status.nodes_expanded, 1)
+        path_finder = VMPoolParallelAdamPathFinder(sA, sB, debug_level=0)
+        path_finder.processes = 2
+        self.check_gives_up(path_finder, 'deadline', deadline=0)
+
+        # Cancelling the search from the progress callback stops it
+        # at the next check.
+        for finder_class in (VMPoolAdamPathFinder, VMPoolShortestPathFinder):
+            token = CancellationToken()
+            reports = [ ]
+            def progress(report):
+                reports.append(report)
+                token.cancel()
+            path_finder = finder_class(sA, sB, debug_level=0,
+                                       progress_callback=progress,
+                                       cancel_token=token)
+            path_finder.progress_interval = 0
+            self.check_gives_up(path_finder, 'cancelled')
+            self.assertEqual(len(reports), 1)
+            self.assertGreater(reports[0].vms_to_migrate, 0)
+            self.assertIsNotNone(reports[0].depth)
+
+        # Budgets which aren't exhausted make no difference.
+        expected_path = VMPoolAdamPathFinder(sA, sB, debug_level=0).find_path()
+        path_finder = VMPoolAdamPathFinder(sA, sB)
+        path = path_finder.find_path(max_nodes=10000, max_states=10000)
+        self.assertMultiLineEqual(path.dump(), expected_path.dump())
+        self.assertEqual(path_finder.status.reason, 'found')
+
+TestPathDiscovery.add_case_tests()
+TestAdamPaths.add_case_tests()
+TestShortestPaths.add_case_tests()
+TestCostModels.add_case_tests()
+TestFeasibleMigrations.add_case_tests()
 
 unittest.main()
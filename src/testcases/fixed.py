@@ -110,8 +110,8 @@ def case_complex_pair_swap():
     expected_path = """\
         shutdown: 
         ! vm1: host2 -> host1  cost 1645
-        ! vm3: host1 -> host2  cost 459
         ! vm4: host1 -> host2  cost 222
+        ! vm3: host1 -> host2  cost 459
         ! vm2: host2 -> host1  cost 2049
         provision: 
     """
@@ -2,6 +2,7 @@
 
 from vm import VM
 from vmhost import VMhost
+from vmpoolstate import VMPoolState
 
 def create_vmhosts(count, arch, ram, dom0_ram=None):
     width = len(str(count))
@@ -18,3 +19,22 @@ def create_vms(count, arch, ram):
         vm = VM("vm{0:0{1}}".format(i+1, width), arch, ram)
         vms.append(vm)
     return vms
+
+def displacement_chain(length):
+    """Returns initial and final states for length full VM hosts plus
+    one empty one, where every VM has to move along to the next VM
+    host.  Migrating the first VM requires a chain of length nested
+    displacements.
+    """
+    VM.reset()
+    VMhost.reset()
+    vmhosts = create_vmhosts(length + 1, 'x86_64', 1256)
+    vms = create_vms(length, 'x86_64', 1000)
+    initial, final = VMPoolState(), VMPoolState()
+    for vmhost in vmhosts:
+        initial.init_vmhost(vmhost.name)
+        final.init_vmhost(vmhost.name)
+    for i, vm in enumerate(vms):
+        initial.add_vm(vm.name, vmhosts[i].name)
+        final.add_vm(vm.name, vmhosts[i + 1].name)
+    return initial, final
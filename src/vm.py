@@ -3,11 +3,14 @@
 class VM:
     vms = { }
 
-    def __init__(self, name, arch, ram):
+    def __init__(self, name, arch, ram, dirty_rate=None):
         assert type(name) is str
         self.name = name
         self.arch = arch
         self.ram = ram
+        # Rate in MB/s at which the VM dirties its RAM, for
+        # LiveMigrationCostModel.
+        self.dirty_rate = dirty_rate
         if name in VM.vms:
             raise RuntimeError, "vm %s already initialised" % name
         VM.vms[name] = self
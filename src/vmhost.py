@@ -3,7 +3,7 @@
 class VMhost:
     vmhosts = { }
 
-    def __init__(self, name, arch, ram, dom0_ram=None):
+    def __init__(self, name, arch, ram, dom0_ram=None, bandwidth=None):
         if dom0_ram is None:
             dom0_ram = 256
         assert type(name) is str
@@ -11,6 +11,9 @@ class VMhost:
         self.arch = arch
         self.ram = ram
         self.dom0_ram = dom0_ram
+        # Bandwidth in MB/s of the NIC used for migrations, for
+        # LiveMigrationCostModel.
+        self.bandwidth = bandwidth
         if name in VMhost.vmhosts:
             raise RuntimeError, "vmhost %s already initialised" % name
         VMhost.vmhosts[name] = self
@@ -1,9 +1,20 @@
 #!/usr/bin/python
 
+from costmodel import CostModel
 from vm import VM
 from vmhost import VMhost
 
 class VMmigration:
+    # Determines the cost of every migration; see set_cost_model().
+    cost_model = CostModel()
+
+    @classmethod
+    def set_cost_model(cls, cost_model):
+        """Replaces the model used to determine the cost of every
+        migration, e.g. with a LiveMigrationCostModel.
+        """
+        VMmigration.cost_model = cost_model
+
     def __init__(self, vm, from_host, to_host):
         self.vm        = self._get_vm(vm)
         self.from_host = self._get_vmhost(from_host)
@@ -34,11 +45,41 @@ class VMmigration:
         raise RuntimeError, "vmhost must be a VMhost object or string"
 
     def cost(self):
-        #return 1
-        return self.vm.ram
+        return self.cost_model.cost(self.vm, self.from_host, self.to_host)
+
+    def commutes_with(self, other):
+        """Returns True if this migration and the other one can be
+        performed in either order, with the same result and cost.
+        This is guaranteed if they migrate different VMs between
+        disjoint pairs of VM hosts, since then neither migration
+        changes the VM hosts which the other one depends on.
+        """
+        if self.vm == other.vm:
+            return False
+        hosts = (self.from_host, self.to_host)
+        return other.from_host not in hosts and other.to_host not in hosts
+
+    def _key(self):
+        return (self.vm.name, self.from_host.name, self.to_host.name)
+
+    def __eq__(self, other):
+        if isinstance(other, VMmigration):
+            return self._key() == other._key()
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __hash__(self):
+        return hash(self._key())
 
     def __cmp__(self, other):
-        return cmp(self.cost, other.cost)
+        # Order by cost, and then by name so that the order is
+        # consistent with __eq__().
+        return cmp((self.cost(), self._key()), (other.cost(), other._key()))
 
     def __str__(self):
         return "%s: %s -> %s (%d)" % \
@@ -0,0 +1,345 @@
+#!/usr/bin/python
+
+from array import array
+import bisect
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from vm import VM
+from vmhost import VMhost
+from vmpoolstate import VMPoolState, zobrist_key
+
+class VMPoolIndex:
+    """This class maps the names of a fixed inventory of VMs and VM
+    hosts to dense integer ids, and holds the properties of each VM
+    and VM host which are relevant to placement in compact typed
+    arrays indexed by those ids.  A single index is shared between
+    all the VMPoolArrayState instances derived from each other.
+
+    By default the inventory is taken from the VM.vms and
+    VMhost.vmhosts registries at the time of construction.  The arch
+    compatibility table is also captured at that point, and captured
+    again whenever it is replaced by VMPoolState.set_guest_archs_ok().
+    """
+
+    def __init__(self, vms=None, vmhosts=None):
+        if vms is None:
+            vms = VM.vms.values()
+        if vmhosts is None:
+            vmhosts = VMhost.vmhosts.values()
+
+        # Ids are allocated in the order in which the registries are
+        # iterated, so that the state iterates VMs and VM hosts in a
+        # similar order to VMPoolState.
+        self.vm_names = [ vm.name for vm in vms ]
+        self.vm_ids = dict((name, i) for i, name in enumerate(self.vm_names))
+
+        self.vmhost_names = [ vmhost.name for vmhost in vmhosts ]
+        self.vmhost_ids = \
+            dict((name, i) for i, name in enumerate(self.vmhost_names))
+        self.sorted_vmhost_ids = \
+            sorted(range(len(self.vmhost_names)),
+                   key=self.vmhost_names.__getitem__)
+
+        self.vm_ram  = array('l', [ VM.vms[name].ram for name in self.vm_names ])
+        self.vmhost_ram  = array('l', [ VMhost.vmhosts[name].ram
+                                        for name in self.vmhost_names ])
+        self.vmhost_dom0_ram = array('l', [ VMhost.vmhosts[name].dom0_ram
+                                            for name in self.vmhost_names ])
+
+        self.vm_arch_mask = array('L', [ 0 ]) * len(self.vm_names)
+        self.vmhost_arch_bit = array('L', [ 0 ]) * len(self.vmhost_names)
+        self.set_arch_masks()
+        VMPoolState._arch_indexes.add(self)
+
+    def set_arch_masks(self):
+        """Recomputes the arch bitmasks of the VMs and VM hosts from
+        the current arch compatibility table.  The arrays are updated
+        in place, since states may be viewing them via NumPy.
+        """
+        # Arch compatibility is precomputed as a bitmask per VM and a
+        # single bit per VM host (see VMPoolState.set_guest_archs_ok()),
+        # so a VM can be hosted by a VM host if the AND of the two is
+        # non-zero.  VM hosts with unrecognised archs get no bit.
+        self.vm_arch_mask[:] = array('L', [
+            VMPoolState.guest_arch_mask(VM.vms[name].arch)
+            for name in self.vm_names ])
+        self.vmhost_arch_bit[:] = array('L', [
+            VMPoolState.vmhost_arch_bits.get(VMhost.vmhosts[name].arch, 0)
+            for name in self.vmhost_names ])
+
+    def vm_arch_ok(self, vm_id, vmhost_id):
+        return (self.vm_arch_mask[vm_id] & self.vmhost_arch_bit[vmhost_id]) != 0
+
+class VMPoolArrayState(VMPoolState):
+    """Compact alternative to VMPoolState, for use with large
+    inventories.  Rather than nested dicts of names, the placement
+    is stored as an array mapping each VM id to the id of the VM host
+    it is on (or -1 if it isn't in the pool), together with an array
+    of the guest RAM used on each VM host.  The ids are allocated by
+    a VMPoolIndex shared by all states derived from each other, so
+    deriving a new state costs a couple of array copies and no
+    string hashing.
+
+    The guests of each VM host are indexed on first use by a single
+    scan of the placement array, and the index is then kept up to
+    date as VMs are added, removed and migrated.  Like the dicts of
+    guests in VMPoolState, the per-host lists of the index are shared
+    between a state and its clones until either changes that VM
+    host's guests.
+    """
+
+    def __init__(self, index=None):
+        if index is None:
+            index = VMPoolIndex()
+        self.index = index
+        self.placement = array('i', [ -1 ]) * len(index.vm_names)
+        self.guest_ram = array('l', [ 0 ]) * len(index.vmhost_names)
+        self.vmhost_present = bytearray(len(index.vmhost_names))
+        self._hash = 0
+        self._vms_by_cost = { }
+        self._vmhosts_by_free_RAM = None
+
+        # List mapping each VM host id to a list of the ids of its
+        # guests in ascending order, or None until it is first needed;
+        # see _guest_ids().  The ids of the VM hosts whose lists this
+        # state owns, rather than shares with a clone, are the keys of
+        # _owned_guests.
+        self._guests = None
+        self._owned_guests = { }
+
+    def vm_names(self):
+        names = self.index.vm_names
+        return [ names[vm_id]
+                 for vm_id, vmhost_id in enumerate(self.placement)
+                 if vmhost_id >= 0 ]
+
+    def vmhost_names(self):
+        names = self.index.vmhost_names
+        return [ names[vmhost_id]
+                 for vmhost_id, present in enumerate(self.vmhost_present)
+                 if present ]
+
+    def get_vm_vmhost(self, vm_name):
+        vmhost_id = self.placement[self.index.vm_ids[vm_name]]
+        if vmhost_id < 0:
+            raise KeyError, vm_name
+        return self.index.vmhost_names[vmhost_id]
+
+    def get_vmhost_vms(self, vmhost_name):
+        vmhost_id = self.index.vmhost_ids[vmhost_name]
+        if not self.vmhost_present[vmhost_id]:
+            raise KeyError, vmhost_name
+        names = self.index.vm_names
+        return [ names[vm_id] for vm_id in self._guest_ids(vmhost_id) ]
+
+    def _guest_ids(self, vmhost_id):
+        """Returns the ids of the guests of the given VM host, in
+        ascending order, first building the index of the guests of
+        every VM host in a single pass over the placement if need be.
+        The list may be shared with clones, so must not be modified.
+        """
+        if self._guests is None:
+            guests = [ [ ] for present in self.vmhost_present ]
+            for vm_id, on in enumerate(self.placement):
+                if on >= 0:
+                    guests[on].append(vm_id)
+            self._guests = guests
+            self._owned_guests = dict.fromkeys(xrange(len(guests)), True)
+        return self._guests[vmhost_id]
+
+    def _own_guest_ids(self, vmhost_id):
+        """Returns the list of ids of the guests of the given VM host
+        for in-place changes, first taking a private copy of it if it
+        is still shared with a clone.  Must only be called once the
+        index has been built.
+        """
+        guests = self._guests[vmhost_id]
+        if vmhost_id not in self._owned_guests:
+            guests = guests[:]
+            self._guests[vmhost_id] = guests
+            self._owned_guests[vmhost_id] = True
+        return guests
+
+    def _guest_moved(self, vm_id, from_id, to_id):
+        """Updates the index of guests, if it has been built, when a
+        VM moves from one VM host to another.  Either id may be -1,
+        when the VM is added to or removed from the pool.
+        """
+        if self._guests is None:
+            return
+        if from_id >= 0:
+            self._own_guest_ids(from_id).remove(vm_id)
+        if to_id >= 0:
+            bisect.insort(self._own_guest_ids(to_id), vm_id)
+
+    def _vmhosts_to_vms(self):
+        """Returns a list mapping each VM host id to a list of the
+        names of its guests.
+        """
+        names = self.index.vm_names
+        return [ [ names[vm_id] for vm_id in self._guest_ids(vmhost_id) ]
+                 for vmhost_id in xrange(len(self.vmhost_present)) ]
+
+    def init_vmhost(self, vmhost_name):
+        vmhost_id = self.index.vmhost_ids[vmhost_name]
+        if self.vmhost_present[vmhost_id]:
+            raise ValueError, "tried to init vmhost %s twice" % vmhost_name
+        self.vmhost_present[vmhost_id] = 1
+        self._hash ^= zobrist_key(vmhost_name)
+        self._vmhosts_by_free_RAM = None
+
+    def add_vm(self, vm_name, vmhost_name):
+        vm_id = self.index.vm_ids[vm_name]
+        vmhost_id = self.index.vmhost_ids[vmhost_name]
+        if self.placement[vm_id] >= 0:
+            raise ValueError, "tried to init vm %s twice" % vm_name
+        if not self.vmhost_present[vmhost_id]:
+            self.init_vmhost(vmhost_name)
+        self.placement[vm_id] = vmhost_id
+        self.guest_ram[vmhost_id] += self.index.vm_ram[vm_id]
+        self._hash ^= zobrist_key(vm_name, vmhost_name)
+        self._guest_moved(vm_id, -1, vmhost_id)
+        self._placement_changed(vmhost_name)
+
+    def remove_vm(self, vm_name):
+        vm_id = self.index.vm_ids.get(vm_name)
+        if vm_id is None or self.placement[vm_id] < 0:
+            raise KeyError, "VM %s not in pool" % vm_name
+        vmhost_id = self.placement[vm_id]
+        self.placement[vm_id] = -1
+        self.guest_ram[vmhost_id] -= self.index.vm_ram[vm_id]
+        self._guest_moved(vm_id, vmhost_id, -1)
+        self._hash ^= zobrist_key(vm_name, self.index.vmhost_names[vmhost_id])
+        self._placement_changed(self.index.vmhost_names[vmhost_id])
+
+    def clone(self):
+        new = VMPoolArrayState(self.index)
+        new.placement = self.placement[:]
+        new.guest_ram = self.guest_ram[:]
+        new.vmhost_present = self.vmhost_present[:]
+        new._hash = self._hash
+        new._vms_by_cost = self._vms_by_cost.copy()
+        new._vmhosts_by_free_RAM = self._vmhosts_by_free_RAM
+        if self._guests is not None:
+            new._guests = self._guests[:]
+            # Any list we currently own is now shared with the clone,
+            # so we have to give up ownership of it too.
+            self._owned_guests = { }
+        return new
+
+    __copy__ = clone
+
+    def migrate(self, vm_name, to_host):
+        index = self.index
+        if to_host not in index.vmhost_ids:
+            raise RuntimeError, "can't migrate %s to non-existent vmhost %s" % \
+                (vm_name, to_host)
+        vm_id = index.vm_ids[vm_name]
+        from_id = self.placement[vm_id]
+        if from_id < 0:
+            raise RuntimeError, "can't migrate %s which is not in the pool" % \
+                vm_name
+        to_id = index.vmhost_ids[to_host]
+        if from_id == to_id:
+            raise RuntimeError, "can't migrate %s from %s to same vmhost" % \
+                  (vm_name, to_host)
+
+        new = self.clone()
+        ram = index.vm_ram[vm_id]
+        new.placement[vm_id] = to_id
+        new.guest_ram[from_id] -= ram
+        new.guest_ram[to_id] += ram
+        new._guest_moved(vm_id, from_id, to_id)
+        new._hash ^= zobrist_key(vm_name, index.vmhost_names[from_id]) ^ \
+            zobrist_key(vm_name, to_host)
+        new._placement_changed(index.vmhost_names[from_id])
+        new._placement_changed(to_host)
+        return new
+
+    def can_migrate(self, vm_name, vmhost_name):
+        index = self.index
+        vm_id = index.vm_ids[vm_name]
+        vmhost_id = index.vmhost_ids[vmhost_name]
+        if self.placement[vm_id] == vmhost_id:
+            return False
+        if index.vm_ram[vm_id] > self._free_RAM(vmhost_id):
+            return False
+        return index.vm_arch_ok(vm_id, vmhost_id)
+
+    def feasible_migrations_matrix(self, vm_names=None, vmhost_names=None):
+        if numpy is None:
+            return VMPoolState.feasible_migrations_matrix(self, vm_names,
+                                                          vmhost_names)
+        if vm_names is None:
+            vm_names = self.vm_names()
+        if vmhost_names is None:
+            vmhost_names = self.vmhost_names()
+
+        index = self.index
+        vm_ids = numpy.array([ index.vm_ids[vm_name] for vm_name in vm_names ],
+                             dtype=int)
+        vmhost_ids = numpy.array([ index.vmhost_ids[vmhost_name]
+                                   for vmhost_name in vmhost_names ], dtype=int)
+
+        # The typed arrays can be viewed as NumPy arrays without copying.
+        vm_ram = numpy.frombuffer(index.vm_ram, dtype='l')[vm_ids]
+        free_ram = numpy.frombuffer(index.vmhost_ram, dtype='l') - \
+            numpy.frombuffer(index.vmhost_dom0_ram, dtype='l') - \
+            numpy.frombuffer(self.guest_ram, dtype='l')
+        matrix = vm_ram[:, numpy.newaxis] <= \
+            free_ram[vmhost_ids][numpy.newaxis, :]
+
+        vm_masks = numpy.frombuffer(index.vm_arch_mask, dtype='L')[vm_ids]
+        vmhost_bits = \
+            numpy.frombuffer(index.vmhost_arch_bit, dtype='L')[vmhost_ids]
+        matrix &= (vm_masks[:, numpy.newaxis] &
+                   vmhost_bits[numpy.newaxis, :]) != 0
+
+        placement = numpy.frombuffer(self.placement, dtype='i')[vm_ids]
+        matrix &= placement[:, numpy.newaxis] != vmhost_ids[numpy.newaxis, :]
+
+        return vm_names, vmhost_names, matrix
+
+    def total_guest_RAM(self, vmhost_name):
+        return self.guest_ram[self.index.vmhost_ids[vmhost_name]]
+
+    def free_RAM(self, vmhost_name):
+        return self._free_RAM(self.index.vmhost_ids[vmhost_name])
+
+    def _free_RAM(self, vmhost_id):
+        return self.index.vmhost_ram[vmhost_id] - \
+            self.index.vmhost_dom0_ram[vmhost_id] - \
+            self.guest_ram[vmhost_id]
+
+    def check_sane(self):
+        for vmhost_id, present in enumerate(self.vmhost_present):
+            if present and self._free_RAM(vmhost_id) < 0:
+                self.check_vmhost_sane(self.index.vmhost_names[vmhost_id])
+        for vm_id, vmhost_id in enumerate(self.placement):
+            if vmhost_id >= 0 and not self.index.vm_arch_ok(vm_id, vmhost_id):
+                self.check_vm_arch_sane(
+                    VM.vms[self.index.vm_names[vm_id]],
+                    VMhost.vmhosts[self.index.vmhost_names[vmhost_id]])
+
+    def unique(self):
+        vmhost_vms = self._vmhosts_to_vms()
+        vmhost_strs = [ ]
+        for vmhost_id in self.index.sorted_vmhost_ids:
+            if self.vmhost_present[vmhost_id]:
+                vm_names = sorted(vmhost_vms[vmhost_id])
+                vmhost_name = self.index.vmhost_names[vmhost_id]
+                vmhost_strs.append(vmhost_name + "[" + ' '.join(vm_names) + "]")
+        return " ".join(vmhost_strs)
+
+    __str__ = unique
+
+    def _same_placement(self, other):
+        if not isinstance(other, VMPoolArrayState) or \
+           other.index is not self.index:
+            return VMPoolState._same_placement(self, other)
+        return self.placement == other.placement and \
+            self.vmhost_present == other.vmhost_present
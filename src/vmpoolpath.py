@@ -5,6 +5,7 @@ import time
 
 from vm import VM
 from vmhost import VMhost
+from waves import makespan
 
 class VMPoolPath:
     """
@@ -21,27 +22,34 @@ class VMPoolPath:
         self.path = [ ]
         self.cost = 0
 
+        # Concurrent batches of the migration sequence, if scheduled
+        # (see WaveScheduler).
+        self.waves = None
+
     def compare_endpoints(self):
         """Figure out which VMs need to be shutdown first, which need
         to be migrated next, and finally which need to be provisioned
         at the end.
         """
+        initial_vms = set(self.initial_state.vm_names())
+        final_vms   = set(self.final_state.vm_names())
+
         self.vms_to_shutdown = { }
         self.vms_to_migrate  = { }
-        for start_vm in self.initial_state.vm_names():
-            if start_vm not in self.final_state.vm_names():
+        for start_vm in initial_vms:
+            if start_vm not in final_vms:
                 self.vms_to_shutdown[start_vm] = True
             else:
-                from_host = self.initial_state.vm2vmhost[start_vm]
-                to_host   = self.final_state.vm2vmhost[start_vm]
+                from_host = self.initial_state.get_vm_vmhost(start_vm)
+                to_host   = self.final_state.get_vm_vmhost(start_vm)
                 if from_host != to_host:
                     self.vms_to_migrate[start_vm] = True
 
         self.vms_to_provision = { }
-        for end_vm in self.final_state.vm_names():
-            if end_vm not in self.initial_state.vm_names():
+        for end_vm in final_vms:
+            if end_vm not in initial_vms:
                 self.vms_to_provision[end_vm] = \
-                    self.final_state.vm2vmhost[end_vm]
+                    self.final_state.get_vm_vmhost(end_vm)
 
         self.state_post_initial_shutdowns = self.do_initial_shutdowns()
         self.state_pre_final_provisions = self.reverse_final_provisions()
@@ -75,9 +83,25 @@ class VMPoolPath:
     def set_cost(self, cost):
         self.cost = cost
 
+    def set_waves(self, waves):
+        self.waves = waves
+
+    def makespan(self):
+        """Returns the time the migrations take in the units of
+        VMmigration.cost(), which is the cost of the path unless they
+        have been scheduled in concurrent waves.
+        """
+        if self.waves is None:
+            return self.cost
+        return makespan(self.waves)
+
     def summary(self):
-        return "Path found with %d migrations and cost %d" % \
+        s = "Path found with %d migrations and cost %d" % \
             (len(self.migration_sequence), self.cost)
+        if self.waves is not None:
+            s += " in %d waves with makespan %d" % \
+                (len(self.waves), self.makespan())
+        return s
 
     def report(self):
         print self.summary()
@@ -109,19 +133,32 @@ class VMPoolPath:
             current_state = current_state.migrate(migration.vm.name,
                                                   migration.to_host.name)
 
-    def dump(self, indent=''):
+    def dump(self, indent='', waves=False):
+        """Returns the path as a string.  If waves is True and the
+        path has been scheduled in waves, the migrations are grouped
+        by wave.
+        """
         s = ''
         s += "%sshutdown: %s\n" % \
             (indent, ", ".join(sorted(self.vms_to_shutdown)))
-        for migration in self.migration_sequence:
-            s += "%s! %s: %s -> %s  cost %d\n" % \
-                (indent,
-                 migration.vm.name, migration.from_host.name,
-                 migration.to_host.name, migration.cost())
+        if waves and self.waves is not None:
+            for i, wave in enumerate(self.waves):
+                s += "%swave %d:\n" % (indent, i + 1)
+                for migration in wave:
+                    s += self._dump_migration(indent + '  ', migration)
+        else:
+            for migration in self.migration_sequence:
+                s += self._dump_migration(indent, migration)
         s += "%sprovision: %s\n" % \
             (indent, ", ".join(sorted(self.vms_to_provision)))
         return s
 
+    def _dump_migration(self, indent, migration):
+        return "%s! %s: %s -> %s  cost %d\n" % \
+            (indent,
+             migration.vm.name, migration.from_host.name,
+             migration.to_host.name, migration.cost())
+
     def __str__(self):
         return self.dump()
 
@@ -182,7 +219,12 @@ class VMPoolPath:
 
         return s
 
-    def animate(self, clear_screen, sleep=0, start_sleep=1.0, end_sleep=2.0):
+    def animate(self, clear_screen, sleep=0, start_sleep=1.0, end_sleep=2.0,
+                waves=False):
+        """Animates the path on the terminal.  If waves is True and
+        the path has been scheduled in waves, each step performs a
+        whole wave of migrations.
+        """
         if clear_screen:
             os.system("clear")
 
@@ -194,7 +236,7 @@ class VMPoolPath:
         print self.challenge_visualization(host_width, meter_width)
 
         print self.summary() + ":\n"
-        print self.dump()
+        print self.dump(waves=waves)
         time.sleep(start_sleep)
 
         if self.vms_to_shutdown:
@@ -224,13 +266,21 @@ class VMPoolPath:
                 highlight_vms = highlights['after'])
             print "Shutdown complete."
 
+        # Each step of the migration phase performs either a single
+        # migration, or a whole wave of them.
+        if waves and self.waves is not None:
+            steps = self.waves
+        else:
+            steps = [ [ migration ] for migration in self.migration_sequence ]
+
         current_state = self.state_post_initial_shutdowns
-        for migration in self.migration_sequence:
+        for i, step in enumerate(steps):
             self.next_screen(clear_screen, sleep)
 
             print "Migration phase\n"
             print "Current state:\n"
-            highlight = { migration.vm.name : ('yellow', 'on_cyan') }
+            highlight = { migration.vm.name : ('yellow', 'on_cyan')
+                          for migration in step }
             print current_state.ascii_meters(
                 host_width, meter_width,
                 highlight_vms = highlight)
@@ -238,16 +288,18 @@ class VMPoolPath:
             print self.final_state.ascii_meters(
                 host_width, meter_width,
                 highlight_vms = highlights['after'])
-            print "%s: %s -> %s  cost %d" % \
-                (migration.vm.name, migration.from_host.name,
-                 migration.to_host.name, migration.cost())
+            for migration in step:
+                print "%s: %s -> %s  cost %d" % \
+                    (migration.vm.name, migration.from_host.name,
+                     migration.to_host.name, migration.cost())
 
             self.next_screen(clear_screen, sleep)
 
             print "Migration phase\n"
             print "Current state:\n"
-            current_state = current_state.migrate(migration.vm.name,
-                                                  migration.to_host.name)
+            for migration in step:
+                current_state = current_state.migrate(migration.vm.name,
+                                                      migration.to_host.name)
             print current_state.ascii_meters(
                 host_width, meter_width,
                 highlight_vms = highlight)
@@ -255,8 +307,11 @@ class VMPoolPath:
             print self.final_state.ascii_meters(
                 host_width, meter_width,
                 highlight_vms = highlights['after'])
-            print "Migration of %s to %s complete." % \
-                (migration.vm.name, migration.to_host.name)
+            if len(step) == 1:
+                print "Migration of %s to %s complete." % \
+                    (step[0].vm.name, step[0].to_host.name)
+            else:
+                print "Wave %d of %d complete." % (i + 1, len(steps))
 
         if self.vms_to_provision:
             self.next_screen(clear_screen, sleep)
@@ -286,5 +341,5 @@ class VMPoolPath:
             print "Provisioning complete.\n"
 
         print self.summary() + ":\n"
-        print self.dump()
+        print self.dump(waves=waves)
         time.sleep(end_sleep)
@@ -1,32 +1,126 @@
 #!/usr/bin/python
 
-from copy import deepcopy
+import hashlib
 import os
+import struct
 import sys
+import weakref
 
 from termcolor import colored
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from types import *
 from vm import VM
 from vmhost import VMhost
+from vmmigration import VMmigration
 from vmpoolstateerrors import *
 
+_zobrist_keys = { }
+
+def zobrist_key(*names):
+    """Returns a pseudo-random signed 64-bit key for the given tuple of
+    names, for use in incremental (Zobrist) hashing of pool states.
+    The keys are derived from the names themselves rather than from a
+    random number generator, so that they are the same in every
+    process.
+    """
+    key = _zobrist_keys.get(names)
+    if key is None:
+        digest = hashlib.md5('\0'.join(names)).digest()
+        key = _zobrist_keys[names] = struct.unpack('<q', digest[:8])[0]
+    return key
+
 class VMPoolState:
     """This class represents a pool of VMs and VM hosts together with
     a particular placement of the VMs across the VM hosts.
     """
 
     # Define which guest VM architectures can be hosted by which VM
-    # host architectures.
+    # host architectures.  This should only be changed via
+    # set_guest_archs_ok(), so that the bitmasks derived from it are
+    # kept in sync.
     guest_archs_ok = {
         'i386'   : { 'i386' : 1 },
         'x86_64' : { 'i386' : 1, 'x86_64' : 1 },
         }
 
+    # Bitmask representation of guest_archs_ok, which allows arch
+    # compatibility to be checked via a single bitwise AND:
+    #
+    # vmhost_arch_bits
+    #     maps each VM host arch to a unique bit
+    # guest_arch_masks
+    #     maps each guest arch to the OR of the bits of all the VM
+    #     host archs which can host it
+    vmhost_arch_bits = { }
+    guest_arch_masks = { }
+
+    # VMPoolIndex instances holding copies of the bitmasks, which
+    # set_guest_archs_ok() has to recompute.
+    _arch_indexes = weakref.WeakSet()
+
+    @classmethod
+    def set_guest_archs_ok(cls, guest_archs_ok):
+        """Replaces the table of which guest VM architectures can be
+        hosted by which VM host architectures, e.g. to add aarch64 or
+        ppc64le, and precomputes the corresponding bitmasks, including
+        those of any existing VMPoolIndex instances.
+        """
+        vmhost_arch_bits = { }
+        guest_arch_masks = { }
+        for vmhost_arch in sorted(guest_archs_ok):
+            bit = vmhost_arch_bits[vmhost_arch] = 1 << len(vmhost_arch_bits)
+            for guest_arch in guest_archs_ok[vmhost_arch]:
+                guest_arch_masks[guest_arch] = \
+                    guest_arch_masks.get(guest_arch, 0) | bit
+
+        VMPoolState.guest_archs_ok = guest_archs_ok
+        VMPoolState.vmhost_arch_bits = vmhost_arch_bits
+        VMPoolState.guest_arch_masks = guest_arch_masks
+        for index in list(VMPoolState._arch_indexes):
+            index.set_arch_masks()
+
+    @classmethod
+    def vmhost_arch_bit(cls, arch):
+        bit = VMPoolState.vmhost_arch_bits.get(arch)
+        if bit is None:
+            raise RuntimeError, "unrecognised vmhost arch %s" % arch
+        return bit
+
+    @classmethod
+    def guest_arch_mask(cls, arch):
+        return VMPoolState.guest_arch_masks.get(arch, 0)
+
     def __init__(self):
         self.vm2vmhost = { }
         self.vmhost2vms = { }
 
+        # Running total of the RAM used by the guests on each VM
+        # host, kept up to date by add_vm() and remove_vm() so that
+        # sanity checks don't have to keep summing it up.
+        self.vmhost_guest_RAM = { }
+
+        # Names of VM hosts whose dict of guests belongs exclusively
+        # to this instance, as opposed to being shared with the state
+        # this one was cloned from.  See clone().
+        self._owned_vmhosts = { }
+
+        # Incremental hash of the placement: the XOR of the Zobrist
+        # keys of every VM host and every (VM, VM host) pair in the
+        # pool.  This is updated in constant time on each change.
+        self._hash = 0
+
+        # Sorted indexes which are built lazily, on first use by
+        # vmhost_vms_by_cost() and vmhosts_by_free_RAM(), and discarded
+        # when the placement changes.  The per-host lists are shared
+        # with clones until the VM host's guests change.
+        self._vms_by_cost = { }
+        self._vmhosts_by_free_RAM = None
+
     def vms(self):
         """Returns a list of VMs in this state."""
         return [ VM.vms[name] for name in self.vm_names() ]
@@ -47,11 +141,19 @@ class VMPoolState:
         """Returns the host for a given VM in this state."""
         return self.vm2vmhost[vm_name]
 
+    def get_vmhost_vms(self, vmhost_name):
+        """Returns a list of names of VMs on a given host in this state."""
+        return self.vmhost2vms[vmhost_name].keys()
+
     def init_vmhost(self, vmhost_name):
         """Adds a new vmhost to the pool by name."""
         if vmhost_name in self.vmhost2vms:
             raise ValueError, "tried to init vmhost %s twice" % vmhost_name
         self.vmhost2vms[vmhost_name] = { }
+        self.vmhost_guest_RAM[vmhost_name] = 0
+        self._owned_vmhosts[vmhost_name] = True
+        self._hash ^= zobrist_key(vmhost_name)
+        self._vmhosts_by_free_RAM = None
 
     def init_by_vmhosts(self, state):
         """Adds multiple VMs and VM hosts in one go, changing the
@@ -76,7 +178,10 @@ class VMPoolState:
         self.vm2vmhost[vm_name] = vmhost_name
         if vmhost_name not in self.vmhost2vms:
             self.init_vmhost(vmhost_name)
-        self.vmhost2vms[vmhost_name][vm_name] = 1
+        self._own_vmhost(vmhost_name)[vm_name] = 1
+        self.vmhost_guest_RAM[vmhost_name] += VM.vms[vm_name].ram
+        self._hash ^= zobrist_key(vm_name, vmhost_name)
+        self._placement_changed(vmhost_name)
 
     def remove_vm(self, vm_name):
         """Remove a VM (by name) from its current VM host.
@@ -87,31 +192,69 @@ class VMPoolState:
         vmhost_name = self.vm2vmhost[vm_name]
         if vmhost_name not in self.vmhost2vms:
             raise RuntimeError, "BUG: no such vmhost %s" % vmhost_name
-        del self.vmhost2vms[vmhost_name][vm_name]
+        del self._own_vmhost(vmhost_name)[vm_name]
         del self.vm2vmhost[vm_name]
+        self.vmhost_guest_RAM[vmhost_name] -= VM.vms[vm_name].ram
+        self._hash ^= zobrist_key(vm_name, vmhost_name)
+        self._placement_changed(vmhost_name)
+
+    def _placement_changed(self, vmhost_name):
+        """Discards the sorted indexes affected by a change to the
+        guests of the given VM host.
+        """
+        if vmhost_name in self._vms_by_cost:
+            del self._vms_by_cost[vmhost_name]
+        self._vmhosts_by_free_RAM = None
+
+    def _own_vmhost(self, vmhost_name):
+        """Returns the dict of guests on the given VM host, first
+        taking a private copy of it if it is still shared with the
+        state this one was cloned from.  This must be called before
+        any in-place change to a VM host's guests.
+        """
+        vms = self.vmhost2vms[vmhost_name]
+        if vmhost_name not in self._owned_vmhosts:
+            vms = vms.copy()
+            self.vmhost2vms[vmhost_name] = vms
+            self._owned_vmhosts[vmhost_name] = True
+        return vms
 
     def provision_vm(self, vm_name, vmhost_name):
         """Provision VM (by name) to a VM host (by name).
         Returns the new state.
         """
-        new = deepcopy(self)
+        new = self.clone()
         new.add_vm(vm_name, vmhost_name)
         return new
 
     def shutdown_vm(self, vm_name):
         """Shuts down VM (by name).  Returns the new state."""
-        new = deepcopy(self)
+        new = self.clone()
         new.remove_vm(vm_name)
         return new
 
-# use copy.deepcopy instead
-#     def clone(self):
-#         new = VMPoolState()
-#         new.vm2vmhost  = self.vm2vmhost.copy()
-#         new.vmhost2vms = { }
-#         for vmhost, vms in self.vmhost2vms.iteritems():
-#             new.vmhost2vms[vmhost] = vms.copy()
-#         return new
+    def clone(self):
+        """Returns a copy-on-write copy of this state.  The per-host
+        dicts of guests are shared between the two instances until
+        either of them changes a VM host's guests, at which point
+        that instance takes a private copy of that VM host's dict
+        only.  This means that deriving a new state from an existing
+        one only copies the top-level mappings, rather than the guests
+        of every VM host in the pool.
+        """
+        new = self.__class__()
+        new.vm2vmhost  = self.vm2vmhost.copy()
+        new.vmhost2vms = self.vmhost2vms.copy()
+        new.vmhost_guest_RAM = self.vmhost_guest_RAM.copy()
+        new._hash = self._hash
+        new._vms_by_cost = self._vms_by_cost.copy()
+        new._vmhosts_by_free_RAM = self._vmhosts_by_free_RAM
+        # Any dict we currently own is now shared with the clone, so
+        # we have to give up ownership of it too.
+        self._owned_vmhosts = { }
+        return new
+
+    __copy__ = clone
 
     def migrate(self, vm_name, to_host):
         """Generate a new instance representing the state after
@@ -121,13 +264,12 @@ class VMPoolState:
         if to_host not in VMhost.vmhosts:
             raise RuntimeError, "can't migrate %s to non-existent vmhost %s" % \
                 (vm_name, to_host)
-        from_host = self.vm2vmhost[vm_name]
+        from_host = self.get_vm_vmhost(vm_name)
         if from_host == to_host:
             raise RuntimeError, "can't migrate %s from %s to same vmhost" % \
                   (vm_name, from_host)
 
-        #new = self.clone()
-        new = deepcopy(self)
+        new = self.clone()
         new.remove_vm(vm_name)
         new.add_vm(vm_name, to_host)
         return new
@@ -135,14 +277,71 @@ class VMPoolState:
     def check_migration_sane(self, vm_name, to_host):
         """Checks whether vm can be moved to to_host.  Returns new
         pool state if sane, otherwise raises a VMPoolStateSanityError.
+
+        The current state is assumed to be sane, so only the migrated
+        VM and to_host are checked; the VM host being migrated from
+        can only gain free RAM, and nothing else changes.
         """
+        self.check_vm_arch_sane(VM.vms[vm_name], to_host)
         new_state = self.migrate(vm_name, to_host.name)
-        new_state.check_sane()
+        new_state.check_vmhost_RAM_sane(to_host.name)
         return new_state
 
+    def can_migrate(self, vm_name, vmhost_name):
+        """Returns True if the VM (by name) can be migrated to the
+        VM host (by name) without the pool becoming insane.  Unlike
+        check_migration_sane(), this runs in constant time and does
+        not construct the new state.  The current state is assumed
+        to be sane.
+        """
+        if self.vm2vmhost[vm_name] == vmhost_name:
+            return False
+        vm = VM.vms[vm_name]
+        if vm.ram > self.free_RAM(vmhost_name):
+            return False
+        return self.vm_arch_ok(vm, VMhost.vmhosts[vmhost_name])
+
     def total_guest_RAM(self, vmhost_name):
-        guests = self.vmhost2vms[vmhost_name]
-        return sum([VM.vms[guest].ram for guest in guests])
+        return self.vmhost_guest_RAM[vmhost_name]
+
+    def free_RAM(self, vmhost_name):
+        """Returns the RAM on the given VM host which is not used
+        by either dom0 or guests.
+        """
+        vmhost = VMhost.vmhosts[vmhost_name]
+        return vmhost.ram - vmhost.dom0_ram - \
+            self.vmhost_guest_RAM[vmhost_name]
+
+    def vmhost_vms_by_cost(self, vmhost_name):
+        """Returns a list of (cost, name) pairs for the VMs on the given
+        host, where cost is the lower bound which the current cost
+        model (see VMmigration.set_cost_model()) puts on migrating the
+        VM away, sorted by cost and then by name.  The list is built
+        on first use and cached until the VM host's guests or the cost
+        model change, so must not be modified.
+        """
+        cost_model = VMmigration.cost_model
+        cached = self._vms_by_cost.get(vmhost_name)
+        if cached is None or cached[0] is not cost_model:
+            vmhost = VMhost.vmhosts[vmhost_name]
+            vms = sorted([ (cost_model.lower_bound(VM.vms[vm_name], vmhost),
+                            vm_name)
+                           for vm_name in self.get_vmhost_vms(vmhost_name) ])
+            cached = self._vms_by_cost[vmhost_name] = (cost_model, vms)
+        return cached[1]
+
+    def vmhosts_by_free_RAM(self):
+        """Returns a list of (free RAM, name) pairs for the VM hosts in
+        this state, sorted by free RAM and then by name, so that the
+        best fitting VM host for a VM can be found by bisection.  The
+        list is built on first use and cached, so must not be
+        modified.
+        """
+        if self._vmhosts_by_free_RAM is None:
+            self._vmhosts_by_free_RAM = \
+                sorted([ (self.free_RAM(vmhost_name), vmhost_name)
+                         for vmhost_name in self.vmhost_names() ])
+        return self._vmhosts_by_free_RAM
 
     def check_sane(self):
         for vmhost_name in self.vmhost_names():
@@ -152,6 +351,10 @@ class VMPoolState:
         """Raises a VMPoolStateSanityError exception if given VM host is
         capable of hosting VMs allocated to it in this state object.
         """
+        self.check_vmhost_RAM_sane(vmhost_name)
+        self.check_vms_sane(vmhost_name)
+
+    def check_vmhost_RAM_sane(self, vmhost_name):
         vmhost = VMhost.vmhosts[vmhost_name]
         guest_RAM_required = self.total_guest_RAM(vmhost_name)
         vmhost_RAM_required = guest_RAM_required + vmhost.dom0_ram
@@ -161,41 +364,134 @@ class VMPoolState:
                   % (vmhost_name,
                      guest_RAM_required, vmhost.dom0_ram,
                      vmhost_RAM_required, vmhost.ram)
-        self.check_vms_sane(vmhost_name)
 
     def check_vms_sane(self, vmhost_name):
         vmhost = VMhost.vmhosts[vmhost_name]
-        vms = self.vmhost2vms[vmhost_name]
-        for vm_name in vms:
+        for vm_name in self.get_vmhost_vms(vmhost_name):
             vm = VM.vms[vm_name]
             self.check_vm_arch_sane(vm, vmhost)
 
     def check_vm_arch_sane(self, vm, vmhost):
-        ok = VMPoolState.guest_archs_ok
-        if vmhost.arch not in ok:
-            raise RuntimeError, \
-                  "unrecognised arch %s for %s" % (vmhost.arch, vmhost)
-        if vm.arch not in ok[vmhost.arch]:
+        if not self.vm_arch_ok(vm, vmhost):
             raise VMPoolStateArchError, \
                   "%s has arch %s; incapable of hosting %s with arch %s" \
                   % (vmhost, vmhost.arch, vm, vm.arch)
 
+    def vm_arch_ok(self, vm, vmhost):
+        return (self.guest_arch_mask(vm.arch) &
+                self.vmhost_arch_bit(vmhost.arch)) != 0
+
+    def feasible_migrations_matrix(self, vm_names=None, vmhost_names=None):
+        """Determines in a single pass which of the given VMs (by
+        name) could be migrated to which of the given VM hosts (by
+        name) without the pool becoming insane, defaulting to all VMs
+        and VM hosts in the pool.  As with can_migrate(), the current
+        state is assumed to be sane.
+
+        Returns a (vm_names, vmhost_names, matrix) tuple, where
+        matrix[i][j] is true if and only if vm_names[i] can be
+        migrated to vmhost_names[j].  If NumPy is available, matrix
+        is a boolean NumPy array computed by broadcasting the VMs' RAM
+        against the VM hosts' free RAM; otherwise it is a list of
+        lists, computed via can_migrate().
+        """
+        if vm_names is None:
+            vm_names = self.vm_names()
+        if vmhost_names is None:
+            vmhost_names = self.vmhost_names()
+
+        if numpy is None:
+            matrix = [ [ self.can_migrate(vm_name, vmhost_name)
+                         for vmhost_name in vmhost_names ]
+                       for vm_name in vm_names ]
+            return vm_names, vmhost_names, matrix
+
+        vms = [ VM.vms[vm_name] for vm_name in vm_names ]
+        vmhosts = [ VMhost.vmhosts[vmhost_name] for vmhost_name in vmhost_names ]
+
+        vm_ram = numpy.array([ vm.ram for vm in vms ], dtype=int)
+        free_ram = numpy.array([ self.free_RAM(vmhost_name)
+                                 for vmhost_name in vmhost_names ], dtype=int)
+        matrix = vm_ram[:, numpy.newaxis] <= free_ram[numpy.newaxis, :]
+        matrix &= self._arch_ok_matrix(vms, vmhosts)
+
+        # A VM can't be migrated to the VM host it's already on.
+        columns = dict((vmhost_name, j)
+                       for j, vmhost_name in enumerate(vmhost_names))
+        current = numpy.array([ columns.get(self.get_vm_vmhost(vm_name), -1)
+                                for vm_name in vm_names ], dtype=int)
+        rows = numpy.flatnonzero(current >= 0)
+        matrix[rows, current[rows]] = False
+
+        return vm_names, vmhost_names, matrix
+
+    def _arch_ok_matrix(self, vms, vmhosts):
+        """Returns a boolean NumPy array whose [i, j] element is true
+        if and only if vms[i] has an arch which vmhosts[j] can host.
+        """
+        vm_masks = numpy.array([ self.guest_arch_mask(vm.arch)
+                                 for vm in vms ], dtype=numpy.uint64)
+        vmhost_bits = numpy.array([ self.vmhost_arch_bit(vmhost.arch)
+                                    for vmhost in vmhosts ], dtype=numpy.uint64)
+        return (vm_masks[:, numpy.newaxis] &
+                vmhost_bits[numpy.newaxis, :]) != 0
+
+    def feasible_migrations(self, vm_names=None, vmhost_names=None):
+        """Returns a list of the (vm_name, vmhost_name) pairs which
+        feasible_migrations_matrix() determines to be sane migrations,
+        ordered by VM and then by VM host.
+        """
+        vm_names, vmhost_names, matrix = \
+            self.feasible_migrations_matrix(vm_names, vmhost_names)
+        if numpy is None:
+            return [ (vm_name, vmhost_name)
+                     for vm_name, row in zip(vm_names, matrix)
+                     for vmhost_name, ok in zip(vmhost_names, row)
+                     if ok ]
+        rows, columns = numpy.nonzero(matrix)
+        return [ (vm_names[i], vmhost_names[j])
+                 for i, j in zip(rows.tolist(), columns.tolist()) ]
+
     def unique(self):
-        """Return unique, deterministic string representing this state."""
+        """Return unique, deterministic string representing this state.
+        This is relatively expensive, so should only be used for
+        display; use the state itself as a key for dicts etc.
+        """
         vmhost_strs = [ ]
         for vmhost_name in sorted(self.vmhost_names()):
-            vm_names = self.vmhost2vms[vmhost_name].keys()
-            vm_names.sort()
+            vm_names = sorted(self.get_vmhost_vms(vmhost_name))
             vmhost_strs.append(vmhost_name + "[" + ' '.join(vm_names) + "]")
         return " ".join(vmhost_strs)
 
     __str__ = unique
 
+    def __hash__(self):
+        return self._hash
+
     def __eq__(self, other):
         if isinstance(other, VMPoolState):
-            return self.unique() == other.unique()
+            if self._hash != other._hash:
+                return False
+            return self._same_placement(other)
         return NotImplemented
 
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def _same_placement(self, other):
+        """Full comparison with another state, which is only needed
+        when the hashes of the two states are equal.
+        """
+        if self.__class__ is not VMPoolState or \
+           other.__class__ is not VMPoolState:
+            return self.unique() == other.unique()
+        return self.vm2vmhost == other.vm2vmhost and \
+            self.vmhost_guest_RAM.viewkeys() == \
+            other.vmhost_guest_RAM.viewkeys()
+
     def __repr__(self):
         return "%s(%s)" % (self.__class__.__name__, self.unique())
 
@@ -215,8 +511,7 @@ class VMPoolState:
 
     def vmhost_ascii_meter(self, vmhost, width, highlight_vms):
         width -= 1 # allow space for trailing '|'
-        vm_names = self.vmhost2vms[vmhost.name].keys()
-        vm_names.sort()
+        vm_names = sorted(self.get_vmhost_vms(vmhost.name))
         vms = [ VM.vms[vm_name] for vm_name in vm_names ]
         ram_used = 0
         doms  = [ ('dom0', 'dom0 (%s)' % vmhost.dom0_ram, vmhost.dom0_ram) ]
@@ -251,3 +546,5 @@ class VMPoolState:
             meter += dom_text
 
         return "[%s]" % meter
+
+VMPoolState.set_guest_archs_ok(VMPoolState.guest_archs_ok)
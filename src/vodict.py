@@ -23,7 +23,7 @@ class ValueOrderedDictionary(dict):
         self.insert(new_key, new_val)
 
     def insert(self, new_key, new_val):
-        if new_key in self.ordered_keys:
+        if new_key in self:
             raise ValueError, "key %s already in todo list" % new_key
         # N.B. bisect_right is required to ensure FIFO behaviour,
         # otherwise the optimising effects of preferentially examining
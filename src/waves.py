@@ -0,0 +1,94 @@
+#!/usr/bin/python
+
+from vmmigration import VMmigration
+from vmpoolstateerrors import VMPoolStateSanityError
+
+class WaveScheduler:
+    """Splits the sequence of migrations of a VMPoolPath into waves,
+    where all the migrations in a wave can be performed concurrently,
+    and each wave starts once the previous one has finished.
+
+    Waves are contiguous chunks of the sequence, so every dependency
+    between migrations which the path finder relied upon is still
+    respected.  A migration is only added to the current wave if:
+
+    - no other migration in the wave moves the same VM
+    - its source and destination VM hosts have fewer than
+      max_outbound and max_inbound migrations in the wave respectively
+      (None means unlimited)
+    - its destination VM host has enough free RAM at the start of
+      the wave for all the VMs migrating to it in the wave.  A VM
+      being live migrated occupies RAM on both VM hosts until the
+      migration completes, so RAM freed by migrations away from a VM
+      host can only be used by the next wave.
+
+    This guarantees that the pool stays sane whatever order the
+    migrations within a wave complete in.
+    """
+
+    def __init__(self, max_inbound=1, max_outbound=1):
+        self.max_inbound = max_inbound
+        self.max_outbound = max_outbound
+
+    def schedule(self, path):
+        """Returns a list of waves, each of which is a list of
+        migrations, for the given path, and records them in the path.
+        """
+        waves = [ ]
+        state = path.state_post_initial_shutdowns
+        wave = [ ]
+        for migration in path.migration_sequence:
+            if wave and not self._fits(state, wave, migration):
+                state = self._perform(state, wave)
+                waves.append(wave)
+                wave = [ ]
+            if not self._fits(state, wave, migration):
+                raise VMPoolStateSanityError, \
+                    "migration %s is not sane on its own" % migration
+            wave.append(migration)
+        if wave:
+            state = self._perform(state, wave)
+            waves.append(wave)
+
+        path.set_waves(waves)
+        return waves
+
+    def _fits(self, state, wave, migration):
+        """Returns True if the migration can be performed concurrently
+        with those already in the wave, which starts in the given
+        state.
+        """
+        vm = migration.vm
+        to_host_name = migration.to_host.name
+        from_host_name = migration.from_host.name
+        if state.get_vm_vmhost(vm.name) != from_host_name or \
+           not state.vm_arch_ok(vm, migration.to_host):
+            return False
+
+        inbound = outbound = 0
+        incoming_RAM = vm.ram
+        for other in wave:
+            if other.vm.name == vm.name:
+                return False
+            if other.to_host.name == to_host_name:
+                inbound += 1
+                incoming_RAM += other.vm.ram
+            if other.from_host.name == from_host_name:
+                outbound += 1
+
+        if self.max_inbound is not None and inbound >= self.max_inbound:
+            return False
+        if self.max_outbound is not None and outbound >= self.max_outbound:
+            return False
+        return incoming_RAM <= state.free_RAM(to_host_name)
+
+    def _perform(self, state, wave):
+        for migration in wave:
+            state = state.migrate(migration.vm.name, migration.to_host.name)
+        return state
+
+def makespan(waves):
+    """Returns the total time the given waves take, in the same units
+    as VMmigration.cost(), as estimated by the current cost model.
+    """
+    return VMmigration.cost_model.makespan(waves)